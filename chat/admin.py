@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import UserProfile, Room, Message, Notification
+from django.db.models import Q
+from .models import UserProfile, Room, Message, ReadState, Notification, Upload, ArchiveSegment
+from .search import get_search_backend, search_terms
 
 
 @admin.register(UserProfile)
@@ -11,10 +13,11 @@ class UserProfileAdmin(admin.ModelAdmin):
 
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
-    list_display = ['name', 'room_type', 'created_by', 'created_at']
+    list_display = ['name', 'room_type', 'created_by', 'message_count', 'last_message_at', 'retention_days', 'created_at']
     list_filter = ['room_type', 'created_at']
     search_fields = ['name', 'description']
     prepopulated_fields = {'slug': ('name',)}
+    readonly_fields = ['message_count', 'last_message_id', 'last_message_at']
 
 
 @admin.register(Message)
@@ -23,11 +26,31 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ['room', 'timestamp', 'is_read']
     search_fields = ['content', 'sender__username']
     
+    def get_search_results(self, request, queryset, search_term):
+        # Match content through the search index instead of LIKE scans;
+        # senders still match on any part of their username
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q(sender__username__icontains=search_term)
+        terms = search_terms(search_term)
+        if terms:
+            condition |= Q(pk__in=get_search_backend().filter(Message.objects.all(), terms).values('pk'))
+        return queryset.filter(condition), False
+    
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
     content_preview.short_description = 'Content'
 
 
+@admin.register(ReadState)
+class ReadStateAdmin(admin.ModelAdmin):
+    list_display = ['user', 'room', 'last_read_message_id', 'updated_at']
+    list_filter = ['room']
+    search_fields = ['user__username', 'room__name']
+    raw_id_fields = ['user', 'room']
+
+
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
     list_display = ['user', 'notification_type', 'content_preview', 'is_read', 'created_at']
@@ -37,3 +60,20 @@ class NotificationAdmin(admin.ModelAdmin):
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
     content_preview.short_description = 'Content'
+
+
+@admin.register(Upload)
+class UploadAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'user', 'room', 'received', 'size', 'message', 'updated_at']
+    list_filter = ['room']
+    search_fields = ['filename', 'user__username']
+    raw_id_fields = ['user', 'room', 'message']
+
+
+@admin.register(ArchiveSegment)
+class ArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ['room', 'first_id', 'last_id', 'first_timestamp', 'last_timestamp', 'message_count', 'size']
+    list_filter = ['room']
+    readonly_fields = [
+        'room', 'path', 'first_id', 'last_id', 'first_timestamp', 'last_timestamp', 'message_count', 'size',
+    ]
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .recent import check_recent_backend
+        from .search import check_search_index
+        checks.register(check_search_index, checks.Tags.database)
+        checks.register(check_recent_backend, checks.Tags.caches)
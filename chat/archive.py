@@ -0,0 +1,150 @@
+"""
+Cold storage of old messages in compressed NDJSON segments
+"""
+import gzip
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .cache import LRUCache
+from .models import ArchiveSegment, Message
+
+# Decoded segments, immutable once written; paging through one reads it once
+segments = LRUCache(getattr(settings, 'CHAT_ARCHIVE_CACHE_SIZE', 32))
+
+
+def get_archive_storage():
+    """The 'chat_archive' storage if configured, else CHAT_ARCHIVE_DIR on disk"""
+    if 'chat_archive' in settings.STORAGES:
+        return storages['chat_archive']
+    return FileSystemStorage(location=settings.CHAT_ARCHIVE_DIR)
+
+
+def get_retention_days(room):
+    """Days a room's messages stay in the messages table, None for ever"""
+    if room.retention_days is not None:
+        return room.retention_days
+    return getattr(settings, 'CHAT_RETENTION_DAYS', None)
+
+
+def to_record(message):
+    """A message as stored in a segment; the sender's name is frozen here"""
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'username': message.sender.username,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'is_read': message.is_read,
+        'file': message.file.name or '',
+        'image': message.image.name or '',
+        'thumbnail': message.thumbnail.name or '',
+    }
+
+
+def archive_batch(room_id, cutoff, batch_size):
+    """Move the oldest messages sent before ``cutoff`` into a new segment.
+
+    The segment is written, indexed and the rows deleted in one transaction,
+    so an interrupted run leaves every message in exactly one tier; if the
+    transaction fails, the file it wrote is deleted again. Returns the
+    number of messages moved.
+    """
+    storage = get_archive_storage()
+    saved = None
+    try:
+        with transaction.atomic():
+            batch = list(
+                Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+                .select_related('sender')
+                .order_by('timestamp', 'id')[:batch_size]
+            )
+            if not batch:
+                return 0
+            first, last = batch[0], batch[-1]
+            name = f'{room_id}/{first.id}-{last.id}.ndjson.gz'
+            data = gzip.compress(''.join(json.dumps(to_record(message)) + '\n' for message in batch).encode())
+            # Left by a run that died before committing; ids are never reused
+            if storage.exists(name):
+                storage.delete(name)
+            saved = storage.save(name, ContentFile(data))
+            ArchiveSegment.objects.create(
+                room_id=room_id,
+                path=saved,
+                first_id=first.id,
+                last_id=last.id,
+                first_timestamp=first.timestamp,
+                last_timestamp=last.timestamp,
+                message_count=len(batch),
+                size=len(data),
+            )
+            # Room counters keep counting archived messages
+            Message.objects.filter(pk__in=[message.id for message in batch]).delete()
+    except Exception:
+        if saved is not None:
+            storage.delete(saved)
+        raise
+    return len(batch)
+
+
+def archive_room(room, batch_size=1000, now=None):
+    """Archive every message of ``room`` past its retention, batch by batch"""
+    days = get_retention_days(room)
+    if days is None:
+        return
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    while moved := archive_batch(room.id, cutoff, batch_size):
+        yield moved
+
+
+def read_segment(segment):
+    """Records of a segment, oldest first"""
+    records = segments.get(segment.pk)
+    if records is None:
+        with get_archive_storage().open(segment.path, 'rb') as stored:
+            records = [json.loads(line) for line in gzip.decompress(stored.read()).splitlines()]
+        segments.set(segment.pk, records)
+    return records
+
+
+def read_archived(room_id, before=None, limit=50):
+    """Archived records older than the ``before`` (timestamp, id) pair.
+
+    Returns up to ``limit`` records, oldest first, and whether there are
+    older ones still.
+    """
+    found = ArchiveSegment.objects.filter(room_id=room_id)
+    if before is not None:
+        timestamp, message_id = before
+        found = found.filter(
+            Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_id__lt=message_id)
+        )
+    records = []
+    for segment in found.order_by('-last_timestamp', '-last_id').iterator():
+        older = read_segment(segment)
+        if before is not None:
+            older = [
+                record for record in older
+                if (parse_datetime(record['timestamp']), record['id']) < before
+            ]
+        records = older + records
+        if len(records) > limit:
+            break
+    return records[-limit:] if limit else [], len(records) > limit
+
+
+def has_archived_after(room_id, message_id):
+    """Whether any archived message of the room is newer than ``message_id``"""
+    return ArchiveSegment.objects.filter(room_id=room_id, last_id__gt=message_id).exists()
+
+
+def delete_segment_file(segment):
+    get_archive_storage().delete(segment.path)
+    segments.discard(segment.pk)
@@ -0,0 +1,100 @@
+"""
+Avatar thumbnails and cached per-user render data
+"""
+import logging
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import connection
+
+from . import imaging
+from .cache import LRUCache
+from .models import UserProfile
+from .uploads import get_image_pool, store
+
+logger = logging.getLogger(__name__)
+
+# username -> {'username', 'avatar'}, the sender details shown with messages
+render_data = LRUCache(getattr(settings, 'CHAT_RENDER_CACHE_SIZE', 4096))
+
+
+def get_avatar_sizes():
+    return getattr(settings, 'CHAT_AVATAR_SIZES', (32, 64, 128))
+
+
+def thumbnail_name(avatar_hash, size):
+    return f'avatars/thumbs/{avatar_hash}-{size}.jpg'
+
+
+def avatar_url(avatar_hash, size=None):
+    """URL of an avatar thumbnail, None for users without one"""
+    if not avatar_hash:
+        return None
+    return default_storage.url(thumbnail_name(avatar_hash, size or getattr(settings, 'CHAT_AVATAR_SIZE', 64)))
+
+
+def get_render_data(usernames):
+    """Render data for each of ``usernames``, loading misses in one query"""
+    found = {}
+    missing = []
+    for username in set(usernames):
+        data = render_data.get(username)
+        if data is None:
+            missing.append(username)
+        else:
+            found[username] = data
+    if missing:
+        for username, avatar_hash in User.objects.filter(username__in=missing).values_list(
+            'username', 'profile__avatar_hash',
+        ):
+            data = found[username] = {'username': username, 'avatar': avatar_url(avatar_hash)}
+            render_data.set(username, data)
+    return found
+
+
+def add_avatars(messages):
+    """Copies of serialized messages with their sender's avatar URL"""
+    senders = get_render_data(message['username'] for message in messages)
+    return [
+        {**message, 'avatar': senders[message['username']]['avatar'] if message['username'] in senders else None}
+        for message in messages
+    ]
+
+
+def generate_thumbnails(profile):
+    """Create the thumbnails of a profile's avatar and record its hash"""
+    directory = tempfile.mkdtemp()
+    try:
+        avatar_hash, paths = get_image_pool().submit(
+            imaging.make_avatar_thumbnails, profile.avatar.path, directory, get_avatar_sizes(),
+        ).result()
+        for size, path in paths.items():
+            # Content-addressed, so an existing file is already right
+            if not default_storage.exists(thumbnail_name(avatar_hash, size)):
+                store(path, thumbnail_name(avatar_hash, size))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    # Only if the avatar was not replaced in the meantime
+    UserProfile.objects.filter(pk=profile.pk, avatar=profile.avatar.name).update(avatar_hash=avatar_hash)
+    render_data.discard(profile.user.username)
+    return avatar_hash
+
+
+def process_avatar(profile):
+    """Generate thumbnails for a newly uploaded avatar off the request path"""
+    thread = threading.Thread(target=_process_avatar, args=(profile,), daemon=True)
+    thread.start()
+    return thread
+
+
+def _process_avatar(profile):
+    try:
+        generate_thumbnails(profile)
+    except Exception:
+        logger.exception('Failed to make avatar thumbnails for %s', profile.user.username)
+    finally:
+        connection.close()
@@ -0,0 +1,286 @@
+"""
+In-process load generator for the websocket path
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import timedelta
+
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .models import Room
+
+
+class QueryCounter:
+    """Count SQL statements on every database connection, in every thread"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._wrapped = set()
+
+    def install(self):
+        from django.db import connections
+        connection_created.connect(self._on_connection_created)
+        for connection in connections.all():
+            self._wrap(connection)
+
+    def uninstall(self):
+        connection_created.disconnect(self._on_connection_created)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        self._wrap(connection)
+
+    def _wrap(self, connection):
+        if id(connection) not in self._wrapped:
+            self._wrapped.add(id(connection))
+            connection.execute_wrappers.append(self._execute)
+
+    def _execute(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+class BenchmarkClient:
+    """One simulated browser tab connected to a room"""
+
+    def __init__(self, application, user, room, session_key, run):
+        self.user = user
+        self.room = room
+        self.run = run
+        self.communicator = WebsocketCommunicator(
+            application,
+            f'/ws/chat/{room.slug}/' + ('?batch=1' if run.batch else ''),
+            headers=[
+                (b'host', b'localhost'),
+                (b'origin', b'http://localhost'),
+                (b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode()),
+            ],
+        )
+        self.last_message_id = 0
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=60)
+        return connected
+
+    async def listen(self):
+        while True:
+            output = await self.communicator.receive_output(timeout=None)
+            if output['type'] == 'websocket.close':
+                return
+            if 'text' not in output:
+                continue
+            received = time.perf_counter()
+            self.run.frames_received += 1
+            data = json.loads(output['text'])
+            for event in data if isinstance(data, list) else [data]:
+                self.run.record_event(event, received)
+                if event.get('type') == 'message':
+                    self.last_message_id = max(self.last_message_id, event['message_id'])
+
+    async def drive(self, rng, deadline):
+        interval = 1 / self.run.rate
+        # Spread the first action so clients do not fire in lockstep
+        await asyncio.sleep(rng.uniform(0, interval))
+        sequence = itertools.count()
+        while time.perf_counter() < deadline:
+            action = rng.choices(self.run.actions, weights=self.run.weights)[0]
+            if action == 'message':
+                self.run.messages_sent += 1
+                self.run.expected_deliveries += self.run.room_sizes[self.room.id]
+                await self.communicator.send_json_to({
+                    'type': 'message',
+                    'message': f'bench {next(sequence)} {time.perf_counter():.6f}',
+                })
+            elif action == 'typing':
+                await self.communicator.send_json_to({
+                    'type': 'typing',
+                    'is_typing': rng.random() < 0.8,
+                })
+            elif action == 'receipt' and self.last_message_id:
+                await self.communicator.send_json_to({
+                    'type': 'read_receipt',
+                    'message_id': self.last_message_id,
+                })
+            remaining = deadline - time.perf_counter()
+            await asyncio.sleep(max(0, min(rng.expovariate(1 / interval), remaining)))
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+class BenchmarkRun:
+    """Set up users and rooms, drive the clients and collect the numbers"""
+
+    def __init__(self, clients=100, rooms=1, duration=10.0, rate=1.0, mix=None,
+                 seed=0, batch=False, connect_concurrency=200, drain=1.0, log=print):
+        self.clients = clients
+        self.rooms = rooms
+        self.duration = duration
+        self.rate = rate
+        mix = mix or {'message': 0.5, 'typing': 0.4, 'receipt': 0.1}
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+        self.seed = seed
+        self.batch = batch
+        self.connect_concurrency = connect_concurrency
+        self.drain = drain
+        self.log = log
+        self.messages_sent = 0
+        self.deliveries = 0
+        self.events_received = 0
+        self.frames_received = 0
+        self.latencies = []
+        self.expected_deliveries = 0
+        self.last_event_at = 0
+        self.room_sizes = {}
+
+    def record_event(self, event, received):
+        self.events_received += 1
+        self.last_event_at = received
+        if event.get('type') == 'message' and event.get('message', '').startswith('bench '):
+            sent = float(event['message'].rsplit(' ', 1)[1])
+            self.deliveries += 1
+            self.latencies.append(received - sent)
+
+    def create_fixtures(self):
+        """Users, rooms and logged-in sessions for every client"""
+        password = make_password(None)
+        User.objects.bulk_create(
+            (User(username=f'bench{i}', password=password) for i in range(self.clients)),
+            batch_size=500,
+        )
+        users = list(User.objects.filter(username__startswith='bench').order_by('id'))
+        rooms = [
+            Room.objects.create(name=f'Benchmark {i}', slug=f'benchmark-{i}')
+            for i in range(self.rooms)
+        ]
+        expires = timezone.now() + timedelta(days=1)
+        store = SessionStore()
+        sessions = []
+        for user in users:
+            sessions.append(Session(
+                session_key=get_random_string(32, VALID_KEY_CHARS),
+                session_data=store.encode({
+                    SESSION_KEY: str(user.pk),
+                    BACKEND_SESSION_KEY: 'django.contrib.auth.backends.ModelBackend',
+                    HASH_SESSION_KEY: user.get_session_auth_hash(),
+                }),
+                expire_date=expires,
+            ))
+        Session.objects.bulk_create(sessions, batch_size=500)
+        for index, room in enumerate(rooms):
+            room.participants.add(*users[index::self.rooms])
+            self.room_sizes[room.id] = len(users[index::self.rooms])
+        return [
+            (user, rooms[index % self.rooms], session.session_key)
+            for index, (user, session) in enumerate(zip(users, sessions))
+        ]
+
+    async def execute(self, application, fixtures):
+        rng = random.Random(self.seed)
+        clients = [BenchmarkClient(application, user, room, key, self) for user, room, key in fixtures]
+
+        # Installed before any database thread exists so every connection
+        # is wrapped; the count is reset once the load starts
+        counter = QueryCounter()
+        counter.install()
+
+        self.log(f'Connecting {len(clients)} clients...')
+        semaphore = asyncio.Semaphore(self.connect_concurrency)
+
+        async def connect(client):
+            async with semaphore:
+                return await client.connect()
+
+        connected = await asyncio.gather(*(connect(client) for client in clients))
+        if not all(connected):
+            raise RuntimeError(f'{connected.count(False)} clients were rejected')
+        listeners = [asyncio.create_task(client.listen()) for client in clients]
+
+        # Let the burst of join notifications drain before measuring
+        self.last_event_at = time.perf_counter()
+        while time.perf_counter() - self.last_event_at < 0.5:
+            await asyncio.sleep(0.1)
+        self.events_received = 0
+        self.frames_received = 0
+        counter.count = 0
+
+        self.log(f'Running for {self.duration}s...')
+        started = time.perf_counter()
+        deadline = started + self.duration
+        await asyncio.gather(*(
+            client.drive(random.Random(rng.random()), deadline) for client in clients
+        ))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(self.drain)
+        counter.uninstall()
+
+        await asyncio.gather(*(client.disconnect() for client in clients))
+        for listener in listeners:
+            listener.cancel()
+        return self.report(elapsed, counter.count)
+
+    def report(self, elapsed, queries):
+        latencies = sorted(self.latencies)
+        to_ms = lambda value: None if value is None else round(value * 1000, 3)
+        return {
+            'config': {
+                'clients': self.clients,
+                'rooms': self.rooms,
+                'duration': self.duration,
+                'rate': self.rate,
+                'mix': dict(zip(self.actions, self.weights)),
+                'seed': self.seed,
+                'batch': self.batch,
+                'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+                'channel_layer_shards': len(settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('shards', [None])),
+                'message_write_mode': getattr(settings, 'CHAT_MESSAGE_WRITE_MODE', 'sync'),
+            },
+            'results': {
+                'elapsed': round(elapsed, 3),
+                'messages_sent': self.messages_sent,
+                'messages_per_sec': round(self.messages_sent / elapsed, 2),
+                'deliveries': self.deliveries,
+                'deliveries_per_sec': round(self.deliveries / elapsed, 2),
+                'delivery_ratio': round(self.deliveries / self.expected_deliveries, 4) if self.expected_deliveries else None,
+                'events_received': self.events_received,
+                'frames_received': self.frames_received,
+                'latency_ms': {
+                    'p50': to_ms(percentile(latencies, 0.50)),
+                    'p90': to_ms(percentile(latencies, 0.90)),
+                    'p99': to_ms(percentile(latencies, 0.99)),
+                    'max': to_ms(latencies[-1] if latencies else None),
+                },
+                'db_queries': queries,
+                'db_queries_per_message': round(queries / self.messages_sent, 3) if self.messages_sent else None,
+            },
+        }
+
+
+def use_channel_layer(config):
+    """Swap the default channel layer before any consumer is created"""
+    settings.CHANNEL_LAYERS = {'default': config}
+    channel_layers.backends = {}
@@ -0,0 +1,105 @@
+"""
+Process-wide lookup caches for the websocket consumers
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django.contrib.auth.models import User
+
+from .models import Room
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used mapping"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_value(self, value):
+        """Drop every key mapping to ``value``"""
+        with self._lock:
+            for key in [k for k, v in self._data.items() if v == value]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+room_ids = LRUCache(getattr(settings, 'CHAT_ROOM_CACHE_SIZE', 1024))
+user_ids = LRUCache(getattr(settings, 'CHAT_USER_CACHE_SIZE', 4096))
+
+
+def get_room_id(slug):
+    """Return the id of the room with ``slug``, or None if there is none"""
+    room_id = room_ids.get(slug)
+    if room_id is None:
+        room_id = Room.objects.filter(slug=slug).values_list('id', flat=True).first()
+        if room_id is not None:
+            room_ids.set(slug, room_id)
+    return room_id
+
+
+def get_user_id(username):
+    """Return the id of the user called ``username``, or None if there is none"""
+    user_id = user_ids.get(username)
+    if user_id is None:
+        user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+        if user_id is not None:
+            user_ids.set(username, user_id)
+    return user_id
+
+
+PUBLIC_ROOMS_KEY = 'chat:public_room_ids'
+
+
+def get_public_room_ids():
+    """Ids of all public rooms, cached until a room is saved or deleted.
+
+    Bulk updates send no signals, so the list also expires on its own.
+    """
+    public_ids = cache.get(PUBLIC_ROOMS_KEY)
+    if public_ids is None:
+        public_ids = list(Room.objects.filter(room_type='public').order_by().values_list('id', flat=True))
+        cache.set(PUBLIC_ROOMS_KEY, public_ids, getattr(settings, 'CHAT_PUBLIC_ROOMS_TIMEOUT', 300))
+    return public_ids
+
+
+def invalidate_public_rooms():
+    cache.delete(PUBLIC_ROOMS_KEY)
+
+
+def can_access_room(room_id, user):
+    """Whether ``user`` may read a room: any public one, private ones they are in"""
+    if room_id in get_public_room_ids():
+        return True
+    return user.is_authenticated and Room.participants.through.objects.filter(
+        room_id=room_id, user_id=user.pk,
+    ).exists()
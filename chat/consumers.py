@@ -1,9 +1,23 @@
-import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import Room, Message, UserProfile
-from django.utils import timezone
+from .avatars import add_avatars, get_render_data, render_data
+from .cache import can_access_room, get_room_id, get_user_id, room_ids, user_ids
+from .db import db_pool_to_async, db_write_to_async
+from .history import get_history_page, get_messages_after
+from .layers import is_process_local
+from .models import Message, ReadState, Room
+from .notifications import get_notification_pipeline
+from .outbound import OutboundQueue
+from .persistence import get_message_writer, is_batched
+from .presence import get_presence
+from .search import search_messages
+from .typing_indicators import get_typing_aggregator
+from . import wire
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -11,6 +25,40 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_slug = self.scope['url_route']['kwargs']['room_slug']
         self.room_group_name = f'chat_{self.room_slug}'
         self.user = self.scope['user']
+        self.read_receipt_id = None
+        self.read_receipt_task = None
+        # Ids of replayed messages whose broadcast may still be on its way
+        self.replayed = set()
+        self.protocol = wire.select_protocol(self.scope.get('subprotocols', []))
+        self.query = parse_qs(self.scope.get('query_string', b'').decode())
+        
+        # Bounded send queue; clients opt in to batched frames with ?batch=1
+        # and to acknowledging messages, which paces sends, with ?ack=1
+        self.outbound = OutboundQueue(
+            self.send,
+            self.close_slow_consumer,
+            self.close,
+            binary=self.protocol == wire.BINARY_PROTOCOL,
+            high_water=getattr(settings, 'CHAT_SEND_QUEUE_HIGH_WATER', 200),
+            low_water=getattr(settings, 'CHAT_SEND_QUEUE_LOW_WATER', 50),
+            limit=getattr(settings, 'CHAT_SEND_QUEUE_LIMIT', 1000),
+            batch=self.query.get('batch') == ['1'],
+            window=getattr(settings, 'CHAT_OUTBOUND_BATCH_WINDOW', 0.01),
+            max_bytes=getattr(settings, 'CHAT_OUTBOUND_BATCH_BYTES', 16384),
+            ack_window=getattr(settings, 'CHAT_SEND_WINDOW', 100) if self.query.get('ack') == ['1'] else None,
+        )
+        
+        # Resolve the room once for the lifetime of the socket
+        self.room_id = room_ids.get(self.room_slug)
+        if self.room_id is None:
+            self.room_id = await db_pool_to_async(get_room_id)(self.room_slug)
+        # Private rooms only admit their participants; history and replay
+        # below rely on this check
+        if self.room_id is not None and not await db_pool_to_async(can_access_room)(self.room_id, self.user):
+            self.room_id = None
+        if self.room_id is None:
+            await self.close()
+            return
         
         # Join room group
         await self.channel_layer.group_add(
@@ -18,33 +66,63 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        # Join the per-user group that call signaling is addressed to
+        if self.user.is_authenticated:
+            self.user_group_name = f'user_{self.user.id}'
+            await self.channel_layer.group_add(
+                self.user_group_name,
+                self.channel_name
+            )
+        
+        # JSON text frames unless the client negotiated the binary protocol
+        await self.accept(self.protocol)
+        
+        # A reconnecting client gets the messages it missed; live events
+        # already wait behind this handler, so nothing falls in between
+        try:
+            last_message_id = int(self.query.get('last_message_id', [0])[0])
+        except ValueError:
+            last_message_id = 0
+        if last_message_id > 0:
+            await self.replay_missed(last_message_id)
         
         # Set user as online
         if self.user.is_authenticated:
-            await self.set_user_online(True)
+            await get_presence().connect(self.user.id)
             
             # Notify others that user joined
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                wire.event('user_join', {
                     'type': 'user_join',
                     'username': self.user.username,
-                }
+                })
             )
     
     async def disconnect(self, close_code):
+        # Rejected in connect, nothing was joined
+        if self.room_id is None:
+            return
+        
+        self.outbound.close()
+        
         # Set user as offline
         if self.user.is_authenticated:
-            await self.set_user_online(False)
+            if self.read_receipt_task is not None:
+                self.read_receipt_task.cancel()
+            await self.flush_read_receipt()
+            get_typing_aggregator(self.channel_layer, self.room_group_name).update(
+                self.user.username, False
+            )
+            await get_presence().disconnect(self.user.id)
             
             # Notify others that user left
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                wire.event('user_leave', {
                     'type': 'user_leave',
                     'username': self.user.username,
-                }
+                })
             )
         
         # Leave room group
@@ -52,216 +130,332 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(
+                self.user_group_name,
+                self.channel_name
+            )
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if text_data is not None:
+                data = wire.decode(text_data)
+            elif self.protocol == wire.BINARY_PROTOCOL:
+                data = wire.unpack(bytes_data)
+            else:
+                return
+        except ValueError:
+            # Malformed frame; drop it rather than close the socket
+            return
+        if not isinstance(data, dict):
+            return
         message_type = data.get('type', 'message')
         
         if message_type == 'message':
+            if not self.user.is_authenticated:
+                return
             message_content = data['message']
-            username = data['username']
+            username = self.user.username
             
             # Save message to database
-            message = await self.save_message(username, message_content)
+            message = await self.save_message(message_content)
             
-            # Send message to room group
+            # Send message to room group, encoded once for every receiver,
+            # so the sender's avatar is looked up here and nowhere else
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    'type': 'chat_message',
+                wire.event('chat_message', {
+                    'type': 'message',
                     'message': message_content,
                     'username': username,
                     'timestamp': message['timestamp'],
                     'message_id': message['id'],
-                }
+                    'avatar': await self.get_avatar(),
+                }, message_id=message['id'])
+            )
+            
+            # Mentions and offline participants are handled in the background
+            get_notification_pipeline().submit(
+                self.room_id, self.user.id, username, message['id'], message_content
             )
         
         elif message_type == 'typing':
-            # Broadcast typing indicator
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'username': data['username'],
-                    'is_typing': data['is_typing'],
-                }
-            )
+            # Merged into a rate-limited "who is typing" snapshot
+            if self.user.is_authenticated:
+                get_typing_aggregator(self.channel_layer, self.room_group_name).update(
+                    self.user.username, bool(data.get('is_typing'))
+                )
+        
+        elif message_type == 'history':
+            # Page of older messages for scroll-back
+            try:
+                history = await self.get_history(data.get('before'))
+            except ValueError:
+                # Answered, so the client can scroll back again
+                await self.send_payload({'type': 'history', 'error': 'Invalid history cursor'})
+                return
+            await self.send_payload({
+                'type': 'history',
+                **history,
+            })
+        
+        elif message_type == 'search':
+            # Full-text search in the user's rooms, or just this one
+            if not self.user.is_authenticated:
+                return
+            try:
+                before = int(data['before']) if data.get('before') else None
+            except (TypeError, ValueError):
+                return
+            query = str(data.get('query', ''))
+            messages, next_before = await self.search(query, data.get('this_room'), before)
+            await self.send_payload({
+                'type': 'search_results',
+                'query': query,
+                'messages': messages,
+                'next_before': next_before,
+            })
+        
+        elif message_type == 'ack':
+            # Newest message the client has handled, for send pacing
+            try:
+                self.outbound.ack(int(data.get('message_id') or 0))
+            except (TypeError, ValueError):
+                return
         
         elif message_type == 'read_receipt':
-            # Mark message as read
-            message_id = data.get('message_id')
-            if message_id:
-                await self.mark_message_read(message_id)
+            # The client sends the newest message it has seen; receipts
+            # within CHAT_READ_RECEIPT_WINDOW collapse into one update
+            try:
+                message_id = int(data.get('message_id') or 0)
+            except (TypeError, ValueError):
+                return
+            if message_id and self.user.is_authenticated:
+                self.read_receipt_id = max(self.read_receipt_id or 0, message_id)
+                if self.read_receipt_task is None:
+                    self.read_receipt_task = asyncio.create_task(self.flush_read_receipt_later())
         
         # Audio call signaling
         elif message_type == 'call_offer':
             # Send call offer to specific user
-            target_username = data.get('target_username')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'call_offer',
-                    'caller': self.user.username,
-                    'target': target_username,
-                    'offer': data.get('offer'),
-                }
-            )
+            await self.send_to_user(data.get('target_username'), {
+                'type': 'call_offer',
+                'caller': self.user.username,
+                'offer': data.get('offer'),
+            })
         
         elif message_type == 'call_answer':
             # Send call answer to caller
-            target_username = data.get('target_username')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'call_answer',
-                    'answerer': self.user.username,
-                    'target': target_username,
-                    'answer': data.get('answer'),
-                }
-            )
+            await self.send_to_user(data.get('target_username'), {
+                'type': 'call_answer',
+                'answerer': self.user.username,
+                'answer': data.get('answer'),
+            })
         
         elif message_type == 'call_ice_candidate':
             # Exchange ICE candidates
-            target_username = data.get('target_username')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'call_ice_candidate',
-                    'sender': self.user.username,
-                    'target': target_username,
-                    'candidate': data.get('candidate'),
-                }
-            )
+            await self.send_to_user(data.get('target_username'), {
+                'type': 'call_ice_candidate',
+                'sender': self.user.username,
+                'candidate': data.get('candidate'),
+            })
         
         elif message_type == 'call_reject':
             # Reject incoming call
-            target_username = data.get('target_username')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'call_reject',
-                    'rejector': self.user.username,
-                    'target': target_username,
-                }
-            )
+            await self.send_to_user(data.get('target_username'), {
+                'type': 'call_reject',
+                'rejector': self.user.username,
+            })
         
         elif message_type == 'call_end':
             # End active call
-            target_username = data.get('target_username')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'call_end',
-                    'ender': self.user.username,
-                    'target': target_username,
-                }
-            )
+            await self.send_to_user(data.get('target_username'), {
+                'type': 'call_end',
+                'ender': self.user.username,
+            })
+    
+    async def send_to_user(self, username, payload):
+        """Send a payload to the connections of ``username`` in this room"""
+        if not self.user.is_authenticated or not username:
+            return
+        user_id = user_ids.get(username)
+        if user_id is None:
+            user_id = await db_pool_to_async(get_user_id)(username)
+        if user_id is None:
+            return
+        await self.channel_layer.group_send(
+            f'user_{user_id}',
+            wire.event(payload['type'], payload, room=self.room_slug),
+        )
     
+    async def send_event(self, event, low_priority=False):
+        """Queue a group event's pre-encoded frame in this socket's protocol"""
+        frame = event['bytes'] if self.protocol == wire.BINARY_PROTOCOL else event['text']
+        await self.outbound.put(frame, low_priority, event.get('message_id'))
+    
+    async def send_payload(self, payload, message_id=None):
+        """Encode and send a payload meant for this socket only"""
+        if self.protocol == wire.BINARY_PROTOCOL:
+            await self.outbound.put(wire.pack(payload), message_id=message_id)
+        else:
+            await self.outbound.put(wire.encode(payload), message_id=message_id)
+    
+    async def close_slow_consumer(self, last_message_id):
+        """Drop a client that fell too far behind, telling it where to resume"""
+        payload = {'type': 'resume', 'last_message_id': last_message_id}
+        if self.protocol == wire.BINARY_PROTOCOL:
+            await self.send(bytes_data=wire.pack(payload))
+        else:
+            await self.send(text_data=wire.encode(payload))
+        await self.close(code=4008)
+    
+    # Group events carry the client frame already encoded by the sender
     async def chat_message(self, event):
+        # Skip messages the reconnect replay already delivered; one saved
+        # alongside a newer message can miss the replay and come only here
+        if event['message_id'] in self.replayed:
+            self.replayed.discard(event['message_id'])
+            return
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'username': event['username'],
-            'timestamp': event['timestamp'],
-            'message_id': event['message_id'],
-        }))
+        await self.send_event(event)
     
     async def typing_indicator(self, event):
-        # Send typing indicator to WebSocket
-        if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'username': event['username'],
-                'is_typing': event['is_typing'],
-            }))
+        # Send the snapshot of who is typing; clients skip their own name
+        await self.send_event(event, low_priority=True)
     
     async def user_join(self, event):
         # Send user join notification
-        await self.send(text_data=json.dumps({
-            'type': 'user_join',
-            'username': event['username'],
-        }))
+        await self.send_event(event, low_priority=True)
     
     async def user_leave(self, event):
         # Send user leave notification
-        await self.send(text_data=json.dumps({
-            'type': 'user_leave',
-            'username': event['username'],
-        }))
+        await self.send_event(event, low_priority=True)
+    
+    async def notification(self, event):
+        # Send a mention or new-message notification from the per-user group
+        await self.send_event(event)
+    
+    async def attachment_ready(self, event):
+        # Send the full-size URL of an image attachment once processed
+        await self.send_event(event)
     
-    # Call signaling handlers
+    # Call signaling handlers, delivered through the per-user group
     async def call_offer(self, event):
-        # Send call offer only to target user
-        if event['target'] == self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'call_offer',
-                'caller': event['caller'],
-                'offer': event['offer'],
-            }))
+        # Send call offer to the target's socket in this room
+        if event['room'] == self.room_slug:
+            await self.send_event(event)
     
     async def call_answer(self, event):
-        # Send call answer only to target user (caller)
-        if event['target'] == self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'call_answer',
-                'answerer': event['answerer'],
-                'answer': event['answer'],
-            }))
+        # Send call answer to the caller's socket in this room
+        if event['room'] == self.room_slug:
+            await self.send_event(event)
     
     async def call_ice_candidate(self, event):
-        # Send ICE candidate only to target user
-        if event['target'] == self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'call_ice_candidate',
-                'sender': event['sender'],
-                'candidate': event['candidate'],
-            }))
+        # Send ICE candidate to the target's socket in this room
+        if event['room'] == self.room_slug:
+            await self.send_event(event)
     
     async def call_reject(self, event):
-        # Send call rejection only to target user (caller)
-        if event['target'] == self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'call_reject',
-                'rejector': event['rejector'],
-            }))
+        # Send call rejection to the caller's socket in this room
+        if event['room'] == self.room_slug:
+            await self.send_event(event)
     
     async def call_end(self, event):
-        # Send call end notification to target user
-        if event['target'] == self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'call_end',
-                'ender': event['ender'],
-            }))
+        # Send call end notification to the target's socket in this room
+        if event['room'] == self.room_slug:
+            await self.send_event(event)
     
-    @database_sync_to_async
-    def save_message(self, username, message_content):
-        user = User.objects.get(username=username)
-        room = Room.objects.get(slug=self.room_slug)
-        message = Message.objects.create(
-            room=room,
-            sender=user,
-            content=message_content
-        )
+    async def save_message(self, message_content):
+        if is_batched():
+            # Queue the row and broadcast before it is written
+            message = await get_message_writer().save(self.room_id, self.user, message_content)
+        else:
+            message = await self.create_message(message_content)
         return {
             'id': message.id,
             'timestamp': message.timestamp.isoformat(),
         }
     
-    @database_sync_to_async
-    def set_user_online(self, is_online):
-        try:
-            profile = self.user.profile
-            profile.is_online = is_online
-            profile.last_seen = timezone.now()
-            profile.save()
-        except UserProfile.DoesNotExist:
-            UserProfile.objects.create(user=self.user, is_online=is_online)
+    async def get_avatar(self):
+        """URL of the user's avatar thumbnail, from the render cache"""
+        data = render_data.get(self.user.username)
+        if data is None:
+            senders = await db_pool_to_async(get_render_data)([self.user.username])
+            data = senders.get(self.user.username, {})
+        return data.get('avatar')
     
-    @database_sync_to_async
-    def mark_message_read(self, message_id):
-        try:
-            message = Message.objects.get(id=message_id)
-            message.mark_as_read(self.user)
-        except Message.DoesNotExist:
-            pass
+    @db_write_to_async
+    def create_message(self, message_content):
+        # Passing the user lets post_save buffer the message without a query
+        return Message.objects.create(
+            room_id=self.room_id,
+            sender=self.user,
+            content=message_content
+        )
+    
+    async def replay_missed(self, last_message_id):
+        """Send the messages posted after ``last_message_id``"""
+        if is_batched() and not is_process_local():
+            # Other processes hand out ids from their own blocks and hold
+            # messages this one cannot flush, so newer ids do not mean
+            # later messages; the client reloads the room instead
+            await self.send_payload({'type': 'replay', 'messages': [], 'truncated': True})
+            return
+        if is_batched():
+            # Queued messages are not in the database yet; a batch that fails
+            # to write stays queued and must not keep this socket out
+            try:
+                await get_message_writer().flush()
+            except Exception:
+                logger.exception('Queued messages could not be written; replaying the stored ones only')
+        messages, truncated = await self.get_messages_after(last_message_id)
+        if truncated:
+            # Too far behind to replay; the client reloads the room
+            messages = []
+        self.replayed.update(message['message_id'] for message in messages)
+        await self.send_payload({
+            'type': 'replay',
+            'messages': messages,
+            'truncated': truncated,
+        }, message_id=messages[-1]['message_id'] if messages else None)
+    
+    @db_pool_to_async
+    def get_messages_after(self, last_message_id):
+        messages, truncated = get_messages_after(self.room_id, last_message_id)
+        return add_avatars(messages), truncated
+    
+    @db_pool_to_async
+    def search(self, query, this_room, before):
+        return search_messages(
+            self.user, query, room_id=self.room_id if this_room else None, before=before
+        )
+    
+    @db_pool_to_async
+    def get_history(self, before):
+        messages, next_cursor = get_history_page(self.room_id, before=before)
+        return {
+            'messages': add_avatars(messages),
+            'next_cursor': next_cursor,
+        }
+    
+    async def flush_read_receipt_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_READ_RECEIPT_WINDOW', 0.5))
+        self.read_receipt_task = None
+        await self.flush_read_receipt()
+    
+    async def flush_read_receipt(self):
+        message_id, self.read_receipt_id = self.read_receipt_id, None
+        if message_id:
+            await self.mark_messages_read(message_id)
+    
+    @db_write_to_async
+    def mark_messages_read(self, message_id):
+        # The id comes from the client; one past the room's newest message
+        # would mark everything sent later as read too
+        last_message_id = Room.objects.filter(pk=self.room_id).values_list('last_message_id', flat=True).first() or 0
+        if is_batched():
+            # Queued messages are broadcast before the room's counter moves
+            last_message_id = max(last_message_id, get_message_writer().last_ids.get(self.room_id, 0))
+        message_id = min(message_id, last_message_id)
+        if message_id > 0:
+            ReadState.mark_read(self.user.id, self.room_id, message_id)
@@ -0,0 +1,265 @@
+"""
+Thread pools for the synchronous ORM work of async code, and SQLite tuning
+"""
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import OperationalError, connection, connections, transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    """Run ORM calls from the event loop on up to ``max_workers`` threads.
+
+    ``database_sync_to_async`` and Django's own async ORM methods (``aget``,
+    ``acreate``, ...) hand every call to one shared thread, so each socket's
+    queries wait behind everyone else's. Calls here get a thread, and that
+    thread's connection, from a fixed pool instead; stale connections are
+    closed around each call as channels does. The time a call waits for a
+    free thread is recorded as ``db_pool.queue_wait`` and calls arriving
+    while every thread is busy count as ``db_pool.saturated``.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-db')
+        self.busy = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    async def run(self, func, *args, **kwargs):
+        queued = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+            # More calls than threads, so this one queues
+            saturated = self.in_flight > self.max_workers
+        if saturated:
+            metrics.increment('db_pool.saturated')
+        metrics.increment('db_pool.calls')
+
+        def call():
+            metrics.observe('db_pool.queue_wait', time.monotonic() - queued)
+            with self._lock:
+                self.busy += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+
+        try:
+            return await DatabaseSyncToAsync(call, thread_sensitive=False, executor=self.executor)()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        """Threads, busy threads and calls waiting for one, right now"""
+        with self._lock:
+            return {
+                'threads': self.max_workers,
+                'busy': self.busy,
+                'waiting': max(self.in_flight - self.busy, 0),
+            }
+
+
+_pool = None
+
+
+def get_db_pool():
+    """Return the process-wide database pool"""
+    global _pool
+    if _pool is None:
+        _pool = DatabasePool(max_workers=getattr(settings, 'CHAT_DB_THREADS', 8))
+    return _pool
+
+
+def db_pool_to_async(func):
+    """Make a synchronous ORM function awaitable on the database pool.
+
+    Works as a decorator on functions and methods, like
+    ``database_sync_to_async``.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await get_db_pool().run(func, *args, **kwargs)
+    return wrapper
+
+
+def db_write_to_async(func):
+    """Like ``db_pool_to_async``, for functions that write.
+
+    In SQLite production mode they run on the single writer thread.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if is_sqlite_production():
+            return await get_sqlite_writer().run(func, *args, **kwargs)
+        return await get_db_pool().run(func, *args, **kwargs)
+    return wrapper
+
+
+def is_sqlite_production():
+    """Whether CHAT_SQLITE_PRODUCTION is on and the database is SQLite"""
+    return getattr(settings, 'CHAT_SQLITE_PRODUCTION', False) and connections['default'].vendor == 'sqlite'
+
+
+def apply_sqlite_pragmas(db_connection):
+    """Tune a new SQLite connection for concurrent readers and one writer"""
+    with db_connection.cursor() as cursor:
+        # WAL lets readers run alongside the writer; NORMAL only syncs at
+        # checkpoints, which WAL keeps safe against corruption
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA mmap_size={int(getattr(settings, 'CHAT_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}")
+        cursor.execute(f"PRAGMA cache_size={int(getattr(settings, 'CHAT_SQLITE_CACHE_SIZE', -64000))}")
+        cursor.execute('PRAGMA temp_store=MEMORY')
+
+
+class SQLiteWriter:
+    """Run the writes of the process on one thread, committing in groups.
+
+    SQLite has a single writer at a time, and writers on several
+    connections stall on each other's locks until one gives up with
+    "database is locked". Here one thread holds the only writing
+    connection. It takes every write queued while the last commit ran, up
+    to ``max_batch``, runs each in its own savepoint of one transaction and
+    commits once, so a burst of writes costs one sync. A failing write is
+    rolled back alone and its caller gets the exception. Side effects
+    outside the database belong in ``transaction.on_commit`` so a group
+    that is rolled back leaves none. A group that cannot get the write lock
+    is retried up to ``max_attempts`` times.
+    """
+
+    max_attempts = 5
+
+    def __init__(self, max_batch=200):
+        self.max_batch = max_batch
+        self.queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write; returns a concurrent.futures.Future of its result"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='chat-sqlite-writer', daemon=True)
+                self._thread.start()
+        future = Future()
+        self.queue.put((func, args, kwargs, future, time.monotonic()))
+        return future
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def _loop(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(jobs)
+
+    def _commit(self, jobs):
+        started = time.monotonic()
+        running = []
+        for func, args, kwargs, future, queued in jobs:
+            metrics.observe('sqlite_writer.queue_wait', started - queued)
+            if future.set_running_or_notify_cancel():
+                running.append((func, args, kwargs, future))
+        for attempt in range(self.max_attempts):
+            outcomes = []
+            try:
+                with immediate_transaction():
+                    for func, args, kwargs, future in running:
+                        try:
+                            with transaction.atomic():
+                                outcomes.append((future, func(*args, **kwargs), None))
+                        except Exception as error:
+                            outcomes.append((future, None, error))
+            except OperationalError as error:
+                # Another connection, such as an HTTP view, held the lock
+                # past the busy timeout; nothing was written, so go again
+                if is_busy(error) and attempt + 1 < self.max_attempts:
+                    metrics.increment('sqlite_writer.busy_retries')
+                    time.sleep(0.05 * 2 ** attempt)
+                    continue
+                self._fail(running, error)
+                return
+            except Exception as error:
+                self._fail(running, error)
+                return
+            break
+        metrics.increment('sqlite_writer.commits')
+        metrics.increment('sqlite_writer.writes', len(outcomes))
+        metrics.observe('sqlite_writer.commit', time.monotonic() - started)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _fail(self, running, error):
+        # Nothing was committed; start over on a fresh connection
+        logger.exception('Failed to commit %d queued writes', len(running))
+        connection.close()
+        for _, _, _, future in running:
+            future.set_exception(error)
+
+
+def is_busy(error):
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+@contextmanager
+def immediate_transaction():
+    """Transaction that takes SQLite's write lock up front.
+
+    Django 5.0 opens transactions with a deferred BEGIN, and under WAL a
+    transaction that read before its first write fails at once with
+    SQLITE_BUSY if another connection wrote in between; BEGIN IMMEDIATE
+    waits for the lock with the busy timeout instead. Autocommit is turned
+    off for the thread's connection and the transaction begun explicitly,
+    so ``transaction.atomic()`` blocks inside are savepoints. Their
+    ``on_commit`` callbacks run once the whole transaction has committed.
+    """
+    connection.set_autocommit(False)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('BEGIN IMMEDIATE')
+        yield
+        connection.commit()
+    except BaseException:
+        try:
+            connection.rollback()
+        except Exception:
+            # The connection is unusable; the next write opens a new one
+            connection.close()
+        raise
+    finally:
+        if connection.connection is not None:
+            connection.set_autocommit(True)
+
+
+_writer = None
+
+
+def get_sqlite_writer():
+    """Return the process-wide SQLite writer"""
+    global _writer
+    if _writer is None:
+        _writer = SQLiteWriter(max_batch=getattr(settings, 'CHAT_SQLITE_GROUP_COMMIT_SIZE', 200))
+    return _writer
@@ -0,0 +1,193 @@
+"""
+Keyset-paginated message history
+"""
+import base64
+import os
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .archive import has_archived_after, read_archived
+from .models import Message
+from .recent import get_recent_messages
+
+
+def get_page_size():
+    return getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+
+
+def encode_cursor(message):
+    """Opaque cursor pointing just before ``message``"""
+    return make_cursor(message.timestamp.isoformat(), message.id)
+
+
+def make_cursor(timestamp, message_id):
+    raw = f'{timestamp}|{message_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, id) pair encoded in ``cursor``.
+
+    Raises ValueError for anything that is not a cursor we handed out.
+    """
+    if not isinstance(cursor, str):
+        raise ValueError('Invalid history cursor')
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        timestamp = parse_datetime(timestamp)
+        message_id = int(message_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid history cursor')
+    if timestamp is None:
+        raise ValueError('Invalid history cursor')
+    return timestamp, message_id
+
+
+def get_history(room_id, before=None, limit=None):
+    """Return one page of messages older than the ``before`` cursor.
+
+    Messages come back oldest first, together with the cursor for the next
+    older page (None when the start of the room has been reached).
+    """
+    limit = limit or get_page_size()
+    messages = Message.objects.filter(room_id=room_id).select_related('sender')
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        messages = messages.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    page = page[:limit]
+    page.reverse()
+    return page, next_cursor
+
+
+def get_history_page(room_id, before=None, limit=None):
+    """Serialized version of ``get_history``.
+
+    Pages the recent-messages buffer covers are served from it; a database
+    read of the newest page reads enough rows to seed the buffer.
+    """
+    limit = limit or get_page_size()
+    recent = get_recent_messages()
+    snapshot = recent.get(room_id)
+    if snapshot is not None:
+        messages = snapshot.messages
+        if before:
+            timestamp, message_id = decode_cursor(before)
+            messages = [
+                message for message in messages
+                if (parse_datetime(message['timestamp']), message['message_id']) < (timestamp, message_id)
+            ]
+        if len(messages) > limit:
+            page = messages[-limit:]
+            return page, make_cursor(page[0]['timestamp'], page[0]['message_id'])
+        if snapshot.complete:
+            return messages, None
+
+    if before:
+        return read_page(room_id, before=before, limit=limit)
+
+    version = recent.version(room_id)
+    messages, next_cursor = read_page(room_id, limit=max(limit, recent.size))
+    recent.seed(room_id, version, messages, complete=next_cursor is None)
+    if len(messages) > limit:
+        page = messages[-limit:]
+        return page, make_cursor(page[0]['timestamp'], page[0]['message_id'])
+    return messages, next_cursor
+
+
+def read_page(room_id, before=None, limit=None):
+    """Serialized page from the messages table, continued into the archive.
+
+    Archived messages are all older than the ones still in the table, so
+    the archive is only read once the table runs out.
+    """
+    limit = limit or get_page_size()
+    page, next_cursor = get_history(room_id, before=before, limit=limit)
+    messages = [serialize_message(message) for message in page]
+    if next_cursor is None:
+        if messages:
+            boundary = (parse_datetime(messages[0]['timestamp']), messages[0]['message_id'])
+        else:
+            boundary = decode_cursor(before) if before else None
+        records, more = read_archived(room_id, before=boundary, limit=limit - len(messages))
+        messages = [serialize_record(record) for record in records] + messages
+        if more:
+            next_cursor = make_cursor(messages[0]['timestamp'], messages[0]['message_id'])
+    return messages, next_cursor
+
+
+def get_messages_after(room_id, message_id, limit=None):
+    """Return serialized messages newer than ``message_id``, oldest first.
+
+    The second value is True when more than ``limit`` messages were missed
+    and only the oldest ``limit`` are returned.
+    """
+    limit = limit or getattr(settings, 'CHAT_RESUME_MAX_MESSAGES', 200)
+    snapshot = get_recent_messages().get(room_id)
+    if snapshot is not None and (
+        snapshot.complete or (snapshot.messages and snapshot.messages[0]['message_id'] <= message_id)
+    ):
+        messages = [message for message in snapshot.messages if message['message_id'] > message_id]
+    else:
+        messages = [
+            serialize_message(message) for message in
+            Message.objects.filter(room_id=room_id, id__gt=message_id)
+            .select_related('sender')
+            .order_by('id')[:limit + 1]
+        ]
+        if has_archived_after(room_id, message_id):
+            # Some were archived meanwhile; the client reloads instead
+            return [], True
+    return messages[:limit], len(messages) > limit
+
+
+def serialize_message(message):
+    """Message as sent to websocket clients"""
+    data = {
+        'message': message.content,
+        'username': message.sender.username,
+        'timestamp': message.timestamp.isoformat(),
+        'message_id': message.id,
+    }
+    attachment = serialize_attachment(message)
+    if attachment is not None:
+        data['attachment'] = attachment
+    return data
+
+
+def serialize_record(record):
+    """Archived message record in the same form as ``serialize_message``"""
+    return serialize_message(Message(
+        id=record['id'],
+        sender=User(id=record['sender_id'], username=record['username']),
+        content=record['content'],
+        timestamp=parse_datetime(record['timestamp']),
+        file=record['file'] or None,
+        image=record['image'] or None,
+        thumbnail=record['thumbnail'] or None,
+    ))
+
+
+def serialize_attachment(message):
+    """File or image attached to a message, None for plain text.
+
+    An image's ``url`` stays None until its full-size version is processed.
+    """
+    if message.thumbnail:
+        return {
+            'name': os.path.basename((message.image or message.thumbnail).name),
+            'url': message.image.url if message.image else None,
+            'thumbnail_url': message.thumbnail.url,
+        }
+    if message.file:
+        return {
+            'name': os.path.basename(message.file.name),
+            'url': message.file.url,
+        }
+    return None
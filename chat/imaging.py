@@ -0,0 +1,90 @@
+"""
+Image processing run in worker processes.
+
+Nothing here imports Django, so the pool can use the spawn start method
+and its workers never touch settings or database connections.
+"""
+import hashlib
+import os
+
+from PIL import Image, ImageOps
+
+SAVE_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+# Image.info entries needed to render the image; anything else (EXIF, XMP,
+# comments, text chunks) is dropped when saving
+RENDER_INFO = ('duration', 'loop', 'transparency', 'background')
+
+
+def clear_info(image):
+    image.info = {key: image.info[key] for key in RENDER_INFO if key in image.info}
+    return image
+
+
+def make_thumbnail(source, target, max_size):
+    """Write a thumbnail of ``source`` to ``target``.
+
+    Returns the thumbnail's format ('JPEG' or 'PNG'), or None when
+    ``source`` is not an image Pillow can read. Thumbnails are re-encoded
+    from pixels only, so they carry no metadata.
+    """
+    try:
+        with Image.open(source) as image:
+            if image.format not in SAVE_FORMATS:
+                return None
+            image = clear_info(ImageOps.exif_transpose(image))
+            image.thumbnail((max_size, max_size))
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                image.save(target, 'PNG', optimize=True)
+                return 'PNG'
+            image.convert('RGB').save(target, 'JPEG', quality=85, optimize=True)
+            return 'JPEG'
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def strip_metadata(source, target):
+    """Write ``source`` to ``target`` without EXIF, XMP or text chunks.
+
+    The EXIF orientation is applied to the pixels first. The colour
+    profile is kept. Returns the image format.
+    """
+    with Image.open(source) as image:
+        image_format = image.format
+        icc_profile = image.info.get('icc_profile')
+        options = {'icc_profile': icc_profile} if icc_profile else {}
+        if getattr(image, 'is_animated', False):
+            clear_info(image)
+            image.save(target, image_format, save_all=True, **options)
+            return image_format
+        image = clear_info(ImageOps.exif_transpose(image))
+        if image_format == 'JPEG':
+            options.update(quality=90, optimize=True)
+        image.save(target, image_format, **options)
+        return image_format
+
+
+def make_avatar_thumbnails(source, directory, sizes):
+    """Write square JPEG thumbnails of ``source`` into ``directory``.
+
+    Files are named ``<hash>-<size>.jpg`` after a hash of the source bytes,
+    so a URL never changes content and can be cached indefinitely. Returns
+    the hash and the written paths by size.
+    """
+    digest = hashlib.sha256()
+    with open(source, 'rb') as original:
+        for block in iter(lambda: original.read(64 * 1024), b''):
+            digest.update(block)
+    avatar_hash = digest.hexdigest()[:20]
+
+    paths = {}
+    with Image.open(source) as image:
+        image = clear_info(ImageOps.exif_transpose(image)).convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image)
+        for size in sizes:
+            path = os.path.join(directory, f'{avatar_hash}-{size}.jpg')
+            ImageOps.fit(background, (size, size)).save(path, 'JPEG', quality=85, optimize=True)
+            paths[size] = path
+    return avatar_hash, paths
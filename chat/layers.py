@@ -0,0 +1,166 @@
+"""
+Channel layer that spreads groups over several backend layers
+"""
+import asyncio
+import bisect
+import hashlib
+import random
+from collections import Counter, defaultdict, deque
+
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+IN_MEMORY_LAYER = 'channels.layers.InMemoryChannelLayer'
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+def is_process_local():
+    """Whether the default channel layer only reaches this process.
+
+    The in-memory layer, sharded or not, cannot carry events between
+    processes, so every consumer of the deployment runs here.
+    """
+    config = settings.CHANNEL_LAYERS.get('default', {})
+    if config.get('BACKEND') == 'chat.layers.ShardedChannelLayer':
+        shards = config.get('CONFIG', {}).get('shards', [])
+        return all(shard['BACKEND'] == IN_MEMORY_LAYER for shard in shards)
+    return config.get('BACKEND') == IN_MEMORY_LAYER
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """Consistently hash groups and channels onto a set of child layers.
+
+    ``shards`` is a list of ordinary CHANNEL_LAYERS entries (``BACKEND`` and
+    optional ``CONFIG``). A group such as ``chat_<slug>`` lives on exactly
+    one shard, so joining a room and broadcasting to it only talk to that
+    shard. Channel names are drawn so that they hash to the shard that
+    created them, which lets any process route a direct send. A consumer
+    that joined groups on other shards receives from all of them.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, shards, replicas=64, **kwargs):
+        super().__init__(**kwargs)
+        if not shards:
+            raise ValueError('ShardedChannelLayer needs at least one shard')
+        self.shards = [
+            import_string(shard['BACKEND'])(**shard.get('CONFIG', {}))
+            for shard in shards
+        ]
+        # channels_redis only delivers to channel names carrying its own
+        # client prefix; sharing it lets any shard hold any channel
+        client_prefix = getattr(self.shards[0], 'client_prefix', None)
+        if client_prefix is not None:
+            for shard in self.shards:
+                shard.client_prefix = client_prefix
+        self._ring = sorted(
+            (ring_hash(f'{index}-{replica}'), index)
+            for index in range(len(self.shards))
+            for replica in range(replicas)
+        )
+        self._ring_keys = [point for point, _ in self._ring]
+        # channel -> Counter of shard indexes it has joined groups on
+        self._memberships = defaultdict(Counter)
+        # Messages that arrived while another shard's receive completed
+        self._pending = defaultdict(deque)
+        # channel -> Event set when an in-flight receive must re-listen
+        self._changed = {}
+
+    def shard_index(self, name):
+        """Index of the shard responsible for a group or channel name"""
+        position = bisect.bisect(self._ring_keys, ring_hash(name)) % len(self._ring)
+        return self._ring[position][1]
+
+    def shard_for(self, name):
+        return self.shards[self.shard_index(name)]
+
+    async def new_channel(self, prefix='specific.'):
+        index = random.randrange(len(self.shards))
+        while True:
+            channel = await self.shards[index].new_channel(prefix)
+            if self.shard_index(channel) == index:
+                return channel
+
+    async def send(self, channel, message):
+        await self.shard_for(channel).send(channel, message)
+
+    async def receive(self, channel):
+        pending = self._pending.get(channel)
+        if pending:
+            message = pending.popleft()
+            if not pending:
+                del self._pending[channel]
+            return message
+
+        # Consumers start receiving before they join any group, so listen
+        # again whenever the channel's set of shards changes
+        changed = self._changed.setdefault(channel, asyncio.Event())
+        try:
+            while True:
+                changed.clear()
+                indexes = {self.shard_index(channel)}
+                indexes.update(self._memberships.get(channel, ()))
+                receives = [asyncio.ensure_future(self.shards[index].receive(channel)) for index in indexes]
+                watcher = asyncio.ensure_future(changed.wait())
+                try:
+                    await asyncio.wait(receives + [watcher], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for future in receives + [watcher]:
+                        future.cancel()
+                # Several shards can deliver in the same tick; keep the extras
+                messages = [
+                    future.result() for future in receives
+                    if future.done() and not future.cancelled()
+                ]
+                if messages:
+                    if len(messages) > 1:
+                        self._pending[channel].extend(messages[1:])
+                    return messages[0]
+        finally:
+            if channel not in self._memberships:
+                self._changed.pop(channel, None)
+
+    def _shards_changed(self, channel):
+        changed = self._changed.get(channel)
+        if changed is not None:
+            changed.set()
+
+    async def group_add(self, group, channel):
+        index = self.shard_index(group)
+        await self.shards[index].group_add(group, channel)
+        memberships = self._memberships[channel]
+        memberships[index] += 1
+        if memberships[index] == 1:
+            self._shards_changed(channel)
+
+    async def group_discard(self, group, channel):
+        index = self.shard_index(group)
+        await self.shards[index].group_discard(group, channel)
+        memberships = self._memberships.get(channel)
+        if memberships is not None:
+            memberships[index] -= 1
+            if memberships[index] <= 0:
+                del memberships[index]
+                self._shards_changed(channel)
+            if not memberships:
+                del self._memberships[channel]
+
+    async def group_send(self, group, message):
+        await self.shard_for(group).group_send(group, message)
+
+    async def flush(self):
+        self._memberships.clear()
+        self._pending.clear()
+        for shard in self.shards:
+            await shard.flush()
+
+    async def close(self):
+        for shard in self.shards:
+            close = getattr(shard, 'close', None)
+            if close is not None:
+                await close()
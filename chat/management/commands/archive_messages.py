@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chat.archive import archive_room
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        'Move messages past their room\'s retention period into compressed archive segments. '
+        'Each batch commits on its own, so an interrupted run can simply be started again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', action='append', dest='rooms', metavar='SLUG', help='Only archive these rooms')
+        parser.add_argument('--batch-size', type=int, help='Messages per segment (default CHAT_ARCHIVE_BATCH_SIZE)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches; run again to continue')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 1000)
+        rooms = Room.objects.all().order_by('id')
+        if options['rooms']:
+            rooms = rooms.filter(slug__in=options['rooms'])
+        if getattr(settings, 'CHAT_RETENTION_DAYS', None) is None:
+            rooms = rooms.filter(~Q(retention_days=None))
+
+        started = time.perf_counter()
+        batches = total = 0
+        for room in rooms.iterator():
+            moved = 0
+            for count in archive_room(room, batch_size=batch_size):
+                moved += count
+                batches += 1
+                if batches == options['max_batches']:
+                    break
+            if moved:
+                total += moved
+                self.stdout.write(f'{room.slug}: archived {moved} messages')
+            if batches == options['max_batches']:
+                self.stdout.write('Reached --max-batches; run again to continue')
+                break
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total} messages in {batches} segments in {time.perf_counter() - started:.1f}s'
+        ))
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import shutil
+import socket
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from chat.benchmark import BenchmarkRun, use_channel_layer
+from chat.persistence import get_message_writer, is_batched
+
+
+def parse_mix(value):
+    """'message=0.6,typing=0.3,receipt=0.1' -> {'message': 0.6, ...}"""
+    mix = {}
+    for part in value.split(','):
+        action, _, weight = part.partition('=')
+        if action not in ('message', 'typing', 'receipt'):
+            raise CommandError(f'Unknown action in --mix: {action!r}')
+        mix[action] = float(weight)
+    return mix
+
+
+class Command(BaseCommand):
+    help = 'Drive simulated websocket clients against the ASGI application and report latency and throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200, help='Number of simulated connections')
+        parser.add_argument('--rooms', type=int, default=1, help='Rooms the clients are spread over')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds to generate load for')
+        parser.add_argument('--rate', type=float, default=0.5, help='Actions per client per second')
+        parser.add_argument(
+            '--mix',
+            type=parse_mix,
+            default='message=0.5,typing=0.4,receipt=0.1',
+            help='Relative weights of message, typing and receipt actions',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch', action='store_true', help='Clients opt in to batched outbound frames')
+        parser.add_argument('--layer', choices=['inmemory', 'redis'], default='inmemory')
+        parser.add_argument(
+            '--redis-url',
+            default='redis://127.0.0.1:6379/15',
+            help='Redis URL, or a comma-separated list with one URL per shard',
+        )
+        parser.add_argument(
+            '--spawn-redis',
+            action='store_true',
+            help='Start throwaway redis-servers on free ports for the run',
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=1,
+            help='Spread groups over this many layers with ShardedChannelLayer',
+        )
+        parser.add_argument('--output', default='benchmark.json', help='Where to write the JSON results')
+
+    def handle(self, *args, **options):
+        redis_processes = []
+        shards = options['shards']
+        if shards < 1:
+            raise CommandError('--shards must be at least 1')
+        if options['layer'] == 'redis':
+            if options['spawn_redis']:
+                redis_processes, urls = zip(*(self.spawn_redis() for _ in range(shards)))
+            else:
+                urls = options['redis_url'].split(',')
+                if len(urls) == 1:
+                    urls = urls * shards
+                if len(urls) != shards:
+                    raise CommandError('--redis-url needs one URL per shard')
+            layers = [
+                {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [url]}}
+                for url in urls
+            ]
+        else:
+            # In-process stand-ins for separate shard servers
+            layers = [{'BACKEND': 'channels.layers.InMemoryChannelLayer'} for _ in range(shards)]
+        if shards == 1:
+            use_channel_layer(layers[0])
+        else:
+            use_channel_layer({'BACKEND': 'chat.layers.ShardedChannelLayer', 'CONFIG': {'shards': layers}})
+
+        # Work on a throwaway test database so runs never touch real data
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            from chatproject.asgi import application
+
+            run = BenchmarkRun(
+                clients=options['clients'],
+                rooms=options['rooms'],
+                duration=options['duration'],
+                rate=options['rate'],
+                mix=options['mix'],
+                seed=options['seed'],
+                batch=options['batch'],
+                log=self.stdout.write,
+            )
+            fixtures = run.create_fixtures()
+            report = asyncio.run(self.run_benchmark(run, application, fixtures))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            for process in redis_processes:
+                process.terminate()
+                process.wait()
+
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+
+        results = report['results']
+        latency = results['latency_ms']
+        self.stdout.write(self.style.SUCCESS(
+            f"{results['messages_per_sec']} msg/s in, {results['deliveries_per_sec']} deliveries/s out, "
+            f"latency p50 {latency['p50']} ms / p99 {latency['p99']} ms, "
+            f"{results['db_queries_per_message']} queries/message"
+        ))
+        self.stdout.write(f"Results written to {options['output']}")
+
+    async def run_benchmark(self, run, application, fixtures):
+        report = await run.execute(application, fixtures)
+        if is_batched():
+            await get_message_writer().flush()
+        return report
+
+    def spawn_redis(self):
+        if shutil.which('redis-server') is None:
+            raise CommandError('--spawn-redis needs redis-server on PATH')
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        process = subprocess.Popen(
+            ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            process.terminate()
+            raise CommandError('redis-server did not start')
+        return process, f'redis://127.0.0.1:{port}/0'
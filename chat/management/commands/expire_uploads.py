@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.uploads import expire_uploads
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete attachment uploads that have not received a chunk for CHAT_UPLOAD_EXPIRY seconds, '
+        'along with their partial files. Run it periodically, e.g. from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, help='Seconds since the last chunk (default CHAT_UPLOAD_EXPIRY)')
+
+    def handle(self, *args, **options):
+        max_age = options['max_age'] or getattr(settings, 'CHAT_UPLOAD_EXPIRY', 24 * 3600)
+        uploads, files = expire_uploads(timedelta(seconds=max_age))
+        self.stdout.write(self.style.SUCCESS(f'Expired {uploads} uploads and removed {files} partial files'))
@@ -0,0 +1,69 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count, Q
+
+from chat.history import get_page_size
+from chat.models import Message, Room
+
+
+# Plan fragments that mean a table is read without an index
+FULL_SCAN_MARKERS = {
+    'sqlite': lambda line: 'SCAN ' in line and ' USING ' not in line,
+    'postgresql': lambda line: 'Seq Scan' in line,
+    'mysql': lambda line: 'type: ALL' in line or "'ALL'" in line,
+}
+
+
+class Command(BaseCommand):
+    help = 'Print EXPLAIN plans for the hot queries in chat.views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Slug of the room to plan room queries for')
+        parser.add_argument('--user', help='Username to plan per-user queries for')
+        parser.add_argument(
+            '--fail-on-scan',
+            action='store_true',
+            help='Exit with an error if any plan contains a full table scan',
+        )
+
+    def handle(self, *args, **options):
+        room = Room.objects.filter(slug=options['room']).first() if options['room'] else Room.objects.first()
+        user = User.objects.filter(username=options['user']).first() if options['user'] else User.objects.first()
+        if room is None or user is None:
+            raise CommandError('Need at least one room and one user to explain queries against')
+
+        scans = []
+        for name, queryset in self.get_queries(room, user):
+            plan = queryset.explain()
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(plan)
+            self.stdout.write('')
+            if self.has_full_scan(queryset.db, plan):
+                scans.append(name)
+
+        if scans:
+            message = 'Full table scans in: ' + ', '.join(scans)
+            if options['fail_on_scan']:
+                raise CommandError(message)
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS('No full table scans'))
+
+    def get_queries(self, room, user):
+        """The querysets chat.views runs on every page load"""
+        return [
+            ('home_view: public rooms', Room.objects.filter(room_type='public').order_by().values_list('id', flat=True)),
+            ('home_view: memberships', Room.participants.through.objects.filter(user=user).values_list('room_id', flat=True)),
+            ('home_view: rooms', Room.objects.filter(pk__in=[room.pk]).annotate(
+                online_count=Count('participants', filter=Q(participants__profile__is_online=True)),
+            )),
+            ('room_view: messages', Message.objects.filter(room_id=room.id).order_by('-timestamp', '-id')[:get_page_size() + 1]),
+            ('room_view: online users', room.participants.filter(pk__in=[user.pk]).order_by('username')),
+            ('notifications_view: list', user.notifications.all()[:20]),
+            ('notifications_view: unread count', user.notifications.filter(is_read=False)),
+        ]
+
+    def has_full_scan(self, alias, plan):
+        is_scan = FULL_SCAN_MARKERS.get(connections[alias].vendor)
+        return is_scan is not None and any(is_scan(line) for line in plan.splitlines())
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from chat.avatars import generate_thumbnails
+from chat.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Create thumbnails for avatars that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Regenerate thumbnails of every avatar')
+
+    def handle(self, *args, **options):
+        profiles = UserProfile.objects.exclude(avatar='').exclude(avatar__isnull=True).select_related('user')
+        if not options['all']:
+            profiles = profiles.filter(avatar_hash='')
+        done = failed = 0
+        for profile in profiles.iterator():
+            try:
+                generate_thumbnails(profile)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'{profile.user.username}: {e}')
+            else:
+                done += 1
+        self.stdout.write(self.style.SUCCESS(f'Generated thumbnails for {done} avatars ({failed} failed)'))
@@ -0,0 +1,227 @@
+import itertools
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from chat.models import Message, Notification, ReadState, Room, UserProfile
+from chat.recent import get_recent_messages
+
+
+WORDS = (
+    'the a to and of in is it you that for on with this be are have not was at but so just '
+    'what we can do if about all like get when up out now how my your me one time there '
+    'deploy bug fix merge review test build release server client api cache query index '
+    'lunch coffee meeting tomorrow today later thanks sure yes no maybe great nice cool'
+).split()
+
+
+def zipf_weights(count, exponent):
+    """Weights 1/rank**exponent for ranks 1..count"""
+    return [1 / rank ** exponent for rank in range(1, count + 1)]
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Generate a large, deterministic synthetic dataset for performance work'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--rooms', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--notifications', type=int, default=100000)
+        parser.add_argument('--rooms-per-user', type=float, default=5, help='Average memberships per user')
+        parser.add_argument('--private-ratio', type=float, default=0.1, help='Share of private rooms')
+        parser.add_argument('--days', type=int, default=90, help='Span of message history')
+        parser.add_argument('--zipf', type=float, default=1.1, help='Skew of room and sender activity')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='gen', help='Prefix for generated usernames and room slugs')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}_').exists():
+            raise CommandError(f'Users prefixed {prefix!r} already exist; pick another --prefix')
+
+        users = self.create_users(prefix, options['users'])
+        rooms = self.create_rooms(prefix, options['rooms'], options['private_ratio'], users)
+        members = self.create_memberships(rooms, users, options['rooms_per_user'], options['zipf'])
+        stats, sample = self.create_messages(rooms, members, options['messages'], options['days'], options['zipf'])
+        self.create_read_states(rooms, members, stats)
+        self.log('Updating room message counters...')
+        Room.refresh_message_stats(rooms)
+        # bulk_create skips the signals that keep shared buffers current
+        recent = get_recent_messages()
+        for room_id in rooms:
+            recent.invalidate(room_id)
+        self.create_notifications(users, members, sample, options['notifications'], options['zipf'])
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def log(self, message):
+        self.stdout.write(message)
+
+    def create_users(self, prefix, count):
+        self.log(f'Creating {count} users...')
+        # Hashing once keeps tens of thousands of users fast to create
+        password = make_password(f'{prefix}-password')
+        for chunk in chunked(range(count), self.chunk_size):
+            with transaction.atomic():
+                User.objects.bulk_create(
+                    User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@example.com', password=password)
+                    for i in chunk
+                )
+        self.usernames = dict(
+            User.objects.filter(username__startswith=f'{prefix}_').order_by('id').values_list('id', 'username')
+        )
+        users = list(self.usernames)
+        for chunk in chunked(users, self.chunk_size):
+            UserProfile.objects.bulk_create(UserProfile(user_id=user_id) for user_id in chunk)
+        return users
+
+    def create_rooms(self, prefix, count, private_ratio, users):
+        self.log(f'Creating {count} rooms...')
+        rng = self.rng
+        Room.objects.bulk_create(
+            Room(
+                name=f'{prefix} room {i}',
+                slug=f'{prefix}-room-{i}',
+                room_type='private' if rng.random() < private_ratio else 'public',
+                created_by_id=rng.choice(users),
+            )
+            for i in range(count)
+        )
+        return list(Room.objects.filter(slug__startswith=f'{prefix}-room-').order_by('id').values_list('id', flat=True))
+
+    def create_memberships(self, rooms, users, rooms_per_user, exponent):
+        """Room sizes follow a Zipf curve: a few huge rooms, a long tail of small ones"""
+        self.log('Creating room memberships...')
+        rng = self.rng
+        weights = zipf_weights(len(rooms), exponent)
+        total = sum(weights)
+        memberships = len(users) * rooms_per_user
+        members = {}
+        Participant = Room.participants.through
+        rows = []
+        for room_id, weight in zip(rooms, weights):
+            size = min(len(users), max(2, round(memberships * weight / total)))
+            members[room_id] = rng.sample(users, size)
+            rows.extend(Participant(room_id=room_id, user_id=user_id) for user_id in members[room_id])
+        for chunk in chunked(rows, self.chunk_size):
+            Participant.objects.bulk_create(chunk)
+        return members
+
+    def create_messages(self, rooms, members, count, days, exponent):
+        """Messages in chronological order so ids grow with timestamps"""
+        self.log(f'Creating {count} messages...')
+        rng = self.rng
+        cum_weights = list(itertools.accumulate(zipf_weights(len(rooms), exponent)))
+        start = timezone.now() - timedelta(days=days)
+        step = timedelta(days=days) / max(count, 1)
+        stats = {room_id: [None, None, 0] for room_id in rooms}
+        sample = []
+        created = 0
+        for chunk in chunked(range(count), self.chunk_size):
+            chosen = rng.choices(rooms, cum_weights=cum_weights, k=len(chunk))
+            batch = []
+            for i, room_id in zip(chunk, chosen):
+                room_members = members[room_id]
+                # Cubing a uniform draw favours the first few members, so a
+                # handful of people write most of each room's messages
+                sender = room_members[int(len(room_members) * rng.random() ** 3)]
+                batch.append(Message(
+                    room_id=room_id,
+                    sender_id=sender,
+                    content=self.make_content(room_members),
+                    timestamp=start + step * i,
+                ))
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            if batch[0].pk is None:
+                # Backend cannot return ids from bulk inserts
+                last_id = Message.objects.order_by('-id').values_list('id', flat=True).first()
+                for offset, message in enumerate(reversed(batch)):
+                    message.pk = last_id - offset
+            for message in batch:
+                room_stats = stats[message.room_id]
+                if room_stats[0] is None:
+                    room_stats[0] = message.pk
+                room_stats[1] = message.pk
+                room_stats[2] += 1
+                # Reservoir sample of messages for notifications to point at
+                if len(sample) < 10000:
+                    sample.append((message.pk, message.room_id))
+                elif rng.random() < 10000 / (created + 1):
+                    sample[rng.randrange(10000)] = (message.pk, message.room_id)
+                created += 1
+            self.log(f'  {created}/{count}')
+        return stats, sample
+
+    def make_content(self, room_members):
+        rng = self.rng
+        words = rng.choices(WORDS, k=rng.randint(2, 25))
+        if rng.random() < 0.05:
+            words.insert(0, '@' + self.usernames[rng.choice(room_members)])
+        return ' '.join(words)
+
+    def create_read_states(self, rooms, members, stats):
+        """Members have read a random share of their rooms' history"""
+        self.log('Creating read states...')
+        rng = self.rng
+        rows = []
+        for room_id in rooms:
+            first_id, last_id, count = stats[room_id]
+            if not count:
+                continue
+            for user_id in members[room_id]:
+                if rng.random() < 0.8:
+                    position = first_id + int((last_id - first_id) * min(1, rng.random() * 1.5))
+                    rows.append(ReadState(user_id=user_id, room_id=room_id, last_read_message_id=position))
+        for chunk in chunked(rows, self.chunk_size):
+            ReadState.objects.bulk_create(chunk)
+
+        # Messages below the furthest read position count as read
+        marks = {}
+        for row in rows:
+            marks[row.room_id] = max(marks.get(row.room_id, 0), row.last_read_message_id)
+        for room_id, mark in marks.items():
+            Message.objects.filter(room_id=room_id, id__lte=mark, is_read=False).update(is_read=True)
+
+    def create_notifications(self, users, members, sample, count, exponent):
+        self.log(f'Creating {count} notifications...')
+        rng = self.rng
+        if not sample:
+            return
+        user_cum_weights = list(itertools.accumulate(zipf_weights(len(users), exponent)))
+        rooms = list(members)
+        created = 0
+        for chunk in chunked(range(count), self.chunk_size):
+            recipients = rng.choices(users, cum_weights=user_cum_weights, k=len(chunk))
+            batch = []
+            for user_id in recipients:
+                kind = rng.choices(('message', 'mention', 'room_invite'), weights=(70, 25, 5))[0]
+                if kind == 'room_invite':
+                    message_id, room_id = None, rng.choice(rooms)
+                else:
+                    message_id, room_id = rng.choice(sample)
+                batch.append(Notification(
+                    user_id=user_id,
+                    notification_type=kind,
+                    message_id=message_id,
+                    room_id=room_id,
+                    content=f'Synthetic {kind} notification',
+                    is_read=rng.random() < 0.7,
+                ))
+            Notification.objects.bulk_create(batch)
+            created += len(batch)
+            self.log(f'  {created}/{count}')
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the message full-text search index from the messages table, '
+        'recreating its SQLite table and triggers if a migration dropped them'
+    )
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        self.stdout.write(f'Rebuilding with {type(backend).__name__}...')
+        started = time.perf_counter()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {Message.objects.count()} messages in {time.perf_counter() - started:.1f}s'
+        ))
@@ -0,0 +1,46 @@
+"""
+Process-local operational counters and timings
+"""
+import threading
+from collections import Counter
+
+_counters = Counter()
+_timings = {}
+_lock = threading.Lock()
+
+
+def increment(name, value=1):
+    """Add ``value`` to the counter ``name``"""
+    if value:
+        with _lock:
+            _counters[name] += value
+
+
+def observe(name, seconds):
+    """Record one duration of ``name``; count, total and maximum are kept"""
+    with _lock:
+        timing = _timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+
+def snapshot():
+    """Copy of every counter of this process"""
+    with _lock:
+        return dict(_counters)
+
+
+def timings():
+    """Copy of every timing of this process, with the mean added"""
+    with _lock:
+        return {
+            name: {**timing, 'mean': timing['total'] / timing['count']}
+            for name, timing in _timings.items()
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,60 @@
+# Generated by Django 5.0.14 on 2026-10-17 01:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def copy_read_by_to_read_state(apps, schema_editor):
+    """Turn per-message read_by rows into one high-water mark per user and room"""
+    Message = apps.get_model('chat', 'Message')
+    ReadState = apps.get_model('chat', 'ReadState')
+    ReadBy = Message.read_by.through
+    marks = (
+        ReadBy.objects
+        .values('user_id', 'message__room_id')
+        .annotate(last_read=Max('message_id'))
+        .order_by()
+    )
+    ReadState.objects.bulk_create(
+        (
+            ReadState(
+                user_id=mark['user_id'],
+                room_id=mark['message__room_id'],
+                last_read_message_id=mark['last_read'],
+            )
+            for mark in marks.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_hot_query_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='readstate',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='chat_readstate_user_room_uniq'),
+        ),
+        migrations.RunPython(copy_read_by_to_read_state, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_by',
+        ),
+    ]
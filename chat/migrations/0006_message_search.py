@@ -0,0 +1,36 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        from chat.search import install_sqlite_search
+
+        install_sqlite_search(connection)
+        schema_editor.execute("INSERT INTO chat_message_fts (chat_message_fts) VALUES ('rebuild')")
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS chat_message_fts_idx ON chat_message "
+            "USING gin (to_tsvector('simple', content))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        for trigger in ('chat_message_fts_ai', 'chat_message_fts_ad', 'chat_message_fts_au'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS chat_message_fts_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_room_message_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_archive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat.message'),
+        ),
+    ]
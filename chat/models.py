@@ -1,4 +1,7 @@
+import uuid
+
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
 
@@ -7,6 +10,8 @@ class UserProfile(models.Model):
     """Extended user profile with additional chat features"""
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    # Content hash naming the avatar's thumbnails, set once they exist
+    avatar_hash = models.CharField(max_length=20, blank=True, editable=False)
     bio = models.TextField(max_length=500, blank=True)
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(default=timezone.now)
@@ -16,6 +21,14 @@ class UserProfile(models.Model):
     
     class Meta:
         ordering = ['user__username']
+        indexes = [
+            # Admin filter on users marked online by the presence flush
+            models.Index(
+                fields=['user'],
+                condition=models.Q(is_online=True),
+                name='chat_profile_online_idx',
+            ),
+        ]
 
 
 class Room(models.Model):
@@ -33,16 +46,70 @@ class Room(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='created_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized from Message, kept up to date as messages are written
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # Days messages stay in the messages table before archive_messages moves
+    # them to cold storage; None falls back to CHAT_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
     
     def __str__(self):
         return self.name
     
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['room_type'], name='chat_room_type_idx'),
+        ]
     
     def get_online_count(self):
         """Get count of online participants"""
         return self.participants.filter(profile__is_online=True).count()
+    
+    @classmethod
+    def record_messages(cls, room_id, count, last_message):
+        """Add ``count`` new messages, the newest being ``last_message``"""
+        # Messages saved on different threads can commit out of order, so an
+        # older one must not replace a newer last message
+        newer = models.Q(last_message_id__gt=last_message.id)
+        cls.objects.filter(pk=room_id).update(
+            message_count=models.F('message_count') + count,
+            last_message_id=models.Case(
+                models.When(newer, then=models.F('last_message_id')),
+                default=models.Value(last_message.id),
+            ),
+            last_message_at=models.Case(
+                models.When(newer, then=models.F('last_message_at')),
+                default=models.Value(last_message.timestamp),
+            ),
+        )
+    
+    @classmethod
+    def refresh_message_stats(cls, room_ids=None):
+        """Recompute the message counters from the messages and archive tables"""
+        rooms = cls.objects.all() if room_ids is None else cls.objects.filter(pk__in=room_ids)
+        messages = Message.objects.filter(room=models.OuterRef('pk')).order_by()
+        latest = messages.order_by('-id')
+        segments = ArchiveSegment.objects.filter(room=models.OuterRef('pk')).order_by()
+        latest_segment = segments.order_by('-last_id')
+        rooms.update(
+            message_count=Coalesce(
+                models.Subquery(messages.values('room').annotate(count=models.Count('pk')).values('count')),
+                0,
+            ) + Coalesce(
+                models.Subquery(segments.values('room').annotate(count=models.Sum('message_count')).values('count')),
+                0,
+            ),
+            last_message_id=Coalesce(
+                models.Subquery(latest.values('id')[:1]),
+                models.Subquery(latest_segment.values('last_id')[:1]),
+            ),
+            last_message_at=Coalesce(
+                models.Subquery(latest.values('timestamp')[:1]),
+                models.Subquery(latest_segment.values('last_timestamp')[:1]),
+            ),
+        )
 
 
 class Message(models.Model):
@@ -52,23 +119,84 @@ class Message(models.Model):
     content = models.TextField()
     file = models.FileField(upload_to='chat_files/', null=True, blank=True)
     image = models.ImageField(upload_to='chat_images/', null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set for image attachments as soon as the upload completes; ``image``
+    # follows once metadata has been stripped from the full-size file
+    thumbnail = models.ImageField(upload_to='chat_thumbnails/', null=True, blank=True)
+    # Set by the writer rather than auto_now_add so batched writes keep the
+    # timestamp that was broadcast with the message
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Read by at least one user other than the sender
     is_read = models.BooleanField(default=False)
-    read_by = models.ManyToManyField(User, related_name='read_messages', blank=True)
     
     def __str__(self):
         return f"{self.sender.username} in {self.room.name}: {self.content[:50]}"
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Room history, newest first with id as tie-breaker
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_idx'),
+        ]
+    
+    @property
+    def read_by(self):
+        """Users whose read position in the room has reached this message"""
+        return User.objects.filter(
+            read_states__room_id=self.room_id,
+            read_states__last_read_message_id__gte=self.id,
+        ).exclude(pk=self.sender_id)
     
     def mark_as_read(self, user):
-        """Mark message as read by a user"""
-        if user != self.sender:
-            self.read_by.add(user)
-            if not self.is_read:
-                self.is_read = True
-                self.save()
+        """Mark message (and everything before it in the room) as read by a user"""
+        ReadState.mark_read(user.id, self.room_id, self.id)
+
+
+class ReadState(models.Model):
+    """How far a user has read in a room"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_states')
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.user.username} read {self.room.name} up to {self.last_read_message_id}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_readstate_user_room_uniq'),
+        ]
+    
+    @classmethod
+    def mark_read(cls, user_id, room_id, message_id):
+        """Advance a user's high-water mark in a room, never moving it back"""
+        advanced = cls.objects.filter(
+            user_id=user_id,
+            room_id=room_id,
+            last_read_message_id__lt=message_id,
+        ).update(last_read_message_id=message_id, updated_at=timezone.now())
+        if not advanced:
+            _, created = cls.objects.get_or_create(
+                user_id=user_id,
+                room_id=room_id,
+                defaults={'last_read_message_id': message_id},
+            )
+            if not created:
+                # Already at or past message_id, or created concurrently
+                # with a lower mark; a second conditional update settles it
+                advanced = cls.objects.filter(
+                    user_id=user_id,
+                    room_id=room_id,
+                    last_read_message_id__lt=message_id,
+                ).update(last_read_message_id=message_id, updated_at=timezone.now())
+                if not advanced:
+                    return
+        
+        # Keep Message.is_read in step for messages the user did not send
+        Message.objects.filter(
+            room_id=room_id,
+            id__lte=message_id,
+            is_read=False,
+        ).exclude(sender_id=user_id).update(is_read=True)
 
 
 class Notification(models.Model):
@@ -81,9 +209,13 @@ class Notification(models.Model):
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
     notification_type = models.CharField(max_length=20, choices=NOTIFICATION_TYPES)
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, null=True, blank=True)
+    # Cleared rather than deleted when archiving moves the message away;
+    # the text is in ``content``
+    message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True)
     room = models.ForeignKey(Room, on_delete=models.CASCADE, null=True, blank=True)
     content = models.TextField()
+    # Messages folded into this notification while it was unread
+    count = models.PositiveIntegerField(default=1)
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
@@ -92,3 +224,60 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='chat_notif_user_created_idx'),
+            # Unread count and unread listing
+            models.Index(
+                fields=['user', '-created_at'],
+                condition=models.Q(is_read=False),
+                name='chat_notif_unread_idx',
+            ),
+        ]
+
+
+class Upload(models.Model):
+    """Resumable upload of a message attachment, received in chunks"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    caption = models.TextField(blank=True)
+    size = models.PositiveBigIntegerField()
+    # Bytes written to the partial file so far
+    received = models.PositiveBigIntegerField(default=0)
+    message = models.OneToOneField(Message, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.filename} from {self.user.username} ({self.received}/{self.size})"
+    
+    @property
+    def is_complete(self):
+        return self.received >= self.size
+
+
+class ArchiveSegment(models.Model):
+    """Compressed NDJSON file holding a run of a room's archived messages"""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='archive_segments')
+    # Name in the archive storage
+    path = models.CharField(max_length=255)
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    # Compressed bytes
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.room.name}: messages {self.first_id}-{self.last_id}"
+    
+    class Meta:
+        ordering = ['room', 'first_timestamp', 'first_id']
+        indexes = [
+            # History reads walk a room's segments newest first
+            models.Index(fields=['room', 'last_timestamp', 'last_id'], name='chat_archive_room_ts_idx'),
+        ]
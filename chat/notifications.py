@@ -0,0 +1,200 @@
+"""
+Notification fan-out for new chat messages
+"""
+import asyncio
+import logging
+import re
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics, wire
+from .db import db_write_to_async
+from .models import Notification, Room
+from .persistence import get_message_writer, is_batched
+from .presence import online_user_ids
+
+logger = logging.getLogger(__name__)
+
+# @username, without trailing sentence punctuation
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.@+-]*[\w+-])')
+
+
+def find_mentions(content):
+    """Lower-cased usernames mentioned in a message"""
+    return {name.lower() for name in MENTION_RE.findall(content)}
+
+
+def describe(kind, count, room_name, username, preview):
+    """Text of a (possibly coalesced) notification"""
+    if kind == 'mention':
+        if count == 1:
+            return f'{username} mentioned you in {room_name}: {preview}'
+        return f'{count} mentions in {room_name}, latest from {username}: {preview}'
+    if count == 1:
+        return f'New message in {room_name} from {username}: {preview}'
+    return f'{count} new messages in {room_name}, latest from {username}: {preview}'
+
+
+class NotificationPipeline:
+    """Turn saved messages into notifications off the message path.
+
+    Consumers only ``submit`` a message; a background task collects them
+    for ``flush_interval`` seconds and then, on a database thread, finds the
+    room participants and their @mentions and works out who is online.
+
+    Everything a batch produces for one (user, room, kind) is coalesced:
+    online users get a single push on their ``user_<id>`` group, offline
+    users a single unread ``Notification`` row, and a row that is still
+    unread is updated with the new count rather than joined by another one.
+    However busy a room is, a user has at most one unread message and one
+    unread mention notification for it.
+
+    The queue holds at most ``max_queue`` messages; past that, and for
+    anything still queued when the process exits, notifications are lost
+    rather than slowing down chat.
+    """
+
+    def __init__(self, flush_interval=1.0, max_queue=10000, preview_length=100):
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.preview_length = preview_length
+        self.queue = None
+        self._task = None
+
+    def submit(self, room_id, sender_id, username, message_id, content):
+        """Queue a saved message; never waits"""
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.max_queue)
+        try:
+            self.queue.put_nowait((room_id, sender_id, username, message_id, content))
+        except asyncio.QueueFull:
+            metrics.increment('notifications.dropped')
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            items = [await self.queue.get()]
+            await asyncio.sleep(self.flush_interval)
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await self.process(items)
+            except Exception:
+                logger.exception('Failed to send notifications for %d messages', len(items))
+
+    async def process(self, items):
+        if is_batched():
+            # Rows reference messages the writer may not have saved yet
+            await get_message_writer().flush()
+        pushes = await db_write_to_async(self.write)(items)
+        channel_layer = get_channel_layer()
+        for user_id, payload in pushes:
+            await channel_layer.group_send(f'user_{user_id}', wire.event('notification', payload))
+        metrics.increment('notifications.pushed', len(pushes))
+
+    def write(self, items):
+        """Store notifications for offline users; return pushes for online ones"""
+        room_ids = {item[0] for item in items}
+        rooms = {
+            room_id: (name, slug)
+            for room_id, name, slug in Room.objects.filter(pk__in=room_ids).values_list('id', 'name', 'slug')
+        }
+        members = defaultdict(dict)
+        for room_id, user_id, username in Room.participants.through.objects.filter(
+            room_id__in=room_ids,
+        ).values_list('room_id', 'user_id', 'user__username'):
+            members[room_id][user_id] = username.lower()
+        online = online_user_ids({user_id for names in members.values() for user_id in names})
+
+        # (user_id, room_id, kind) -> [count, message_id, username, preview]
+        digests = {}
+        for room_id, sender_id, username, message_id, content in items:
+            if room_id not in rooms:
+                continue
+            names = members[room_id]
+            mentions = find_mentions(content)
+            mentioned = {user_id for user_id, name in names.items() if name in mentions}
+            preview = content[:self.preview_length]
+            for user_id in names:
+                if user_id == sender_id:
+                    continue
+                kind = 'mention' if user_id in mentioned else 'message'
+                digest = digests.setdefault((user_id, room_id, kind), [0, None, None, None])
+                digest[0] += 1
+                digest[1:] = [message_id, username, preview]
+
+        pushes = []
+        offline = {}
+        for (user_id, room_id, kind), (count, message_id, username, preview) in digests.items():
+            name, slug = rooms[room_id]
+            if user_id in online:
+                pushes.append((user_id, {
+                    'type': 'notification',
+                    'notification_type': kind,
+                    'room': slug,
+                    'count': count,
+                    'message_id': message_id,
+                    'content': describe(kind, count, name, username, preview),
+                }))
+            else:
+                offline[user_id, room_id, kind] = (count, message_id, username, preview)
+
+        if offline:
+            self.store(offline, rooms)
+        return pushes
+
+    def store(self, digests, rooms):
+        """Fold digests into the users' unread notifications"""
+        now = timezone.now()
+        # At most one unread row per (user, room, kind), so this stays small
+        unread = {
+            (notification.user_id, notification.room_id, notification.notification_type): notification
+            for notification in Notification.objects.filter(
+                room_id__in={room_id for _, room_id, _ in digests},
+                notification_type__in=('message', 'mention'),
+                is_read=False,
+            )
+        }
+        created, updated = [], []
+        for key, (count, message_id, username, preview) in digests.items():
+            user_id, room_id, kind = key
+            notification = unread.get(key)
+            if notification is None:
+                notification = Notification(
+                    user_id=user_id,
+                    room_id=room_id,
+                    notification_type=kind,
+                    count=0,
+                )
+                created.append(notification)
+            else:
+                updated.append(notification)
+            notification.count += count
+            notification.message_id = message_id
+            notification.content = describe(kind, notification.count, rooms[room_id][0], username, preview)
+            notification.created_at = now
+        Notification.objects.bulk_create(created, batch_size=500)
+        Notification.objects.bulk_update(
+            updated, ['count', 'message', 'content', 'created_at'], batch_size=500
+        )
+        metrics.increment('notifications.created', len(created))
+        metrics.increment('notifications.coalesced', len(updated))
+
+
+_pipeline = None
+
+
+def get_notification_pipeline():
+    """Return the process-wide notification pipeline"""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = NotificationPipeline(
+            flush_interval=getattr(settings, 'CHAT_NOTIFICATION_FLUSH_INTERVAL', 1.0),
+            max_queue=getattr(settings, 'CHAT_NOTIFICATION_QUEUE_SIZE', 10000),
+        )
+    return _pipeline
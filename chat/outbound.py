@@ -0,0 +1,160 @@
+"""
+Per-connection outbound queue with batching and backpressure
+"""
+import asyncio
+import logging
+from collections import deque
+
+from . import metrics, wire
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundQueue:
+    """Bounded queue between a consumer's group events and its socket.
+
+    Handlers only enqueue, so a client that reads slowly never stalls the
+    consumer and lets its channel layer queue fill up for the whole group.
+    A writer task drains the queue. Daphne buffers socket writes without
+    pushing back, so how fast ``send`` returns says nothing about the
+    client; clients that opt in acknowledge the newest message they have
+    handled instead, and the writer keeps at most ``ack_window`` chat
+    messages unacknowledged. Frames for a client that stops keeping up
+    therefore wait here, where the limits below apply. Without
+    acknowledgements frames go out as fast as the server accepts them.
+
+    Once ``high_water`` frames are waiting, low-priority frames (typing,
+    join/leave) are dropped, queued ones included, until the writer gets
+    the queue back down to ``low_water``. If ``limit`` frames are still
+    waiting, the queue is dropped and ``on_overflow`` is awaited with the
+    id of the last chat message actually sent, for the client to resume
+    from.
+
+    With ``batch`` set, frames are held for up to ``window`` seconds, or
+    until ``max_bytes`` are waiting, and sent as one array frame. The frames
+    are already encoded, so joining them costs no re-serialization.
+
+    If ``send`` fails, the queue is closed and ``on_error`` awaited.
+    """
+
+    def __init__(self, send, on_overflow, on_error, binary=False, high_water=200, low_water=50,
+                 limit=1000, batch=False, window=0.01, max_bytes=16384, ack_window=None):
+        self.send = send
+        self.on_overflow = on_overflow
+        self.on_error = on_error
+        self.binary = binary
+        self.high_water = high_water
+        self.low_water = low_water
+        self.limit = limit
+        self.batch = batch
+        self.window = window
+        self.max_bytes = max_bytes
+        self.ack_window = ack_window
+        # Ids of chat messages sent and not yet acknowledged, ascending
+        self.unacked = deque()
+        # (frame, low_priority, message_id)
+        self.frames = deque()
+        self.size = 0
+        self.shedding = False
+        self.closed = False
+        self.last_sent_id = None
+        self._ready = None
+        self._full = None
+        self._acked = asyncio.Event()
+        self._task = None
+
+    async def put(self, frame, low_priority=False, message_id=None):
+        if self.closed:
+            return
+        if not self.shedding and len(self.frames) >= self.high_water:
+            self.shedding = True
+            metrics.increment('outbound.shedding_started')
+            kept = deque(item for item in self.frames if not item[1])
+            metrics.increment('outbound.low_priority_dropped', len(self.frames) - len(kept))
+            self.frames = kept
+            self.size = sum(len(item[0]) for item in kept)
+        if self.shedding and low_priority:
+            metrics.increment('outbound.low_priority_dropped')
+            return
+        if len(self.frames) >= self.limit:
+            metrics.increment('outbound.overflow_disconnects')
+            self.close()
+            await self.on_overflow(self.last_sent_id)
+            return
+
+        self.frames.append((frame, low_priority, message_id))
+        self.size += len(frame)
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._ready.set()
+        if self.size >= self.max_bytes:
+            self._full.set()
+
+    def ack(self, message_id):
+        """The client has handled every message up to ``message_id``"""
+        while self.unacked and self.unacked[0] <= message_id:
+            self.unacked.popleft()
+        self._acked.set()
+
+    def close(self):
+        """Stop the writer and drop anything still queued"""
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.frames.clear()
+        self.size = 0
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            if self.batch and self.size < self.max_bytes:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            self._ready.clear()
+            self._full.clear()
+            while self.frames:
+                if self.ack_window is not None and len(self.unacked) >= self.ack_window:
+                    metrics.increment('outbound.window_full')
+                    self._acked.clear()
+                    await self._acked.wait()
+                    continue
+                try:
+                    await self._send(self._take())
+                except Exception:
+                    logger.exception('Failed to send to a websocket client, closing it')
+                    metrics.increment('outbound.send_errors')
+                    self._task = None
+                    self.close()
+                    await self.on_error()
+                    return
+                if self.shedding and len(self.frames) <= self.low_water:
+                    self.shedding = False
+
+    def _take(self):
+        items = [self.frames.popleft()]
+        size = len(items[0][0])
+        if self.batch:
+            while self.frames and size + len(self.frames[0][0]) <= self.max_bytes:
+                items.append(self.frames.popleft())
+                size += len(items[-1][0])
+        self.size -= size
+        return items
+
+    async def _send(self, items):
+        frames = [item[0] for item in items]
+        if len(frames) > 1:
+            metrics.increment('outbound.batched_frames', len(frames))
+        if self.binary:
+            await self.send(bytes_data=frames[0] if len(frames) == 1 else wire.join_binary(frames))
+        else:
+            await self.send(text_data=frames[0] if len(frames) == 1 else wire.join_text(frames))
+        message_ids = [item[2] for item in items if item[2] is not None]
+        if message_ids:
+            self.last_sent_id = max(message_ids)
+            if self.ack_window is not None:
+                self.unacked.extend(sorted(message_ids))
@@ -0,0 +1,255 @@
+"""
+Write-behind persistence for chat messages
+"""
+import asyncio
+import atexit
+import logging
+from collections import deque
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .db import db_write_to_async
+from .history import serialize_message
+from .models import ArchiveSegment, Message, Room
+from .recent import get_recent_messages
+
+logger = logging.getLogger(__name__)
+
+
+def reserve_message_ids(count):
+    """Take ``count`` ids from the database's own sequence for messages.
+
+    An id handed out here is never given to another insert, from this or
+    any other process, so queued messages cannot collide with rows written
+    directly. The sequence is first lifted past archived ids, which a table
+    rebuild may have let it forget. Returns the ids in ascending order, or
+    None on databases without a sequence this knows how to advance.
+    """
+    table = Message._meta.db_table
+    floor = last_archived_id()
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT tables never reuse an id below sqlite_sequence
+            cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, %s) + %s WHERE name = %s', [floor, count, table])
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, floor + count])
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            last_id = cursor.fetchone()[0]
+            return list(range(last_id - count + 1, last_id + 1))
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)', [sequence, count])
+            ids = sorted(row[0] for row in cursor.fetchall())
+            if ids[0] <= floor:
+                cursor.execute('SELECT setval(%s, %s)', [sequence, floor])
+                cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)', [sequence, count])
+                ids = sorted(row[0] for row in cursor.fetchall())
+            return ids
+    return None
+
+
+def last_archived_id():
+    """Highest id of any archived message, 0 when nothing is archived"""
+    return ArchiveSegment.objects.aggregate(last_id=Max('last_id'))['last_id'] or 0
+
+
+class MessageWriter:
+    """Queue chat messages and persist them in batches with bulk_create.
+
+    Each message gets its primary key and timestamp when it is queued, so the
+    caller can broadcast it straight away. Ids are reserved from the
+    database's sequence ``batch_size`` at a time; on databases without one
+    they are counted in-process, which assumes a single process writes
+    messages. Rows are written once ``batch_size`` messages are waiting or
+    ``flush_interval`` seconds have passed. A batch that fails is kept and
+    retried ahead of newer messages; after ``max_attempts`` failures its
+    messages are written one at a time, so only a message that cannot be
+    stored at all is dropped.
+    """
+
+    max_attempts = 5
+
+    def __init__(self, batch_size=100, flush_interval=0.05):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.ids = deque()
+        # room_id -> highest id handed out there, possibly not written yet
+        self.last_ids = {}
+        self._next_id = None
+        self._failed = []
+        self._attempts = 0
+        self._pending = None
+        self._full = None
+        self._reserving = None
+        self._flushing = None
+        self._task = None
+
+    async def save(self, room_id, sender, content, **fields):
+        """Queue a message and return the unsaved instance"""
+        await self._start()
+        if not self.ids and self._next_id is None:
+            async with self._reserving:
+                if not self.ids and self._next_id is None:
+                    await self._reserve_ids()
+        message_id = self._take_id()
+        self.last_ids[room_id] = max(self.last_ids.get(room_id, 0), message_id)
+        message = Message(
+            id=message_id,
+            room_id=room_id,
+            sender=sender,
+            content=content,
+            timestamp=timezone.now(),
+            **fields
+        )
+        self.queue.put_nowait(message)
+        self._pending.set()
+        if self.queue.qsize() >= self.batch_size:
+            self._full.set()
+        return message
+
+    async def flush(self):
+        """Write every queued message.
+
+        Raises the error of a batch that could not be written, which stays
+        queued for the next flush.
+        """
+        if self.queue is None:
+            return
+        # One flush at a time, so returning means earlier messages are in
+        async with self._flushing:
+            while self._failed or not self.queue.empty():
+                batch, self._failed = self._failed or self._take_batch(), []
+                one_by_one = self._attempts >= self.max_attempts
+                try:
+                    await self._write(batch, one_by_one)
+                except Exception:
+                    self._failed = batch
+                    self._attempts += 1
+                    raise
+                self._attempts = 0
+            self._pending.clear()
+            self._full.clear()
+
+    def flush_sync(self):
+        """Write queued messages from outside the event loop (at shutdown)"""
+        if self.queue is None:
+            return
+        while self._failed or not self.queue.empty():
+            batch, self._failed = self._failed or self._take_batch(), []
+            try:
+                self._write_batch(batch, one_by_one=True)
+            except Exception:
+                logger.exception('Failed to persist %d queued chat messages at shutdown', len(batch))
+
+    async def _start(self):
+        if self._task is not None:
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self._pending = asyncio.Event()
+            self._full = asyncio.Event()
+            self._reserving = asyncio.Lock()
+            self._flushing = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            if self.queue.qsize() < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.flush()
+            except Exception:
+                delay = min(self.flush_interval * 2 ** self._attempts, 5)
+                logger.exception(
+                    'Failed to persist %d queued chat messages, retrying in %.2fs', len(self._failed), delay,
+                )
+                await asyncio.sleep(delay)
+
+    def _take_id(self):
+        if self.ids:
+            return self.ids.popleft()
+        message_id = self._next_id
+        self._next_id += 1
+        return message_id
+
+    def _take_batch(self):
+        batch = []
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    @db_write_to_async
+    def _reserve_ids(self):
+        ids = reserve_message_ids(self.batch_size)
+        if ids is None:
+            last_id = Message.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+            # Archiving removes the newest rows of quiet rooms too
+            self._next_id = max(last_id, last_archived_id()) + 1
+        else:
+            self.ids.extend(ids)
+
+    @db_write_to_async
+    def _write(self, batch, one_by_one=False):
+        self._write_batch(batch, one_by_one)
+
+    def _write_batch(self, batch, one_by_one=False):
+        with transaction.atomic():
+            if one_by_one:
+                batch = self._insert_each(batch)
+            else:
+                Message.objects.bulk_create(batch)
+            # bulk_create sends no post_save, so update room counters here
+            by_room = {}
+            for message in batch:
+                by_room.setdefault(message.room_id, []).append(message)
+            for room_id, messages in by_room.items():
+                Room.record_messages(room_id, len(messages), max(messages, key=lambda m: m.id))
+        # Buffered only once a seeding read would find the rows
+        transaction.on_commit(lambda: self._buffer(batch), robust=True)
+
+    def _buffer(self, batch):
+        recent = get_recent_messages()
+        for message in batch:
+            recent.append(message.room_id, serialize_message(message))
+
+    def _insert_each(self, batch):
+        """Insert messages one at a time, dropping those that fail"""
+        written = []
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+            except Exception:
+                logger.exception('Dropping chat message %s, which cannot be stored', message.id)
+            else:
+                written.append(message)
+        return written
+
+
+_writer = None
+
+
+def get_message_writer():
+    """Return the process-wide message writer"""
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(
+            batch_size=getattr(settings, 'CHAT_MESSAGE_BATCH_SIZE', 100),
+            flush_interval=getattr(settings, 'CHAT_MESSAGE_FLUSH_INTERVAL', 0.05),
+        )
+        atexit.register(_writer.flush_sync)
+    return _writer
+
+
+def is_batched():
+    """Whether messages are persisted through the write-behind queue"""
+    return getattr(settings, 'CHAT_MESSAGE_WRITE_MODE', 'sync') == 'batched'
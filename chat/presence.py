@@ -0,0 +1,140 @@
+"""
+Online presence tracking for websocket connections
+"""
+import asyncio
+import atexit
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .db import db_write_to_async
+
+logger = logging.getLogger(__name__)
+
+
+def presence_key(user_id):
+    return f'chat:presence:{user_id}'
+
+
+class PresenceService:
+    """Reference-counted presence shared through the Django cache.
+
+    Each process counts its own sockets per user and keeps a cache key alive
+    for every user it has connected, refreshing it every ``heartbeat``
+    seconds with a ``ttl`` expiry. A user is online while any process holds
+    their key, so extra tabs do not flip the flag and a crashed worker's
+    users expire on their own. When a process's last socket for a user
+    closes, the key is left to expire within two heartbeats, since another
+    process may still hold them. ``UserProfile.last_seen`` and ``is_online``
+    are written in batches every ``flush_interval`` seconds.
+    """
+
+    def __init__(self, ttl=30, heartbeat=10, flush_interval=30):
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.flush_interval = flush_interval
+        self.connections = Counter()
+        self.came_online = set()
+        self.went_offline = set()
+        self._task = None
+
+    async def connect(self, user_id):
+        self.connections[user_id] += 1
+        if self.connections[user_id] == 1:
+            self.came_online.add(user_id)
+            self.went_offline.discard(user_id)
+            await cache.aset(presence_key(user_id), True, self.ttl)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def disconnect(self, user_id):
+        self.connections[user_id] -= 1
+        if self.connections[user_id] <= 0:
+            del self.connections[user_id]
+            self.came_online.discard(user_id)
+            self.went_offline.add(user_id)
+            # Another process may still hold the user, so the key is not
+            # deleted; it expires soon unless that process's heartbeat
+            # refreshes it
+            await cache.aset(presence_key(user_id), True, min(self.ttl, 2 * self.heartbeat))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_flush = loop.time() + self.flush_interval
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                if self.connections:
+                    await cache.aset_many(
+                        {presence_key(user_id): True for user_id in self.connections},
+                        self.ttl,
+                    )
+                if loop.time() >= next_flush:
+                    next_flush = loop.time() + self.flush_interval
+                    await self._flush()
+            except Exception:
+                # Keep the heartbeat going, or every user here expires
+                logger.exception('Presence heartbeat failed')
+
+    async def _flush(self):
+        came_online, went_offline = self._take_changes()
+        try:
+            await db_write_to_async(self.write)(came_online, went_offline)
+        except Exception:
+            # Retry with the next flush, unless superseded by then
+            self.came_online |= came_online - self.went_offline
+            self.went_offline |= went_offline - self.came_online
+            raise
+
+    def _take_changes(self):
+        came_online, self.came_online = self.came_online, set()
+        went_offline, self.went_offline = self.went_offline, set()
+        return came_online, went_offline
+
+    def write(self, came_online, went_offline):
+        """Write online/offline changes to UserProfile in bulk"""
+        from .models import UserProfile
+
+        now = timezone.now()
+        if came_online:
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_id) for user_id in came_online],
+                ignore_conflicts=True,
+            )
+            UserProfile.objects.filter(user_id__in=came_online).update(is_online=True, last_seen=now)
+        if went_offline:
+            UserProfile.objects.filter(user_id__in=went_offline).update(is_online=False, last_seen=now)
+
+    def flush_sync(self):
+        """Mark this process's users offline at shutdown"""
+        self.went_offline.update(self.connections)
+        self.connections.clear()
+        _, went_offline = self._take_changes()
+        self.write(set(), went_offline)
+
+
+def online_user_ids(user_ids):
+    """Subset of ``user_ids`` that are currently online"""
+    keys = {presence_key(user_id): user_id for user_id in user_ids}
+    if not keys:
+        return set()
+    return {keys[key] for key in cache.get_many(keys)}
+
+
+_presence = None
+
+
+def get_presence():
+    """Return the process-wide presence service"""
+    global _presence
+    if _presence is None:
+        _presence = PresenceService(
+            ttl=getattr(settings, 'CHAT_PRESENCE_TTL', 30),
+            heartbeat=getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 10),
+            flush_interval=getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 30),
+        )
+        atexit.register(_presence.flush_sync)
+    return _presence
@@ -0,0 +1,264 @@
+"""
+Ring buffers of the newest serialized messages of active rooms
+"""
+import bisect
+import threading
+from collections import OrderedDict, deque, namedtuple
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+
+from .layers import is_process_local
+
+# ``messages`` oldest first; ``complete`` when they reach back to the
+# room's first message
+Snapshot = namedtuple('Snapshot', ['messages', 'complete'])
+
+
+def message_size(message):
+    """Rough in-memory footprint of a serialized message, in bytes"""
+    return len(message['message']) + len(message['username']) + 200
+
+
+def contains(messages, message):
+    """Whether ``message`` is already among ``messages``, ordered by id"""
+    for buffered in reversed(messages):
+        if buffered['message_id'] <= message['message_id']:
+            return buffered['message_id'] == message['message_id']
+    return False
+
+
+def place(messages, message, complete):
+    """Put ``message`` into ``messages`` in id order.
+
+    Returns False, leaving ``messages`` alone, if it is already there or is
+    older than everything held by a buffer that is not ``complete``.
+    """
+    message_id = message['message_id']
+    if not messages or messages[-1]['message_id'] < message_id:
+        messages.append(message)
+        return True
+    if contains(messages, message):
+        return False
+    if not complete and message_id < messages[0]['message_id']:
+        return False
+    messages.insert(bisect.bisect(messages, message_id, key=itemgetter('message_id')), message)
+    return True
+
+
+class RecentMessages:
+    """Process-local buffers of the last ``size`` messages per room.
+
+    Buffers are seeded from database reads and extended as messages are
+    saved. Every append bumps a per-room version; a seed only lands if no
+    append happened since its read started, and an append only extends a
+    buffer that saw the previous one. Messages saved concurrently can be
+    appended out of id order and are put in their place, so a buffer only
+    lacks a message while that message's save is finishing. Idle rooms
+    are evicted least recently used first once ``memory_budget`` bytes are
+    held. Only messages saved by this process are seen, so these buffers
+    are only used while the channel layer keeps every consumer in this
+    process.
+    """
+
+    def __init__(self, size=100, memory_budget=32 * 1024 * 1024):
+        self.size = size
+        self.memory_budget = memory_budget
+        # room_id -> [version, deque of messages, complete, bytes]
+        self.rooms = OrderedDict()
+        self.versions = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def version(self, room_id):
+        """Call before reading the messages that will seed the buffer"""
+        with self._lock:
+            return self.versions.get(room_id, 0)
+
+    def get(self, room_id):
+        with self._lock:
+            entry = self.rooms.get(room_id)
+            if entry is None:
+                return None
+            self.rooms.move_to_end(room_id)
+            return Snapshot(list(entry[1]), entry[2])
+
+    def seed(self, room_id, version, messages, complete):
+        with self._lock:
+            if self.versions.get(room_id, 0) != version or room_id in self.rooms:
+                return
+            complete = complete and len(messages) <= self.size
+            messages = messages[-self.size:]
+            size = sum(message_size(message) for message in messages)
+            self.rooms[room_id] = [version, deque(messages), complete, size]
+            self.bytes += size
+            self._evict()
+
+    def append(self, room_id, message):
+        with self._lock:
+            version = self.versions[room_id] = self.versions.get(room_id, 0) + 1
+            entry = self.rooms.get(room_id)
+            if entry is None:
+                return
+            if entry[0] != version - 1:
+                self._drop(room_id)
+                return
+            entry[0] = version
+            messages = entry[1]
+            if not place(messages, message, entry[2]):
+                return
+            size = message_size(message)
+            entry[3] += size
+            self.bytes += size
+            if len(messages) > self.size:
+                size = message_size(messages.popleft())
+                entry[2] = False
+                entry[3] -= size
+                self.bytes -= size
+            self.rooms.move_to_end(room_id)
+            self._evict()
+
+    async def aappend(self, room_id, message):
+        self.append(room_id, message)
+
+    def invalidate(self, room_id):
+        """Forget a room's buffer after its messages were edited or deleted"""
+        with self._lock:
+            self.versions[room_id] = self.versions.get(room_id, 0) + 1
+            if room_id in self.rooms:
+                self._drop(room_id)
+
+    def _drop(self, room_id):
+        self.bytes -= self.rooms.pop(room_id)[3]
+
+    def _evict(self):
+        while self.bytes > self.memory_budget and len(self.rooms) > 1:
+            self._drop(next(iter(self.rooms)))
+
+
+class SharedRecentMessages:
+    """The same buffers kept in the Django cache, shared by every worker.
+
+    Versions live in their own cache key and are bumped atomically with
+    ``incr``; a buffer whose version does not match is ignored, so racing
+    writers can only cause a reload from the database, never a gap. Idle
+    rooms expire after ``timeout`` seconds or through the cache's own
+    eviction.
+    """
+
+    def __init__(self, size=100, timeout=3600):
+        self.size = size
+        self.timeout = timeout
+
+    def key(self, room_id):
+        return f'chat:recent:{room_id}'
+
+    def version_key(self, room_id):
+        return f'chat:recent:{room_id}:version'
+
+    def version(self, room_id):
+        return cache.get(self.version_key(room_id), 0)
+
+    def get(self, room_id):
+        key, version_key = self.key(room_id), self.version_key(room_id)
+        found = cache.get_many([key, version_key])
+        entry = found.get(key)
+        if entry is None or entry['version'] != found.get(version_key, 0):
+            return None
+        return Snapshot(entry['messages'], entry['complete'])
+
+    def seed(self, room_id, version, messages, complete):
+        if self.version(room_id) != version:
+            return
+        cache.set(self.key(room_id), {
+            'version': version,
+            'messages': messages[-self.size:],
+            'complete': complete and len(messages) <= self.size,
+        }, self.timeout)
+
+    def append(self, room_id, message):
+        version = self._bump(room_id)
+        key = self.key(room_id)
+        entry = cache.get(key)
+        if entry is None:
+            return
+        if entry['version'] != version - 1:
+            cache.delete(key)
+            return
+        messages = entry['messages']
+        place(messages, message, entry['complete'])
+        if len(messages) > self.size:
+            del messages[:-self.size]
+            entry['complete'] = False
+        entry['version'] = version
+        cache.set(key, entry, self.timeout)
+
+    async def aappend(self, room_id, message):
+        await sync_to_async(self.append)(room_id, message)
+
+    def invalidate(self, room_id):
+        self._bump(room_id)
+        cache.delete(self.key(room_id))
+
+    def _bump(self, room_id):
+        version_key = self.version_key(room_id)
+        cache.add(version_key, 0, None)
+        try:
+            return cache.incr(version_key)
+        except ValueError:
+            # Evicted between add and incr
+            cache.set(version_key, 1, None)
+            return 1
+
+
+_recent = None
+
+
+def get_recent_messages():
+    """Return the configured recent-messages buffer"""
+    global _recent
+    if _recent is None:
+        size = getattr(settings, 'CHAT_RECENT_MESSAGES', 100)
+        if recent_backend() == 'cache':
+            _recent = SharedRecentMessages(
+                size=size,
+                timeout=getattr(settings, 'CHAT_RECENT_CACHE_TIMEOUT', 3600),
+            )
+        else:
+            _recent = RecentMessages(
+                size=size,
+                memory_budget=getattr(settings, 'CHAT_RECENT_MEMORY_BUDGET', 32 * 1024 * 1024),
+            )
+    return _recent
+
+
+def recent_backend():
+    """'local' or 'cache', the recent-messages backend in use"""
+    if not is_process_local():
+        # Local buffers would miss messages saved by other workers and
+        # still claim to hold a room's newest messages
+        return 'cache'
+    return getattr(settings, 'CHAT_RECENT_BACKEND', None) or 'local'
+
+
+def check_recent_backend(app_configs, **kwargs):
+    """Warn when the buffers cannot see every worker's messages"""
+    if is_process_local():
+        return []
+    if getattr(settings, 'CHAT_RECENT_BACKEND', None) == 'local':
+        return [checks.Warning(
+            'CHAT_RECENT_BACKEND "local" is ignored because the channel layer spans processes.',
+            hint='Leave CHAT_RECENT_BACKEND unset or set it to "cache".',
+            id='chat.W002',
+        )]
+    if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache':
+        return [checks.Warning(
+            'Recent messages are kept in a per-process cache while the channel layer spans processes; '
+            'workers miss each other\'s messages.',
+            hint='Configure a cache shared by the workers, such as Redis.',
+            id='chat.W003',
+        )]
+    return []
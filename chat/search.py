@@ -0,0 +1,185 @@
+"""
+Full-text message search
+"""
+import re
+
+from django.conf import settings
+from django.core import checks
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .history import serialize_message
+from .models import Message, Room
+
+TERM_RE = re.compile(r'\w+')
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_ai AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_ad AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts (chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_au AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts (chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+
+def search_terms(query):
+    """Words of a user query; operators and punctuation are ignored"""
+    return TERM_RE.findall(query.lower())
+
+
+class SearchBackend:
+    """Base class for message search backends.
+
+    ``filter`` narrows a Message queryset to rows matching every term of
+    the query, so callers can add their own room and paging filters.
+    """
+
+    def filter(self, queryset, terms):
+        raise NotImplementedError
+
+    def rebuild(self):
+        """Rebuild the whole index from the messages table"""
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 external-content table over chat_message.
+
+    Triggers installed by migration 0006 keep the index current for every
+    insert, update and delete, including bulk_create and the batched
+    message writer. SQLite drops them when a migration rebuilds
+    chat_message; ``manage.py check --database default`` (and migrate)
+    warns when they are gone, and ``manage.py rebuild_search_index``
+    restores them.
+    """
+
+    def filter(self, queryset, terms):
+        # Quoted prefix terms cannot be parsed as FTS5 operators
+        match = ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s', [match]
+        ))
+
+    def rebuild(self):
+        install_sqlite_search(connection)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO chat_message_fts (chat_message_fts) VALUES ('rebuild')")
+
+
+class PostgresSearchBackend(SearchBackend):
+    """GIN index over to_tsvector('simple', content), created by migration 0006"""
+
+    def filter(self, queryset, terms):
+        query = ' & '.join(term + ':*' for term in terms)
+        return queryset.filter(pk__in=RawSQL(
+            "SELECT id FROM chat_message WHERE to_tsvector('simple', content) @@ to_tsquery('simple', %s)",
+            [query],
+        ))
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute('REINDEX INDEX chat_message_fts_idx')
+
+
+class ContainsSearchBackend(SearchBackend):
+    """Fallback for other databases: a LIKE scan, no index"""
+
+    def filter(self, queryset, terms):
+        condition = Q()
+        for term in terms:
+            condition &= Q(content__icontains=term)
+        return queryset.filter(condition)
+
+
+def install_sqlite_search(connection):
+    """Create the FTS5 table and its triggers if they are missing.
+
+    SQLite drops triggers when Django rebuilds chat_message during a
+    migration; migrations that do so should call this again.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+            "content, content='chat_message', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        for trigger in SQLITE_TRIGGERS:
+            cursor.execute(trigger)
+
+
+def check_search_index(app_configs, databases=None, **kwargs):
+    """Warn when the SQLite index or one of its triggers is missing"""
+    if 'default' not in (databases or ()) or not isinstance(get_search_backend(), SQLiteSearchBackend):
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        names = {row[0] for row in cursor.fetchall()}
+    if 'chat_message' not in names:
+        # Not migrated yet
+        return []
+    missing = sorted(
+        {'chat_message_fts', 'chat_message_fts_ai', 'chat_message_fts_ad', 'chat_message_fts_au'} - names
+    )
+    if not missing:
+        return []
+    return [checks.Warning(
+        f'Message search index is incomplete, missing {", ".join(missing)}; new messages are not searchable.',
+        hint='Run "manage.py rebuild_search_index" to recreate and refill it.',
+        id='chat.W001',
+    )]
+
+
+_backend = None
+
+
+def get_search_backend():
+    """Return the configured backend, picked by database vendor by default"""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+        if path:
+            _backend = import_string(path)()
+        elif connection.vendor == 'sqlite':
+            _backend = SQLiteSearchBackend()
+        elif connection.vendor == 'postgresql':
+            _backend = PostgresSearchBackend()
+        else:
+            _backend = ContainsSearchBackend()
+    return _backend
+
+
+def search_messages(user, query, room_id=None, before=None, limit=None):
+    """Messages matching ``query`` in rooms ``user`` belongs to, newest first.
+
+    Returns serialized messages, each with its room slug, and the ``before``
+    value for the next page (None on the last one).
+    """
+    limit = limit or getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+    terms = search_terms(query)
+    if not terms:
+        return [], None
+    member_rooms = Room.participants.through.objects.filter(user_id=user.id).values('room_id')
+    messages = Message.objects.filter(room_id__in=member_rooms)
+    if room_id is not None:
+        messages = messages.filter(room_id=room_id)
+    if before:
+        messages = messages.filter(id__lt=before)
+    messages = get_search_backend().filter(messages, terms)
+    page = list(messages.select_related('sender', 'room').order_by('-id')[:limit + 1])
+    next_before = page[limit - 1].id if len(page) > limit else None
+    return [
+        {**serialize_message(message), 'room': message.room.slug}
+        for message in page[:limit]
+    ], next_before
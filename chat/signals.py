@@ -0,0 +1,96 @@
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .archive import delete_segment_file
+from .avatars import render_data
+from .cache import invalidate_public_rooms, room_ids, user_ids
+from .db import apply_sqlite_pragmas
+from .history import serialize_message
+from .models import ArchiveSegment, Message, Room, UserProfile
+from .recent import get_recent_messages
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    """Apply the production PRAGMAs to every new SQLite connection"""
+    if connection.vendor == 'sqlite' and getattr(settings, 'CHAT_SQLITE_PRODUCTION', False):
+        apply_sqlite_pragmas(connection)
+
+
+@receiver([post_save, post_delete], sender=Room)
+def invalidate_room_id(sender, instance, **kwargs):
+    """Forget cached slug lookups when a room is renamed or removed"""
+    room_ids.discard(instance.slug)
+    room_ids.discard_value(instance.pk)
+    invalidate_public_rooms()
+
+
+@receiver(post_save, sender=Message)
+def count_new_message(sender, instance, created, **kwargs):
+    """Keep the room's message counters current for single inserts"""
+    if created:
+        Room.record_messages(instance.room_id, 1, instance)
+
+
+# Rooms that lost messages in this thread's open transaction
+_stale_rooms = threading.local()
+
+
+@receiver(post_delete, sender=Message)
+def uncount_deleted_message(sender, instance, **kwargs):
+    """Recompute the room's counters once a message deletion commits.
+
+    Deleting many messages at once refreshes each room only once, and
+    archived messages keep being counted through their segment.
+    """
+    if not hasattr(_stale_rooms, 'ids'):
+        _stale_rooms.ids = set()
+    _stale_rooms.ids.add(instance.room_id)
+    transaction.on_commit(refresh_stale_rooms, robust=True)
+
+
+def refresh_stale_rooms():
+    # Rooms left over from a rolled-back transaction are refreshed too,
+    # which is harmless
+    stale, _stale_rooms.ids = _stale_rooms.ids, set()
+    if stale:
+        Room.refresh_message_stats(stale)
+
+
+@receiver([post_save, post_delete], sender=Message)
+def update_recent_messages(sender, instance, created=False, **kwargs):
+    """Add new messages to the room's buffer, drop it when one changes.
+
+    Deferred to the commit, so a rolled-back save leaves the buffer alone.
+    """
+    if created:
+        message = serialize_message(instance)
+        transaction.on_commit(lambda: get_recent_messages().append(instance.room_id, message), robust=True)
+    else:
+        transaction.on_commit(lambda: get_recent_messages().invalidate(instance.room_id), robust=True)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_id(sender, instance, **kwargs):
+    """Forget cached username lookups when a user is renamed or removed"""
+    user_ids.discard(instance.username)
+    user_ids.discard_value(instance.pk)
+    render_data.discard(instance.username)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_render_data(sender, instance, **kwargs):
+    """Forget a user's cached avatar when their profile changes"""
+    render_data.discard(instance.user.username)
+
+
+@receiver(post_delete, sender=ArchiveSegment)
+def delete_archive_file(sender, instance, **kwargs):
+    """Remove a segment's file with its row, e.g. when its room is deleted"""
+    transaction.on_commit(lambda: delete_segment_file(instance), robust=True)
@@ -364,5 +364,132 @@ class AudioCallManager {
     }
 }
 
+// Websocket wire protocol: JSON text frames by default, MessagePack binary
+// frames when the 'chat.msgpack' subprotocol was negotiated
+
+function unpackMsgpack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const decoder = new TextDecoder();
+    let offset = 0;
+
+    function take(size, getter) {
+        getter = getter || { 1: 'getUint8', 2: 'getUint16', 4: 'getUint32', 8: 'getBigUint64' }[size];
+        const value = view[getter](offset);
+        offset += size;
+        return typeof value === 'bigint' ? Number(value) : value;
+    }
+
+    function str(length) {
+        const value = decoder.decode(bytes.subarray(offset, offset + length));
+        offset += length;
+        return value;
+    }
+
+    function bin(length) {
+        const value = bytes.slice(offset, offset + length);
+        offset += length;
+        return value;
+    }
+
+    function array(length) {
+        const value = [];
+        for (let i = 0; i < length; i++) {
+            value.push(read());
+        }
+        return value;
+    }
+
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+
+    function read() {
+        const type = take(1);
+        if (type < 0x80) return type;
+        if (type < 0x90) return map(type & 0x0f);
+        if (type < 0xa0) return array(type & 0x0f);
+        if (type < 0xc0) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(take(1));
+            case 0xc5: return bin(take(2));
+            case 0xc6: return bin(take(4));
+            case 0xca: return take(4, 'getFloat32');
+            case 0xcb: return take(8, 'getFloat64');
+            case 0xcc: return take(1);
+            case 0xcd: return take(2);
+            case 0xce: return take(4);
+            case 0xcf: return take(8);
+            case 0xd0: return take(1, 'getInt8');
+            case 0xd1: return take(2, 'getInt16');
+            case 0xd2: return take(4, 'getInt32');
+            case 0xd3: return take(8, 'getBigInt64');
+            case 0xd9: return str(take(1));
+            case 0xda: return str(take(2));
+            case 0xdb: return str(take(4));
+            case 0xdc: return array(take(2));
+            case 0xdd: return array(take(4));
+            case 0xde: return map(take(2));
+            case 0xdf: return map(take(4));
+        }
+        throw new Error('Unsupported MessagePack type 0x' + type.toString(16));
+    }
+
+    return read();
+}
+
+const ChatWire = {
+    JSON_PROTOCOL: 'chat.json',
+    BINARY_PROTOCOL: 'chat.msgpack',
+
+    // Positional layout of binary frames, mirrors SCHEMAS in chat/wire.py
+    SCHEMAS: {
+        message: ['message_id', 'timestamp', 'username', 'message'],
+        typing: ['users'],
+        user_join: ['username'],
+        user_leave: ['username']
+    },
+
+    // Subprotocols to offer when opening the socket
+    protocols(binary) {
+        return binary ? [this.BINARY_PROTOCOL, this.JSON_PROTOCOL] : [];
+    },
+
+    // Decode one websocket frame into a list of events
+    decode(data) {
+        if (typeof data === 'string') {
+            const parsed = JSON.parse(data);
+            return Array.isArray(parsed) ? parsed : [parsed];
+        }
+        const frame = unpackMsgpack(new Uint8Array(data));
+        // A batch is an array of frames
+        if (Array.isArray(frame[0])) {
+            return frame.map(item => this.fromFrame(item));
+        }
+        return [this.fromFrame(frame)];
+    },
+
+    fromFrame(frame) {
+        const event = { type: frame[0] };
+        const fields = this.SCHEMAS[frame[0]] || [];
+        fields.forEach((field, i) => {
+            event[field] = frame[i + 1];
+        });
+        if (frame.length > fields.length + 1) {
+            Object.assign(event, frame[fields.length + 1]);
+        }
+        return event;
+    }
+};
+
 // Export for use in room template
 window.AudioCallManager = AudioCallManager;
+window.ChatWire = ChatWire;
@@ -1,3 +1,1135 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .archive import archive_batch
+from .benchmark import BenchmarkRun, percentile
+from .cache import PUBLIC_ROOMS_KEY, get_public_room_ids
+from .db import SQLiteWriter
+from .history import decode_cursor, encode_cursor, get_history_page, make_cursor
+from .layers import ShardedChannelLayer, is_process_local
+from .models import ArchiveSegment, Message, Notification, ReadState, Room, Upload, UserProfile
+from .notifications import NotificationPipeline, find_mentions
+from .outbound import OutboundQueue
+from .persistence import MessageWriter, reserve_message_ids
+from .presence import PresenceService, online_user_ids
+from .recent import RecentMessages, SharedRecentMessages, check_recent_backend, get_recent_messages
+from .routing import websocket_urlpatterns
+from .search import check_search_index, search_messages
+from .typing_indicators import SOURCE, TypingAggregator
+from .uploads import advance_upload, part_path, write_chunk, write_part
+from .views import upload_view
+from . import metrics, wire
+
+
+# The recent-messages buffer is process-wide and keyed by room id, which
+# tests reuse; each test gets an empty one
+fresh_recent_messages = mock.patch('chat.recent._recent', None)
+
+
+def communicator(user, path):
+    """Websocket client for ``path`` logged in as ``user``"""
+    client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+    client.scope['user'] = user
+    return client
+
+
+async def receive_type(client, message_type):
+    """Next frame of ``message_type``, skipping joins and other events"""
+    while True:
+        data = await client.receive_json_from()
+        if data['type'] == message_type:
+            return data
+
+
+async def received_types(client):
+    """Types of every frame waiting for ``client``"""
+    types = []
+    while not await client.receive_nothing():
+        types.append((await client.receive_json_from())['type'])
+    return types
+
+
+@fresh_recent_messages
+class MessageWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+        # Only explicit flushes write
+        self.writer = MessageWriter(batch_size=10, flush_interval=60)
+
+    async def asyncTearDown(self):
+        if self.writer._task is not None:
+            self.writer._task.cancel()
+
+    async def test_flush_writes_queued_messages(self):
+        first = await self.writer.save(self.room.id, self.user, 'one')
+        second = await self.writer.save(self.room.id, self.user, 'two')
+        self.assertLess(first.id, second.id)
+        self.assertFalse(await Message.objects.filter(room=self.room).aexists())
+        await self.writer.flush()
+        contents = [message.content async for message in Message.objects.filter(room=self.room).order_by('id')]
+        self.assertEqual(contents, ['one', 'two'])
+        room = await Room.objects.aget(pk=self.room.pk)
+        self.assertEqual((room.message_count, room.last_message_id), (2, second.id))
+
+    async def test_queued_ids_never_collide_with_direct_inserts(self):
+        queued = await self.writer.save(self.room.id, self.user, 'queued')
+        direct = await Message.objects.acreate(room=self.room, sender=self.user, content='direct')
+        self.assertNotEqual(direct.id, queued.id)
+        await self.writer.flush()
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 2)
+
+    async def test_failed_batch_is_kept_and_retried(self):
+        message = await self.writer.save(self.room.id, self.user, 'hi')
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError):
+                await self.writer.flush()
+        self.assertFalse(await Message.objects.filter(pk=message.id).aexists())
+        await self.writer.flush()
+        self.assertTrue(await Message.objects.filter(pk=message.id).aexists())
+
+    async def test_only_unstorable_messages_are_dropped(self):
+        bulk_create = Message.objects.bulk_create
+
+        def reject_bad(messages, *args, **kwargs):
+            if any(message.content == 'bad' for message in messages):
+                raise OperationalError('cannot store')
+            return bulk_create(messages, *args, **kwargs)
+
+        await self.writer.save(self.room.id, self.user, 'good')
+        await self.writer.save(self.room.id, self.user, 'bad')
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=reject_bad):
+            for _ in range(self.writer.max_attempts):
+                with self.assertRaises(OperationalError):
+                    await self.writer.flush()
+            # Written one message at a time from now on
+            with self.assertLogs('chat.persistence', 'ERROR'):
+                await self.writer.flush()
+        contents = [message.content async for message in Message.objects.filter(room=self.room)]
+        self.assertEqual(contents, ['good'])
+
+    @override_settings(CHAT_MESSAGE_WRITE_MODE='batched')
+    async def test_replay_survives_a_failing_flush(self):
+        message = await Message.objects.acreate(room=self.room, sender=self.user, content='missed')
+        writer = mock.Mock(flush=mock.AsyncMock(side_effect=OperationalError('database is locked')))
+        client = communicator(self.user, f'/ws/chat/general/?last_message_id={message.id - 1}')
+        with mock.patch('chat.consumers.get_message_writer', return_value=writer):
+            with self.assertLogs('chat.consumers', 'ERROR'):
+                connected, _ = await client.connect()
+            replay = await client.receive_json_from()
+        self.assertTrue(connected)
+        self.assertEqual([m['message'] for m in replay['messages']], ['missed'])
+        await client.disconnect()
+
+    @override_settings(CHAT_MESSAGE_WRITE_MODE='batched')
+    async def test_replay_reloads_when_other_processes_write(self):
+        message = await Message.objects.acreate(room=self.room, sender=self.user, content='missed')
+        client = communicator(self.user, f'/ws/chat/general/?last_message_id={message.id - 1}')
+        with mock.patch('chat.consumers.is_process_local', return_value=False):
+            connected, _ = await client.connect()
+            replay = await client.receive_json_from()
+        self.assertEqual(replay, {'type': 'replay', 'messages': [], 'truncated': True})
+        await client.disconnect()
+
+    async def test_only_replayed_ids_are_skipped_live(self):
+        seen = await Message.objects.acreate(room=self.room, sender=self.user, content='seen')
+        replayed = await Message.objects.acreate(room=self.room, sender=self.user, content='replayed')
+        client = communicator(self.user, f'/ws/chat/general/?last_message_id={seen.id}')
+        await client.connect()
+        replay = await receive_type(client, 'replay')
+        self.assertEqual([m['message_id'] for m in replay['messages']], [replayed.id])
+        # The join is announced after presence is recorded
+        await receive_type(client, 'user_join')
+        # A message committed after the replay's read
+        layer = get_channel_layer()
+        for message_id in (replayed.id, replayed.id + 1):
+            await layer.group_send('chat_general', wire.event(
+                'chat_message', {'type': 'message', 'message_id': message_id}, message_id=message_id,
+            ))
+        message = await receive_type(client, 'message')
+        self.assertEqual(message['message_id'], replayed.id + 1)
+        self.assertTrue(await client.receive_nothing())
+        await client.disconnect()
+
+
+class CallSignalingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        Room.objects.create(name='General', slug='general')
+        Room.objects.create(name='Random', slug='random')
+
+    async def test_offer_reaches_only_the_target_in_the_same_room(self):
+        caller = communicator(self.alice, '/ws/chat/general/')
+        callee = communicator(self.bob, '/ws/chat/general/')
+        elsewhere = communicator(self.bob, '/ws/chat/random/')
+        for client in (caller, callee, elsewhere):
+            await client.connect()
+        await caller.send_json_to({'type': 'call_offer', 'target_username': 'bob', 'offer': {'sdp': 'x'}})
+        offer = await receive_type(callee, 'call_offer')
+        self.assertEqual((offer['caller'], offer['offer']), ('alice', {'sdp': 'x'}))
+        self.assertNotIn('call_offer', await received_types(elsewhere))
+        await callee.send_json_to({'type': 'call_answer', 'target_username': 'alice', 'answer': {'sdp': 'y'}})
+        answer = await receive_type(caller, 'call_answer')
+        self.assertEqual(answer['answerer'], 'bob')
+        for client in (caller, callee, elsewhere):
+            await client.disconnect()
+
+    async def test_unknown_target_is_ignored(self):
+        caller = communicator(self.alice, '/ws/chat/general/')
+        await caller.connect()
+        await caller.send_json_to({'type': 'call_offer', 'target_username': 'nobody', 'offer': {}})
+        self.assertEqual(await received_types(caller), ['user_join'])
+        await caller.disconnect()
+
+
+class RecordingLayer:
+    """Channel layer stand-in that keeps every group message"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class TypingAggregatorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = RecordingLayer()
+        self.aggregator = TypingAggregator(self.layer, 'chat_general', max_rate=100, ttl=0.2)
+
+    def snapshots(self):
+        return [json.loads(message['text']) for _, message in self.layer.sent]
+
+    async def test_updates_merge_into_one_snapshot(self):
+        self.aggregator.update('bob', True)
+        self.aggregator.update('alice', True)
+        self.aggregator.update('alice', True)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.snapshots(), [{'type': 'typing', 'source': SOURCE, 'users': ['alice', 'bob'], 'ttl': 0.2}])
+        self.assertEqual(self.layer.sent[0][0], 'chat_general')
+
+    async def test_stopping_sends_the_shorter_list(self):
+        self.aggregator.update('alice', True)
+        self.aggregator.update('bob', True)
+        await asyncio.sleep(0.03)
+        self.aggregator.update('alice', False)
+        await asyncio.sleep(0.03)
+        self.assertEqual([s['users'] for s in self.snapshots()], [['alice', 'bob'], ['bob']])
+
+    async def test_snapshots_repeat_and_typists_expire(self):
+        self.aggregator.update('alice', True)
+        await asyncio.sleep(0.35)
+        users = [s['users'] for s in self.snapshots()]
+        # Repeated every ttl / 2 while someone types, then emptied on expiry
+        self.assertGreaterEqual(users.count(['alice']), 2)
+        self.assertEqual(users[-1], [])
+        self.assertIsNone(self.aggregator._task)
+
+
+@fresh_recent_messages
+class CursorTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+
+    def test_round_trip(self):
+        message = Message.objects.create(room=self.room, sender=self.user, content='hi')
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.timestamp, message.id))
+
+    def test_rejects_invalid_cursors(self):
+        invalid = [
+            None, 123, ['a'], {'a': 1}, '', 'not base64!',
+            make_cursor('yesterday', 1), make_cursor('2024-01-01T00:00:00+00:00', 'x'),
+        ]
+        for cursor in invalid:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_pages_walk_back_without_gaps(self):
+        ids = [Message.objects.create(room=self.room, sender=self.user, content=str(i)).id for i in range(7)]
+        seen, cursor = [], None
+        while True:
+            page, cursor = get_history_page(self.room.id, before=cursor, limit=3)
+            seen = [message['message_id'] for message in page] + seen
+            if cursor is None:
+                break
+        self.assertEqual(seen, ids)
+
+
+@fresh_recent_messages
+class RoomAccessTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        room = Room.objects.create(name='Secret', slug='secret', room_type='private')
+        room.participants.add(self.alice)
+        Message.objects.create(room=room, sender=self.alice, content='hi')
+
+    async def test_private_room_rejects_outsiders(self):
+        # History requests and the replay would otherwise leak the room
+        client = communicator(self.bob, '/ws/chat/secret/?last_message_id=1')
+        connected, _ = await client.connect()
+        self.assertFalse(connected)
+        await client.disconnect()
+
+    async def test_participants_get_history(self):
+        client = communicator(self.alice, '/ws/chat/secret/')
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        await client.send_json_to({'type': 'history'})
+        history = await receive_type(client, 'history')
+        self.assertEqual([m['message'] for m in history['messages']], ['hi'])
+        self.assertIsNone(history['next_cursor'])
+        await client.disconnect()
+
+    async def test_invalid_cursor_is_answered(self):
+        client = communicator(self.alice, '/ws/chat/secret/')
+        await client.connect()
+        await client.send_json_to({'type': 'history', 'before': ['not', 'a', 'cursor']})
+        history = await receive_type(client, 'history')
+        self.assertEqual(history['error'], 'Invalid history cursor')
+        await client.disconnect()
+
+
+# Receipts wait for the disconnect, which flushes them
+@override_settings(CHAT_READ_RECEIPT_WINDOW=60)
+class ReadReceiptTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+        self.message = Message.objects.create(room=self.room, sender=self.alice, content='hi')
+
+    async def read_mark(self):
+        state = await ReadState.objects.aget(user=self.alice, room=self.room)
+        return state.last_read_message_id
+
+    async def test_receipt_is_clamped_to_last_message(self):
+        client = communicator(self.alice, '/ws/chat/general/')
+        await client.connect()
+        await client.send_json_to({'type': 'read_receipt', 'message_id': 2 ** 62})
+        await client.disconnect()
+        self.assertEqual(await self.read_mark(), self.message.id)
+
+    async def test_receipts_coalesce_to_the_highest(self):
+        newer = await Message.objects.acreate(room=self.room, sender=self.alice, content='again')
+        client = communicator(self.alice, '/ws/chat/general/')
+        await client.connect()
+        for message_id in (newer.id, self.message.id):
+            await client.send_json_to({'type': 'read_receipt', 'message_id': message_id})
+        await client.disconnect()
+        self.assertEqual(await self.read_mark(), newer.id)
+
+    @override_settings(CHAT_MESSAGE_WRITE_MODE='batched')
+    async def test_receipt_for_a_queued_message_is_kept(self):
+        writer = MessageWriter(batch_size=10, flush_interval=60)
+        client = communicator(self.alice, '/ws/chat/general/')
+        with mock.patch('chat.consumers.get_message_writer', return_value=writer):
+            await client.connect()
+            await client.send_json_to({'type': 'message', 'message': 'queued'})
+            message = await receive_type(client, 'message')
+            await client.send_json_to({'type': 'read_receipt', 'message_id': message['message_id']})
+            await client.disconnect()
+        writer._task.cancel()
+        self.assertGreater(message['message_id'], self.message.id)
+        self.assertEqual(await self.read_mark(), message['message_id'])
+
+
+class PresenceTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='alice')
+        UserProfile.objects.create(user=self.user)
+        self.presence = PresenceService(ttl=30, heartbeat=60, flush_interval=60)
+
+    async def asyncTearDown(self):
+        self.presence._task.cancel()
+
+    async def is_online(self):
+        return (await UserProfile.objects.aget(user=self.user)).is_online
+
+    async def test_user_stays_online_until_the_last_socket_closes(self):
+        await self.presence.connect(self.user.id)
+        await self.presence.connect(self.user.id)
+        await self.presence.disconnect(self.user.id)
+        await self.presence._flush()
+        self.assertTrue(await self.is_online())
+        await self.presence.disconnect(self.user.id)
+        await self.presence._flush()
+        self.assertFalse(await self.is_online())
+
+    async def test_key_outlives_the_last_socket_briefly(self):
+        # Another worker may still hold the user, so the key is not deleted
+        await self.presence.connect(self.user.id)
+        await self.presence.disconnect(self.user.id)
+        self.assertEqual(await sync_to_async(online_user_ids)([self.user.id]), {self.user.id})
+
+
+class HomeViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.client.force_login(self.user)
+        for index, online in enumerate([True, False, True]):
+            user = User.objects.create(username=f'user{index}')
+            UserProfile.objects.create(user=user, is_online=online)
+        self.participants = User.objects.exclude(pk=self.user.pk)
+
+    def add_room(self, name):
+        room = Room.objects.create(name=name, slug=name)
+        room.participants.set(self.participants)
+        return room
+
+    def test_online_counts_take_one_query_for_all_rooms(self):
+        self.add_room('one')
+        # Fills the public room cache and creates the profile
+        self.client.get(reverse('home'))
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(reverse('home'))
+        self.assertEqual([room.online_count for room in response.context['rooms']], [2])
+        for name in ('two', 'three', 'four'):
+            self.add_room(name)
+        self.client.get(reverse('home'))
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse('home'))
+        self.assertEqual([room.online_count for room in response.context['rooms']], [2, 2, 2, 2])
+        self.assertEqual(len(many), len(few))
+
+
+
+@fresh_recent_messages
+class BenchmarkTests(TransactionTestCase):
+
+    def test_percentile(self):
+        samples = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        self.assertEqual(percentile(samples, 0.5), 5)
+        self.assertEqual(percentile(samples, 0.99), 10)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_run_reports_every_delivery(self):
+        from chatproject.asgi import application
+
+        run = BenchmarkRun(
+            clients=4, rooms=2, duration=0.5, rate=10, mix={'message': 1}, drain=0.5, log=lambda line: None,
+        )
+        fixtures = run.create_fixtures()
+        report = json.loads(json.dumps(asyncio.run(run.execute(application, fixtures))))
+        results = report['results']
+        self.assertGreater(results['messages_sent'], 0)
+        # Every message reaches both members of its room, the sender included
+        self.assertEqual(results['deliveries'], 2 * results['messages_sent'])
+        self.assertEqual(results['delivery_ratio'], 1.0)
+        self.assertIsNotNone(results['latency_ms']['p99'])
+        self.assertGreater(results['db_queries_per_message'], 0)
+        self.assertEqual(report['config']['clients'], 4)
+
+
+class RoomCounterTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+        self.messages = [Message.objects.create(room=self.room, sender=self.user, content=str(i)) for i in range(3)]
+
+    def test_saves_count_messages(self):
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.last_message_id), (3, self.messages[-1].id))
+
+    def test_deletes_are_counted_once_committed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.messages[-1].delete()
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.last_message_id), (2, self.messages[-2].id))
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(room=self.room).delete()
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.last_message_id), (0, None))
+
+    @override_settings(CHAT_PUBLIC_ROOMS_TIMEOUT=123)
+    def test_public_room_ids_expire(self):
+        private = Room.objects.create(name='Secret', slug='secret', room_type='private')
+        with mock.patch('chat.cache.cache.set', wraps=cache.set) as cache_set:
+            self.assertEqual(get_public_room_ids(), [self.room.id])
+        cache_set.assert_called_once_with(PUBLIC_ROOMS_KEY, [self.room.id], 123)
+        # Saving a room clears the list straight away
+        private.room_type = 'public'
+        private.save()
+        self.assertEqual(sorted(get_public_room_ids()), [self.room.id, private.id])
+
+
+class ShardedChannelLayerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = ShardedChannelLayer(shards=[{'BACKEND': 'channels.layers.InMemoryChannelLayer'}] * 3)
+
+    def group_on_other_shard(self, channel):
+        index = self.layer.shard_index(channel)
+        return next(
+            group for group in (f'chat_room{i}' for i in range(100))
+            if self.layer.shard_index(group) != index
+        )
+
+    def test_groups_spread_over_shards(self):
+        indexes = {self.layer.shard_index(f'chat_room{i}') for i in range(100)}
+        self.assertEqual(indexes, {0, 1, 2})
+        self.assertEqual(self.layer.shard_index('chat_general'), self.layer.shard_index('chat_general'))
+
+    async def test_channels_live_on_their_own_shard(self):
+        for _ in range(10):
+            channel = await self.layer.new_channel()
+            shard = self.layer.shard_for(channel)
+            await self.layer.send(channel, {'type': 'hello'})
+            self.assertEqual(await shard.receive(channel), {'type': 'hello'})
+
+    async def test_receive_follows_group_membership(self):
+        channel = await self.layer.new_channel()
+        group = self.group_on_other_shard(channel)
+        # Start listening before joining, as consumers do
+        receive = asyncio.ensure_future(self.layer.receive(channel))
+        await asyncio.sleep(0)
+        await self.layer.group_add(group, channel)
+        await self.layer.group_send(group, {'type': 'chat.message'})
+        self.assertEqual(await asyncio.wait_for(receive, 1), {'type': 'chat.message'})
+
+        await self.layer.group_discard(group, channel)
+        self.assertNotIn(channel, self.layer._memberships)
+        await self.layer.group_send(group, {'type': 'chat.message'})
+        await self.layer.send(channel, {'type': 'direct'})
+        self.assertEqual(await asyncio.wait_for(self.layer.receive(channel), 1), {'type': 'direct'})
+
+    def test_only_in_memory_layers_are_process_local(self):
+        in_memory = {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+        redis = {'BACKEND': 'channels_redis.core.RedisChannelLayer'}
+        for layer, expected in [
+            (in_memory, True),
+            (redis, False),
+            ({'BACKEND': 'chat.layers.ShardedChannelLayer', 'CONFIG': {'shards': [in_memory, in_memory]}}, True),
+            ({'BACKEND': 'chat.layers.ShardedChannelLayer', 'CONFIG': {'shards': [in_memory, redis]}}, False),
+        ]:
+            with self.subTest(layer=layer), self.settings(CHANNEL_LAYERS={'default': layer}):
+                self.assertIs(is_process_local(), expected)
+
+    async def test_messages_from_several_shards_are_kept(self):
+        channel = await self.layer.new_channel()
+        group = self.group_on_other_shard(channel)
+        await self.layer.group_add(group, channel)
+        await self.layer.group_send(group, {'type': 'one'})
+        await self.layer.send(channel, {'type': 'two'})
+        received = [await asyncio.wait_for(self.layer.receive(channel), 1) for _ in range(2)]
+        self.assertCountEqual(received, [{'type': 'one'}, {'type': 'two'}])
+
+
+class WireTests(SimpleTestCase):
+
+    def test_encode_round_trips(self):
+        payload = {'type': 'message', 'message': 'héllo "there"', 'message_id': 7}
+        self.assertEqual(json.loads(wire.encode(payload)), payload)
+        self.assertEqual(wire.decode(wire.encode(payload)), payload)
+
+    def test_join_text_makes_an_array_frame(self):
+        frames = [wire.encode({'type': 'typing', 'users': []}), wire.encode({'type': 'user_join', 'username': 'bob'})]
+        self.assertEqual(json.loads(wire.join_text(frames)), [json.loads(frame) for frame in frames])
+
+    def test_pack_round_trips(self):
+        payload = {'type': 'message', 'message_id': 3, 'timestamp': 't', 'username': 'bob', 'message': 'hi', 'avatar': None}
+        self.assertEqual(wire.unpack(wire.pack(payload)), payload)
+        # Positional fields, with the rest in a trailing map
+        self.assertEqual(len(wire.to_frame(payload)), 6)
+
+    def test_malformed_binary_frames_raise_value_error(self):
+        for data in (b'\xc1', b'\x91', b'\x05', b'\x93\xa6typing\x90\x05', b'\x91\x90'):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                wire.unpack(data)
+
+    def test_select_protocol(self):
+        offered = [wire.BINARY_PROTOCOL, wire.JSON_PROTOCOL]
+        with self.settings(CHAT_BINARY_PROTOCOL=True):
+            self.assertEqual(wire.select_protocol(offered), wire.BINARY_PROTOCOL)
+            self.assertEqual(wire.select_protocol([wire.JSON_PROTOCOL]), wire.JSON_PROTOCOL)
+        with self.settings(CHAT_BINARY_PROTOCOL=False):
+            self.assertEqual(wire.select_protocol(offered), wire.JSON_PROTOCOL)
+        self.assertIsNone(wire.select_protocol([]))
+
+    @override_settings(CHAT_BINARY_PROTOCOL=False)
+    def test_event_carries_the_encoded_frame(self):
+        payload = {'type': 'message', 'message': 'hi', 'message_id': 3}
+        event = wire.event('chat_message', payload, message_id=3)
+        self.assertEqual(event, {'type': 'chat_message', 'text': wire.encode(payload), 'message_id': 3})
+
+
+@fresh_recent_messages
+@override_settings(CHAT_BINARY_PROTOCOL=True)
+class MalformedFrameTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        Room.objects.create(name='General', slug='general')
+
+    async def test_bad_json_is_dropped(self):
+        client = communicator(self.user, '/ws/chat/general/')
+        await client.connect()
+        for text in ('{', '[1, 2]', '"message"'):
+            await client.send_to(text_data=text)
+        await client.send_json_to({'type': 'history'})
+        history = await receive_type(client, 'history')
+        self.assertEqual(history['messages'], [])
+        await client.disconnect()
+
+    async def test_bad_msgpack_is_dropped(self):
+        client = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), '/ws/chat/general/', subprotocols=[wire.BINARY_PROTOCOL],
+        )
+        client.scope['user'] = self.user
+        connected, subprotocol = await client.connect()
+        self.assertEqual(subprotocol, wire.BINARY_PROTOCOL)
+        for data in (b'\xc1', b'\x05', b'\x91\x90'):
+            await client.send_to(bytes_data=data)
+        await client.send_to(bytes_data=wire.pack({'type': 'history'}))
+        while True:
+            payload = wire.unpack(await client.receive_from())
+            if payload['type'] == 'history':
+                break
+        self.assertEqual(payload['messages'], [])
+        await client.disconnect()
+
+
+class OutboundBatchingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.sent.append(text_data if text_data is not None else bytes_data)
+
+    def queue(self, **kwargs):
+        return OutboundQueue(self.send, on_overflow=None, on_error=None, batch=True, window=0.01, **kwargs)
+
+    async def test_frames_in_a_window_go_out_as_one_array(self):
+        queue = self.queue()
+        frames = [wire.encode({'type': 'message', 'message_id': i}) for i in range(3)]
+        for frame in frames:
+            await queue.put(frame, message_id=json.loads(frame)['message_id'])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [wire.join_text(frames)])
+        self.assertEqual(queue.last_sent_id, 2)
+        queue.close()
+
+    async def test_max_bytes_splits_batches(self):
+        queue = self.queue(max_bytes=10)
+        for frame in ('"aaaa"', '"bbbb"', '"cccc"'):
+            await queue.put(frame)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, ['"aaaa"', '"bbbb"', '"cccc"'])
+        queue.close()
+
+    async def test_binary_batches_are_msgpack_arrays(self):
+        queue = self.queue(binary=True)
+        payloads = [{'type': 'user_join', 'username': 'bob'}, {'type': 'user_leave', 'username': 'bob'}]
+        for payload in payloads:
+            await queue.put(wire.pack(payload))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(wire.msgpack.unpackb(self.sent[0]), [wire.to_frame(payload) for payload in payloads])
+        queue.close()
+
+
+class OutboundBackpressureTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.overflowed = []
+        self.errors = 0
+        self.unblocked = asyncio.Event()
+        self.unblocked.set()
+
+    async def send(self, text_data=None, bytes_data=None):
+        # A slow client: the send only completes once unblocked
+        await self.unblocked.wait()
+        self.sent.append(text_data)
+
+    async def on_overflow(self, last_sent_id):
+        self.overflowed.append(last_sent_id)
+
+    async def on_error(self):
+        self.errors += 1
+
+    def queue(self, **kwargs):
+        return OutboundQueue(self.send, self.on_overflow, self.on_error, **kwargs)
+
+    async def test_low_priority_frames_are_shed_between_water_marks(self):
+        queue = self.queue(high_water=3, low_water=1, limit=10)
+        await queue.put('m1', message_id=1)
+        await asyncio.sleep(0)
+        self.unblocked.clear()
+        await queue.put('m2', message_id=2)
+        await asyncio.sleep(0)
+        await queue.put('typing1', low_priority=True)
+        await queue.put('m3', message_id=3)
+        await queue.put('m4', message_id=4)
+        # High water reached: the queued typing frame and new ones are dropped
+        await queue.put('typing2', low_priority=True)
+        self.assertTrue(queue.shedding)
+        self.assertEqual([item[0] for item in queue.frames], ['m3', 'm4'])
+
+        self.unblocked.set()
+        await asyncio.sleep(0.01)
+        self.assertFalse(queue.shedding)
+        await queue.put('typing3', low_priority=True)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['m1', 'm2', 'm3', 'm4', 'typing3'])
+        queue.close()
+
+    async def test_limit_disconnects_with_the_last_sent_id(self):
+        queue = self.queue(high_water=2, low_water=1, limit=3)
+        await queue.put('m1', message_id=1)
+        await asyncio.sleep(0)
+        self.unblocked.clear()
+        for message_id in range(2, 7):
+            await queue.put(f'm{message_id}', message_id=message_id)
+        self.assertEqual(self.overflowed, [1])
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue.frames), 0)
+
+    async def test_ack_window_holds_messages_until_acknowledged(self):
+        queue = self.queue(ack_window=2)
+        for message_id in range(1, 5):
+            await queue.put(f'm{message_id}', message_id=message_id)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['m1', 'm2'])
+        queue.ack(1)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['m1', 'm2', 'm3'])
+        queue.ack(4)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['m1', 'm2', 'm3', 'm4'])
+        queue.close()
+
+    async def test_send_errors_close_the_queue(self):
+        async def failing_send(**kwargs):
+            raise OSError('connection reset')
+
+        queue = OutboundQueue(failing_send, self.on_overflow, self.on_error)
+        with self.assertLogs('chat.outbound', 'ERROR'):
+            await queue.put('m1', message_id=1)
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.errors, 1)
+        self.assertTrue(queue.closed)
+        await queue.put('m2', message_id=2)
+        self.assertEqual(len(queue.frames), 0)
+
+
+def recent_message(message_id):
+    return {'message_id': message_id, 'message': str(message_id), 'username': 'alice'}
+
+
+class RecentMessagesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.recent = RecentMessages(size=3)
+
+    def ids(self, room_id=1):
+        snapshot = self.recent.get(room_id)
+        return snapshot and [message['message_id'] for message in snapshot.messages]
+
+    def test_appends_extend_a_seeded_buffer(self):
+        self.recent.seed(1, self.recent.version(1), [recent_message(1)], complete=True)
+        self.recent.append(1, recent_message(2))
+        self.recent.append(1, recent_message(2))
+        self.assertEqual(self.ids(), [1, 2])
+        self.assertTrue(self.recent.get(1).complete)
+        for message_id in (3, 4):
+            self.recent.append(1, recent_message(message_id))
+        self.assertEqual(self.ids(), [2, 3, 4])
+        self.assertFalse(self.recent.get(1).complete)
+
+    def test_out_of_order_appends_keep_id_order(self):
+        self.recent.seed(1, self.recent.version(1), [recent_message(1), recent_message(3)], complete=True)
+        self.recent.append(1, recent_message(5))
+        self.recent.append(1, recent_message(2))
+        self.assertEqual(self.ids(), [2, 3, 5])
+        self.assertFalse(self.recent.get(1).complete)
+        # Older than the window of a partial buffer
+        self.recent.append(1, recent_message(1))
+        self.assertEqual(self.ids(), [2, 3, 5])
+        self.recent.append(1, recent_message(4))
+        self.assertEqual(self.ids(), [3, 4, 5])
+
+    def test_shared_buffers_keep_id_order(self):
+        cache.clear()
+        recent = SharedRecentMessages(size=3)
+        recent.seed(1, recent.version(1), [recent_message(2)], complete=True)
+        for message_id in (4, 1, 3, 3):
+            recent.append(1, recent_message(message_id))
+        snapshot = recent.get(1)
+        self.assertEqual([message['message_id'] for message in snapshot.messages], [2, 3, 4])
+        self.assertFalse(snapshot.complete)
+
+    def test_seed_read_before_an_append_is_ignored(self):
+        version = self.recent.version(1)
+        self.recent.append(1, recent_message(2))
+        self.recent.seed(1, version, [recent_message(1)], complete=True)
+        self.assertIsNone(self.recent.get(1))
+
+    def test_backend_follows_the_channel_layer(self):
+        cases = [
+            ('channels.layers.InMemoryChannelLayer', None, RecentMessages),
+            ('channels.layers.InMemoryChannelLayer', 'cache', SharedRecentMessages),
+            ('channels_redis.core.RedisChannelLayer', None, SharedRecentMessages),
+            ('channels_redis.core.RedisChannelLayer', 'local', SharedRecentMessages),
+        ]
+        for layer, backend, expected in cases:
+            with self.subTest(layer=layer, backend=backend), \
+                    self.settings(CHANNEL_LAYERS={'default': {'BACKEND': layer}}, CHAT_RECENT_BACKEND=backend), \
+                    mock.patch('chat.recent._recent', None):
+                self.assertIsInstance(get_recent_messages(), expected)
+
+    def test_check_warns_about_buffers_other_workers_miss(self):
+        redis = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}}
+        with self.settings(CHANNEL_LAYERS=redis, CHAT_RECENT_BACKEND='local'):
+            self.assertEqual([warning.id for warning in check_recent_backend(None)], ['chat.W002'])
+        with self.settings(CHANNEL_LAYERS=redis, CHAT_RECENT_BACKEND=None):
+            self.assertEqual([warning.id for warning in check_recent_backend(None)], ['chat.W003'])
+        self.assertEqual(check_recent_backend(None), [])
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bobby_tables')
+        self.general = Room.objects.create(name='General', slug='general')
+        self.general.participants.add(self.alice, self.bob)
+        self.secret = Room.objects.create(name='Secret', slug='secret', room_type='private')
+        self.secret.participants.add(self.bob)
+        self.deploy = Message.objects.create(room=self.general, sender=self.bob, content='Deploying the new release')
+        Message.objects.create(room=self.general, sender=self.alice, content='Lunch anyone?')
+        Message.objects.create(room=self.secret, sender=self.bob, content='Deploy keys are rotated')
+
+    def contents(self, user, query, **kwargs):
+        messages, _ = search_messages(user, query, **kwargs)
+        return [message['message'] for message in messages]
+
+    def test_terms_match_word_prefixes(self):
+        self.assertEqual(self.contents(self.alice, 'deploy'), ['Deploying the new release'])
+        self.assertEqual(self.contents(self.alice, 'NEW rel'), ['Deploying the new release'])
+        self.assertEqual(self.contents(self.alice, 'deploy lunch'), [])
+        # Operators are plain words, not FTS syntax
+        self.assertEqual(self.contents(self.alice, 'deploy OR "lunch'), [])
+        self.assertEqual(self.contents(self.alice, '!!!'), [])
+
+    def test_only_member_rooms_are_searched(self):
+        self.assertEqual(self.contents(self.bob, 'deploy'), ['Deploy keys are rotated', 'Deploying the new release'])
+        self.assertEqual(self.contents(self.bob, 'deploy', room_id=self.general.id), ['Deploying the new release'])
+        self.assertEqual(self.contents(self.alice, 'rotated'), [])
+
+    def test_pages_go_back_in_time(self):
+        messages, before = search_messages(self.bob, 'deploy', limit=1)
+        self.assertEqual([message['room'] for message in messages], ['secret'])
+        messages, before = search_messages(self.bob, 'deploy', limit=1, before=before)
+        self.assertEqual([message['message_id'] for message in messages], [self.deploy.id])
+        self.assertIsNone(before)
+
+    def test_edits_and_deletes_reach_the_index(self):
+        self.deploy.content = 'Rolled back'
+        self.deploy.save()
+        self.assertEqual(self.contents(self.alice, 'deploy'), [])
+        self.assertEqual(self.contents(self.alice, 'rolled'), ['Rolled back'])
+        self.deploy.delete()
+        self.assertEqual(self.contents(self.alice, 'rolled'), [])
+
+    def test_admin_matches_content_and_username_parts(self):
+        admin = site._registry[Message]
+        results, _ = admin.get_search_results(None, Message.objects.all(), 'tables')
+        self.assertEqual(results.count(), 2)
+        results, _ = admin.get_search_results(None, Message.objects.all(), 'lunch')
+        self.assertEqual([message.content for message in results], ['Lunch anyone?'])
+
+    def test_check_reports_missing_triggers(self):
+        self.assertEqual(check_search_index(None, databases=['default']), [])
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER chat_message_fts_ai')
+        warnings = check_search_index(None, databases=['default'])
+        self.assertEqual([warning.id for warning in warnings], ['chat.W001'])
+        self.assertIn('chat_message_fts_ai', warnings[0].msg)
+
+
+class NotificationTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='Bob')
+        self.carol = User.objects.create(username='carol')
+        self.room = Room.objects.create(name='General', slug='general')
+        self.room.participants.add(self.alice, self.bob, self.carol)
+        self.pipeline = NotificationPipeline(flush_interval=0)
+        self.online = set()
+        patcher = mock.patch('chat.notifications.online_user_ids', side_effect=lambda ids: self.online & set(ids))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, content, sender=None):
+        sender = sender or self.alice
+        message = Message.objects.create(room=self.room, sender=sender, content=content)
+        return (self.room.id, sender.id, sender.username, message.id, content)
+
+    def unread(self, user):
+        return list(Notification.objects.filter(user=user, is_read=False).values_list('notification_type', 'count', 'content'))
+
+    def test_find_mentions(self):
+        self.assertEqual(find_mentions('@Bob and @carol. mail me@example.com, @a.b!'), {'bob', 'carol', 'a.b'})
+
+    def test_offline_users_get_one_unread_row_per_kind(self):
+        items = [self.post('one'), self.post('two @bob'), self.post('three')]
+        self.assertEqual(self.pipeline.write(items), [])
+        self.assertEqual(self.unread(self.carol), [('message', 3, '3 new messages in General, latest from alice: three')])
+        self.assertCountEqual(self.unread(self.bob), [
+            ('message', 2, '2 new messages in General, latest from alice: three'),
+            ('mention', 1, 'alice mentioned you in General: two @bob'),
+        ])
+        self.assertEqual(self.unread(self.alice), [])
+
+        # Later batches fold into the row while it is unread
+        self.pipeline.write([self.post('four')])
+        self.assertEqual(self.unread(self.carol), [('message', 4, '4 new messages in General, latest from alice: four')])
+        Notification.objects.filter(user=self.carol).update(is_read=True)
+        self.pipeline.write([self.post('five')])
+        self.assertEqual(self.unread(self.carol), [('message', 1, 'New message in General from alice: five')])
+
+    def test_online_users_get_one_push(self):
+        self.online = {self.bob.id}
+        items = [self.post('one'), self.post('two')]
+        pushes = self.pipeline.write(items)
+        self.assertEqual(pushes, [(self.bob.id, {
+            'type': 'notification',
+            'notification_type': 'message',
+            'room': 'general',
+            'count': 2,
+            'message_id': items[-1][3],
+            'content': '2 new messages in General, latest from alice: two',
+        })])
+        self.assertEqual(self.unread(self.bob), [])
+
+    async def test_submitted_messages_are_pushed_in_one_batch(self):
+        self.online = {self.bob.id, self.carol.id}
+        layer = RecordingLayer()
+        items = [await sync_to_async(self.post)(content) for content in ('one', 'two')]
+        with mock.patch('chat.notifications.get_channel_layer', return_value=layer):
+            for item in items:
+                self.pipeline.submit(*item)
+            await asyncio.sleep(0.2)
+        self.pipeline._task.cancel()
+        self.assertCountEqual([group for group, _ in layer.sent], [f'user_{self.bob.id}', f'user_{self.carol.id}'])
+        self.assertEqual(json.loads(layer.sent[0][1]['text'])['count'], 2)
+
+
+class UploadTests(TransactionTestCase):
+
+    def setUp(self):
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media, CHAT_UPLOAD_TEMP_DIR=os.path.join(media, 'parts')))
+        self.enterContext(mock.patch('chat.uploads.get_notification_pipeline'))
+        self.user = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+        self.room.participants.add(self.user)
+        self.upload = Upload.objects.create(user=self.user, room=self.room, filename='notes.txt', size=10)
+
+    async def put(self, offset, data, **headers):
+        request = AsyncRequestFactory().put(
+            f'/uploads/{self.upload.pk}/', data, content_type='application/octet-stream',
+            headers={'Upload-Offset': str(offset)},
+        )
+        request.META.update(headers)
+        request.auser = sync_to_async(lambda: self.user)
+        response = await upload_view(request, self.upload.pk)
+        return response.status_code, json.loads(response.content)
+
+    async def test_chunks_append_at_the_received_offset(self):
+        self.assertEqual(await write_chunk(self.upload, 0, io.BytesIO(b'hello')), 5)
+        # A retry racing the first attempt; the bytes are the same
+        self.assertIsNone(await write_chunk(self.upload, 0, io.BytesIO(b'hello')))
+        with self.assertRaises(ValueError):
+            await write_chunk(self.upload, 5, io.BytesIO(b'world!'))
+        self.assertEqual(await write_chunk(self.upload, 5, io.BytesIO(b'world')), 10)
+        with open(part_path(self.upload), 'rb') as part:
+            self.assertEqual(part.read(), b'helloworld')
+
+    async def test_invalid_content_length_is_rejected(self):
+        status, data = await self.put(0, b'hello', CONTENT_LENGTH='five')
+        self.assertEqual((status, data['error']), (400, 'Invalid Content-Length header.'))
+        status, data = await self.put(3, b'hello')
+        self.assertEqual((status, data['offset']), (409, 0))
+
+    async def test_last_chunk_posts_the_message(self):
+        await self.put(0, b'hello')
+        status, data = await self.put(5, b'world')
+        message = await Message.objects.aget(pk=data['message_id'])
+        self.assertEqual((status, message.content), (200, 'notes.txt'))
+        with default_storage.open(message.file.name) as stored:
+            self.assertEqual(stored.read(), b'helloworld')
+        self.assertFalse(os.path.exists(part_path(self.upload)))
+
+    async def test_failed_completion_can_be_retried(self):
+        await self.put(0, b'hello')
+        with mock.patch('chat.uploads.post_upload', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('chat.views', 'ERROR'):
+            status, _ = await self.put(5, b'world')
+        self.assertEqual(status, 503)
+        self.assertTrue(os.path.exists(part_path(self.upload)))
+        self.assertEqual(await Message.objects.acount(), 0)
+        self.assertEqual(os.listdir(os.path.join(default_storage.location, 'chat_files')), [])
+
+        status, data = await self.put(10, b'')
+        self.assertEqual(status, 200)
+        self.assertIsNotNone(data['message_id'])
+        self.assertEqual(await Message.objects.acount(), 1)
+        # Nothing left to complete
+        status, _ = await self.put(10, b'')
+        self.assertEqual((status, await Message.objects.acount()), (200, 1))
+
+    def test_expire_removes_stale_uploads_and_files(self):
+        fresh = Upload.objects.create(user=self.user, room=self.room, filename='new.txt', size=10)
+        for upload in (self.upload, fresh):
+            advance_upload(upload, 0, write_part(upload, 0, io.BytesIO(b'hello')))
+        orphan = os.path.join(os.path.dirname(part_path(self.upload)), 'leftover.part.clean')
+        open(orphan, 'wb').close()
+        old = time.time() - 7200
+        for path in (part_path(self.upload), part_path(fresh), orphan):
+            os.utime(path, (old, old))
+        Upload.objects.filter(pk=self.upload.pk).update(updated_at=self.upload.updated_at - timedelta(hours=2))
+
+        with override_settings(CHAT_UPLOAD_EXPIRY=3600):
+            call_command('expire_uploads', stdout=io.StringIO())
+        self.assertEqual(list(Upload.objects.values_list('pk', flat=True)), [fresh.pk])
+        self.assertEqual(os.listdir(os.path.dirname(orphan)), [os.path.basename(part_path(fresh))])
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.enterContext(override_settings(CHAT_ARCHIVE_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+        self.user = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+        old = timezone.now() - timedelta(days=30)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.user, content=str(i), timestamp=old) for i in range(5)
+        ]
+
+    def test_reserved_ids_stay_above_archived_ones(self):
+        archive_batch(self.room.id, timezone.now(), 10)
+        # Rebuilding the table can reset the sequence to the rows left
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s', [Message._meta.db_table])
+        ids = reserve_message_ids(3)
+        self.assertGreater(ids[0], self.messages[-1].id)
+
+    def test_archiving_keeps_room_counters(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            archive_batch(self.room.id, timezone.now(), 10)
+        self.room.refresh_from_db()
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(ArchiveSegment.objects.get().message_count, 5)
+        self.assertEqual((self.room.message_count, self.room.last_message_id), (5, self.messages[-1].id))
+
+    def test_notifications_outlive_archived_messages(self):
+        notification = Notification.objects.create(
+            user=self.user, room=self.room, notification_type='mention',
+            message=self.messages[-1], content='bob mentioned you in General: 4',
+        )
+        archive_batch(self.room.id, timezone.now(), 10)
+        notification.refresh_from_db()
+        self.assertIsNone(notification.message_id)
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(reverse('notifications')), 'bob mentioned you in General')
+
+
+class SQLiteWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.room = Room.objects.create(name='General', slug='general')
+        self.writer = SQLiteWriter()
+        self.hooks = []
+        metrics.reset()
+
+    def post(self, content, fail=False):
+        message = Message.objects.create(room=self.room, sender=self.user, content=content)
+        # Runs once the group has committed, never for a rolled back write
+        transaction.on_commit(lambda: self.hooks.append((content, connection.get_autocommit())))
+        if fail:
+            raise ValueError(content)
+        return message.id
+
+    def test_queued_writes_commit_together(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        self.writer.submit(block)
+        started.wait(5)
+        futures = [self.writer.submit(self.post, content) for content in ('one', 'two', 'three')]
+        release.set()
+        ids = [future.result(5) for future in futures]
+        self.assertEqual(list(Message.objects.order_by('id').values_list('id', flat=True)), ids)
+        self.assertEqual(metrics.snapshot()['sqlite_writer.commits'], 2)
+        self.assertEqual(self.hooks, [('one', True), ('two', True), ('three', True)])
+
+    def test_a_failing_write_is_rolled_back_alone(self):
+        started, release = threading.Event(), threading.Event()
+        self.writer.submit(lambda: (started.set(), release.wait(5)))
+        started.wait(5)
+        futures = [self.writer.submit(self.post, content, fail=content == 'bad') for content in ('good', 'bad', 'fine')]
+        release.set()
+        with self.assertRaisesMessage(ValueError, 'bad'):
+            futures[1].result(5)
+        futures[2].result(5)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)), ['good', 'fine'])
+        self.assertEqual([content for content, _ in self.hooks], ['good', 'fine'])
+
+    def test_busy_groups_are_retried(self):
+        wrapper = type(connections['default'])
+        real = wrapper.commit
+        calls = []
+
+        def commit(db_connection):
+            calls.append(db_connection)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            real(db_connection)
+
+        with mock.patch.object(wrapper, 'commit', commit), mock.patch('chat.db.time.sleep'):
+            message_id = self.writer.submit(self.post, 'retried').result(5)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [message_id])
+        self.assertEqual(metrics.snapshot()['sqlite_writer.busy_retries'], 1)
+        # Hooks of the attempt that was rolled back are dropped
+        self.assertEqual(self.hooks, [('retried', True)])
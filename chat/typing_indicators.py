@@ -0,0 +1,97 @@
+"""
+Server-side coalescing of typing indicators
+"""
+import asyncio
+import uuid
+
+from django.conf import settings
+
+from . import wire
+
+# Tags this process's snapshots, which clients merge with other workers'
+SOURCE = uuid.uuid4().hex[:12]
+
+
+class TypingAggregator:
+    """Merge typing updates for one room into periodic snapshots.
+
+    Consumers report who started or stopped typing; the aggregator sends a
+    single ``typing_indicator`` event listing everyone currently typing, at
+    most ``max_rate`` times per second and only when the list changed.
+    Entries not refreshed within ``ttl`` seconds expire on their own.
+
+    State is per process, so each worker reports the typists connected to
+    it in snapshots tagged with its ``SOURCE``; clients show the union of
+    the latest snapshot from every source. A non-empty snapshot is repeated
+    every ``ttl / 2`` seconds and clients forget one after ``ttl``, so the
+    typists of a worker that died disappear too.
+    """
+
+    def __init__(self, channel_layer, group_name, max_rate=2, ttl=5):
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.interval = 1 / max_rate
+        self.ttl = ttl
+        self.typing = {}
+        self.dirty = False
+        self.last_sent = 0
+        self._task = None
+
+    def update(self, username, is_typing):
+        """Record a typing state change for ``username``"""
+        loop = asyncio.get_running_loop()
+        if is_typing:
+            if username not in self.typing:
+                self.dirty = True
+            self.typing[username] = loop.time() + self.ttl
+        elif self.typing.pop(username, None) is not None:
+            self.dirty = True
+        if self.dirty and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.typing or self.dirty:
+                if self.typing and loop.time() - self.last_sent >= self.ttl / 2:
+                    self.dirty = True
+                if self.dirty:
+                    self.dirty = False
+                    self.last_sent = loop.time()
+                    await self.channel_layer.group_send(
+                        self.group_name,
+                        wire.event('typing_indicator', {
+                            'type': 'typing',
+                            'source': SOURCE,
+                            'users': sorted(self.typing),
+                            'ttl': self.ttl,
+                        })
+                    )
+                await asyncio.sleep(self.interval)
+
+                # Expire typists that stopped sending updates
+                now = loop.time()
+                for username in [u for u, expires in self.typing.items() if expires <= now]:
+                    del self.typing[username]
+                    self.dirty = True
+        finally:
+            self._task = None
+            if not self.typing and _aggregators.get(self.group_name) is self:
+                del _aggregators[self.group_name]
+
+
+_aggregators = {}
+
+
+def get_typing_aggregator(channel_layer, group_name):
+    """Return the typing aggregator for a room group in this process"""
+    aggregator = _aggregators.get(group_name)
+    if aggregator is None:
+        aggregator = TypingAggregator(
+            channel_layer,
+            group_name,
+            max_rate=getattr(settings, 'CHAT_TYPING_MAX_RATE', 2),
+            ttl=getattr(settings, 'CHAT_TYPING_TTL', 5),
+        )
+        _aggregators[group_name] = aggregator
+    return aggregator
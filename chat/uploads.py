@@ -0,0 +1,275 @@
+"""
+Resumable chunked uploads of message attachments
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from . import imaging, wire
+from .db import db_pool_to_async, db_write_to_async
+from .history import serialize_attachment, serialize_message
+from .models import Message, Upload
+from .notifications import get_notification_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Bytes copied from the request to the partial file at a time
+READ_SIZE = 64 * 1024
+
+THUMBNAIL_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+# Seconds one request may spend completing an upload before another may
+# try again
+COMPLETE_LOCK_TIMEOUT = 300
+
+
+def get_chunk_size():
+    return getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+
+def upload_dir():
+    """Directory holding the partial files of unfinished uploads"""
+    return getattr(settings, 'CHAT_UPLOAD_TEMP_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'uploads')
+
+
+def part_path(upload):
+    """Where the bytes of an unfinished upload are kept"""
+    return os.path.join(upload_dir(), f'{upload.pk}.part')
+
+
+def start_upload(user, room, filename, size, content_type='', caption=''):
+    """Register an upload; raises ValueError for an unacceptable one"""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid upload size')
+    if size <= 0 or size > getattr(settings, 'CHAT_UPLOAD_MAX_SIZE', 100 * 1024 * 1024):
+        raise ValueError('Upload size out of range')
+    try:
+        filename = get_valid_filename(os.path.basename(str(filename)))[-255:]
+    except SuspiciousFileOperation:
+        raise ValueError('Invalid file name')
+    return Upload.objects.create(
+        user=user,
+        room=room,
+        filename=filename,
+        size=size,
+        content_type=str(content_type)[:100],
+        caption=str(caption),
+    )
+
+
+def write_part(upload, offset, stream):
+    """Write the chunk read from ``stream`` at ``offset`` of the partial file.
+
+    The chunk is copied in small reads, so neither it nor the file is ever
+    held in memory. Returns the number of bytes written. Raises ValueError
+    when the chunk would run past the declared size.
+    """
+    path = part_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    remaining = upload.size - offset
+    written = 0
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as part:
+        part.seek(offset)
+        while True:
+            data = stream.read(min(READ_SIZE, remaining - written + 1))
+            if not data:
+                break
+            written += len(data)
+            if written > remaining:
+                raise ValueError('Chunk runs past the end of the upload')
+            part.write(data)
+        # Drop whatever an interrupted earlier attempt left past this chunk
+        part.truncate()
+    return written
+
+
+def advance_upload(upload, offset, written):
+    """Record a written chunk; None if another request advanced the upload first"""
+    advanced = Upload.objects.filter(pk=upload.pk, received=offset).update(
+        received=offset + written, updated_at=timezone.now(),
+    )
+    return offset + written if advanced else None
+
+
+async def write_chunk(upload, offset, stream):
+    """Write a chunk at ``offset`` and return the new offset.
+
+    Only the bookkeeping goes to the database writer; the file is written
+    on a thread of its own so a slow disk never holds up other writes.
+    Returns None if another request advanced the upload first.
+    """
+    written = await sync_to_async(write_part)(upload, offset, stream)
+    return await db_write_to_async(advance_upload)(upload, offset, written)
+
+
+def store(path, name):
+    """Copy a finished local file into media storage"""
+    with open(path, 'rb') as source:
+        return default_storage.save(name, File(source))
+
+
+def post_upload(upload, user, content, fields):
+    """Create the upload's message and link the upload to it in one go"""
+    with transaction.atomic():
+        message = Message.objects.create(room_id=upload.room_id, sender=user, content=content, **fields)
+        Upload.objects.filter(pk=upload.pk).update(message=message)
+    return message
+
+
+def expire_uploads(max_age):
+    """Delete uploads left unfinished for ``max_age`` and their partial files.
+
+    Partial files without an upload, such as those of uploads deleted with
+    their room, go once they are as old. Returns the number of uploads and
+    files removed.
+    """
+    cutoff = timezone.now() - max_age
+    uploads, _ = Upload.objects.filter(message__isnull=True, updated_at__lt=cutoff).delete()
+    directory = upload_dir()
+    if not os.path.isdir(directory):
+        return uploads, 0
+    # path -> upload id, None for files no upload could have written
+    old_files = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.getmtime(path) < cutoff.timestamp():
+            try:
+                old_files[path] = uuid.UUID(name.split('.', 1)[0])
+            except ValueError:
+                old_files[path] = None
+    live = set(Upload.objects.filter(pk__in={pk for pk in old_files.values() if pk}).values_list('pk', flat=True))
+    files = 0
+    for path, upload_id in old_files.items():
+        if upload_id not in live:
+            os.remove(path)
+            files += 1
+    return uploads, files
+
+
+async def complete_upload(upload, user):
+    """Post a fully received upload to its room and return the message.
+
+    Images get a thumbnail in the process pool before the message is
+    broadcast; stripping metadata from the full-size image continues in
+    the background and ends with an ``attachment_ready`` event. Other files
+    are published as they are.
+
+    The partial file is kept until the upload is linked to its message, so
+    a completion that fails can be retried. Returns None while another
+    request is completing the same upload.
+    """
+    # chat.avatars uses this module's image pool
+    from .avatars import add_avatars
+
+    lock = f'chat:upload:{upload.pk}:completing'
+    if not await cache.aadd(lock, True, COMPLETE_LOCK_TIMEOUT):
+        return None
+    try:
+        if await Upload.objects.filter(pk=upload.pk, message__isnull=False).aexists():
+            # Finished by a request that held the lock just before
+            return None
+        loop = asyncio.get_running_loop()
+        path = part_path(upload)
+        stem, _ = os.path.splitext(upload.filename)
+        fields = {}
+        thumbnail_format = None
+        if upload.content_type.startswith('image/'):
+            thumbnail_format = await loop.run_in_executor(
+                get_image_pool(), imaging.make_thumbnail,
+                path, path + '.thumb', getattr(settings, 'CHAT_THUMBNAIL_SIZE', 320),
+            )
+        content = upload.caption or upload.filename
+        try:
+            if thumbnail_format:
+                fields['thumbnail'] = await sync_to_async(store)(
+                    path + '.thumb', f'chat_thumbnails/{stem}{THUMBNAIL_EXTENSIONS[thumbnail_format]}'
+                )
+            else:
+                fields['file'] = await sync_to_async(store)(path, f'chat_files/{upload.filename}')
+            # Written directly even in batched mode: a queued message could
+            # still be written after its files were removed for a retry
+            message = await db_write_to_async(post_upload)(upload, user, content, fields)
+        except Exception:
+            # A retry stores the files again
+            for name in fields.values():
+                await sync_to_async(default_storage.delete)(name)
+            raise
+    finally:
+        await cache.adelete(lock)
+    upload.message = message
+    await sync_to_async(os.remove)(path + '.thumb' if thumbnail_format else path)
+
+    payload, = await db_pool_to_async(add_avatars)([serialize_message(message)])
+    await get_channel_layer().group_send(
+        f'chat_{upload.room.slug}',
+        wire.event('chat_message', {
+            'type': 'message',
+            **payload,
+        }, message_id=message.id)
+    )
+    get_notification_pipeline().submit(upload.room_id, user.id, user.username, message.id, content)
+
+    if thumbnail_format:
+        task = asyncio.create_task(finish_image(upload, message, path))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    return message
+
+
+async def finish_image(upload, message, path):
+    """Publish the full-size image once its metadata is stripped"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(get_image_pool(), imaging.strip_metadata, path, path + '.clean')
+        message.image = await sync_to_async(store)(path + '.clean', f'chat_images/{upload.filename}')
+        await db_write_to_async(message.save)(update_fields=['image'])
+    except Exception:
+        logger.exception('Failed to process image upload %s', upload.pk)
+        return
+    finally:
+        for leftover in (path, path + '.clean'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    await get_channel_layer().group_send(
+        f'chat_{upload.room.slug}',
+        wire.event('attachment_ready', {
+            'type': 'attachment_ready',
+            'message_id': message.id,
+            'attachment': serialize_attachment(message),
+        })
+    )
+
+
+# Background image tasks, referenced until they finish
+_tasks = set()
+
+_pool = None
+
+
+def get_image_pool():
+    """Return the process pool that runs Pillow, started on first use"""
+    global _pool
+    if _pool is None:
+        # Spawned workers only import chat.imaging, never the forked state
+        # of a server process
+        _pool = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'CHAT_IMAGE_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _pool
@@ -10,4 +10,9 @@ urlpatterns = [
     path('notifications/', views.notifications_view, name='notifications'),
     path('room/create/', views.create_room_view, name='create_room'),
     path('room/<slug:slug>/', views.room_view, name='room'),
+    path('room/<slug:slug>/history/', views.room_history_view, name='room_history'),
+    path('room/<slug:slug>/uploads/', views.upload_create_view, name='upload_create'),
+    path('uploads/<uuid:upload_id>/', views.upload_view, name='upload'),
+    path('search/', views.search_view, name='search'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
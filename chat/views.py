@@ -1,12 +1,29 @@
+import json
+import logging
+import os
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib import messages
-from django.db.models import Q, Count
+from django.http import JsonResponse
+from django.views.decorators.http import require_http_methods, require_POST
+from django.utils.dateparse import parse_datetime
 from django.utils.text import slugify
-from .models import Room, Message, UserProfile, Notification
+from django.db.models import Count, Q
+from .models import Room, Message, UserProfile, Notification, Upload
 from .forms import UserRegisterForm, UserProfileForm, RoomForm
+from .avatars import add_avatars, process_avatar
+from .cache import get_public_room_ids
+from .db import db_write_to_async, get_db_pool
+from .history import get_history_page
+from .presence import online_user_ids
+from .search import search_messages
+from .uploads import complete_upload, get_chunk_size, start_upload, write_chunk
+from . import metrics, wire
+
+logger = logging.getLogger(__name__)
 
 
 def register_view(request):
@@ -62,9 +79,17 @@ def logout_view(request):
 @login_required
 def home_view(request):
     """Home page with list of chat rooms"""
-    rooms = Room.objects.filter(
-        Q(room_type='public') | Q(participants=request.user)
-    ).distinct().annotate(message_count=Count('messages'))
+    # Public rooms come from the cache, the user's own rooms from the
+    # membership table; message counts are stored on the room
+    room_ids = set(get_public_room_ids())
+    room_ids.update(
+        Room.participants.through.objects.filter(user=request.user).values_list('room_id', flat=True)
+    )
+    # Online counts for every room in the same query, from the flags the
+    # presence service flushes every CHAT_PRESENCE_FLUSH_INTERVAL seconds
+    rooms = Room.objects.filter(pk__in=room_ids).annotate(
+        online_count=Count('participants', filter=Q(participants__profile__is_online=True)),
+    )
     
     # Get or create user profile
     profile, created = UserProfile.objects.get_or_create(user=request.user)
@@ -90,20 +115,133 @@ def room_view(request, slug):
     if request.user not in room.participants.all():
         room.participants.add(request.user)
     
-    # Get messages
-    messages_list = room.messages.select_related('sender').all()
+    # Get the latest page of messages, older ones are fetched on scroll
+    messages_list, history_cursor = get_history_page(room.id)
+    # Pages come serialized; the template formats the timestamp itself
+    messages_list = [
+        {**message, 'timestamp': parse_datetime(message['timestamp'])}
+        for message in add_avatars(messages_list)
+    ]
     
     # Get online users
-    online_users = room.participants.filter(profile__is_online=True)
+    online_ids = online_user_ids(room.participants.values_list('id', flat=True))
+    online_users = room.participants.filter(pk__in=online_ids).order_by('username')
     
     context = {
         'room': room,
         'messages': messages_list,
+        'history_cursor': history_cursor,
         'online_users': online_users,
+        'binary_protocol': wire.binary_enabled(),
     }
     return render(request, 'chat/room.html', context)
 
 
+@login_required
+def room_history_view(request, slug):
+    """Older messages of a room as JSON, paginated with a before cursor"""
+    room = get_object_or_404(Room, slug=slug)
+    
+    if room.room_type == 'private' and not room.participants.filter(pk=request.user.pk).exists():
+        return JsonResponse({'error': 'You do not have access to this room.'}, status=403)
+    
+    try:
+        messages_list, next_cursor = get_history_page(room.id, before=request.GET.get('before'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    return JsonResponse({
+        'messages': add_avatars(messages_list),
+        'next_cursor': next_cursor,
+    })
+
+
+# The upload views are async so finishing an upload can broadcast and hand
+# work to the image pool from the server's event loop
+
+def upload_status(upload):
+    return {
+        'upload_id': str(upload.pk),
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': get_chunk_size(),
+        'message_id': upload.message_id,
+    }
+
+
+@require_POST
+async def upload_create_view(request, slug):
+    """Start a resumable attachment upload: {filename, size, content_type, caption}"""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required.'}, status=401)
+    room = await Room.objects.filter(slug=slug).afirst()
+    if room is None:
+        return JsonResponse({'error': 'Room not found.'}, status=404)
+    if not await room.participants.filter(pk=user.pk).aexists():
+        return JsonResponse({'error': 'You do not have access to this room.'}, status=403)
+    
+    try:
+        data = json.loads(request.body)
+        upload = await db_write_to_async(start_upload)(
+            user, room, data.get('filename', ''), data.get('size'),
+            data.get('content_type', ''), data.get('caption', ''),
+        )
+    except (ValueError, AttributeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(upload_status(upload), status=201)
+
+
+@require_http_methods(['GET', 'PUT'])
+async def upload_view(request, upload_id):
+    """Upload progress (GET), or the next chunk at the Upload-Offset header (PUT)"""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required.'}, status=401)
+    upload = await Upload.objects.select_related('room').filter(pk=upload_id, user_id=user.id).afirst()
+    if upload is None:
+        return JsonResponse({'error': 'Upload not found.'}, status=404)
+    if request.method == 'GET' or upload.message_id is not None:
+        return JsonResponse(upload_status(upload))
+    
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Missing or invalid Upload-Offset header.'}, status=400)
+    if offset != upload.received:
+        # The client resumes from the offset we report
+        return JsonResponse(upload_status(upload), status=409)
+    try:
+        length = int(request.headers.get('Content-Length') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid Content-Length header.'}, status=400)
+    if length > get_chunk_size():
+        return JsonResponse({'error': 'Chunk too large.'}, status=413)
+    
+    # Once every byte is in, an empty PUT at the end retries a completion
+    # that failed
+    if not upload.is_complete:
+        try:
+            received = await write_chunk(upload, offset, request)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        if received is None:
+            await upload.arefresh_from_db(fields=['received'])
+            return JsonResponse(upload_status(upload), status=409)
+        upload.received = received
+    if upload.is_complete:
+        try:
+            message = await complete_upload(upload, user)
+        except Exception:
+            logger.exception('Failed to complete upload %s', upload.pk)
+            return JsonResponse({'error': 'The upload could not be completed; try again.'}, status=503)
+        if message is None:
+            # Completed, or being completed, by another request
+            await upload.arefresh_from_db(fields=['message'])
+            return JsonResponse(upload_status(upload), status=409)
+    return JsonResponse(upload_status(upload))
+
+
 @login_required
 def create_room_view(request):
     """Create new chat room"""
@@ -132,6 +270,8 @@ def profile_view(request):
         form = UserProfileForm(request.POST, request.FILES, instance=profile)
         if form.is_valid():
             form.save()
+            if 'avatar' in form.changed_data and profile.avatar:
+                process_avatar(profile)
             messages.success(request, 'Profile updated successfully!')
             return redirect('profile')
     else:
@@ -149,9 +289,9 @@ def notifications_view(request):
     """User notifications view"""
     notifications = request.user.notifications.all()[:20]
     
-    # Mark all as read
+    # Mark all as read; new messages then start a fresh notification
     if request.method == 'POST':
-        notifications.update(is_read=True)
+        request.user.notifications.filter(is_read=False).update(is_read=True)
         return redirect('notifications')
     
     context = {
@@ -159,3 +299,34 @@ def notifications_view(request):
         'unread_count': request.user.notifications.filter(is_read=False).count(),
     }
     return render(request, 'chat/notifications.html', context)
+
+
+@login_required
+def search_view(request):
+    """Search messages in the user's rooms, optionally within one room"""
+    room_id = None
+    if request.GET.get('room'):
+        room_id = get_object_or_404(Room, slug=request.GET['room']).id
+    try:
+        before = int(request.GET['before']) if request.GET.get('before') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid before parameter'}, status=400)
+    
+    messages_list, next_before = search_messages(
+        request.user, request.GET.get('q', ''), room_id=room_id, before=before
+    )
+    return JsonResponse({
+        'messages': messages_list,
+        'next_before': next_before,
+    })
+
+
+@staff_member_required
+def metrics_view(request):
+    """Operational counters of the process serving the request"""
+    return JsonResponse({
+        'pid': os.getpid(),
+        'counters': metrics.snapshot(),
+        'timings': metrics.timings(),
+        'db_pool': get_db_pool().stats(),
+    })
@@ -0,0 +1,125 @@
+"""
+Websocket wire encoding shared by every consumer
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_PROTOCOL = 'chat.json'
+BINARY_PROTOCOL = 'chat.msgpack'
+
+# Positional layout of binary frames: [type, *fields, {other fields}].
+# Keep in sync with ChatWire.SCHEMAS in static/js/chat.js
+SCHEMAS = {
+    'message': ('message_id', 'timestamp', 'username', 'message'),
+    'typing': ('users',),
+    'user_join': ('username',),
+    'user_leave': ('username',),
+}
+
+
+def encode(payload):
+    """Encode a client payload as JSON text"""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def decode(text):
+    """Decode a JSON text frame from a client"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def binary_enabled():
+    """Whether clients may negotiate the MessagePack protocol"""
+    return msgpack is not None and getattr(settings, 'CHAT_BINARY_PROTOCOL', False)
+
+
+def to_frame(payload):
+    """Compact positional form of a payload for binary frames"""
+    fields = SCHEMAS.get(payload['type'], ())
+    frame = [payload['type']]
+    frame.extend(payload.get(field) for field in fields)
+    rest = {key: value for key, value in payload.items() if key != 'type' and key not in fields}
+    if rest:
+        frame.append(rest)
+    return frame
+
+
+def pack(payload):
+    """Encode a client payload as a MessagePack frame"""
+    return msgpack.packb(to_frame(payload))
+
+
+def unpack(data):
+    """Decode a binary frame from a client into a payload dict.
+
+    Raises ValueError for anything that is not a well-formed frame, as
+    ``decode`` does for bad JSON.
+    """
+    frame = msgpack.unpackb(data)
+    if isinstance(frame, dict):
+        return frame
+    try:
+        message_type, values = frame[0], frame[1:]
+        fields = SCHEMAS.get(message_type, ())
+        payload = {'type': message_type, **dict(zip(fields, values))}
+        if len(values) > len(fields):
+            payload.update(values[len(fields)])
+    except (TypeError, IndexError, KeyError) as exc:
+        raise ValueError('Malformed binary frame') from exc
+    return payload
+
+
+def select_protocol(offered):
+    """Pick the subprotocol to accept from those a client offered"""
+    if BINARY_PROTOCOL in offered and binary_enabled():
+        return BINARY_PROTOCOL
+    if JSON_PROTOCOL in offered:
+        return JSON_PROTOCOL
+    return None
+
+
+def join_text(frames):
+    """Combine JSON text frames into one array frame"""
+    return '[' + ','.join(frames) + ']'
+
+
+def join_binary(frames):
+    """Combine MessagePack frames into one array frame without re-encoding"""
+    count = len(frames)
+    if count < 16:
+        header = bytes([0x90 | count])
+    elif count < 0x10000:
+        header = b'\xdc' + count.to_bytes(2, 'big')
+    else:
+        header = b'\xdd' + count.to_bytes(4, 'big')
+    return header + b''.join(frames)
+
+
+def event(handler, payload, **extra):
+    """Build a channel layer event whose client frame is encoded once.
+
+    The sender encodes ``payload`` here and every receiving consumer
+    forwards ``event['text']`` (or ``event['bytes']`` for binary clients)
+    untouched, so a broadcast costs one encode no matter how many sockets
+    are in the group. ``extra`` carries routing fields the receivers
+    inspect, such as the room of a call event.
+    """
+    message = {'type': handler, 'text': encode(payload), **extra}
+    if binary_enabled():
+        message['bytes'] = pack(payload)
+    return message
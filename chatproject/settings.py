@@ -92,6 +92,194 @@ CHANNEL_LAYERS = {
 #     },
 # }
 
+# To spread rooms over several Redis servers, shard the layer. Each room's
+# group lives on one shard picked by consistent hashing, so joins and
+# broadcasts only touch that server. Swap the shard backends for
+# 'channels.layers.InMemoryChannelLayer' to try sharding in one process.
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'chat.layers.ShardedChannelLayer',
+#         'CONFIG': {
+#             'shards': [
+#                 {
+#                     'BACKEND': 'channels_redis.core.RedisChannelLayer',
+#                     'CONFIG': {'hosts': [('10.0.0.1', 6379)]},
+#                 },
+#                 {
+#                     'BACKEND': 'channels_redis.core.RedisChannelLayer',
+#                     'CONFIG': {'hosts': [('10.0.0.2', 6379)]},
+#                 },
+#             ],
+#         },
+#     },
+# }
+
+
+# Chat message persistence
+# 'sync' writes each message before it is broadcast. 'batched' assigns ids
+# up front, broadcasts immediately and writes rows with bulk_create once
+# CHAT_MESSAGE_BATCH_SIZE messages are queued or CHAT_MESSAGE_FLUSH_INTERVAL
+# seconds have passed. Ids come from the database's sequence in blocks of
+# CHAT_MESSAGE_BATCH_SIZE on SQLite and PostgreSQL, so other writers never
+# collide with them, though with several processes ids only roughly follow
+# send order; other databases need a single process writing messages.
+# Reconnect replays and their dedupe go by id, so with a channel layer that
+# spans processes a reconnecting client reloads the room instead of
+# receiving the messages it missed.
+# Messages still queued at shutdown are written by an atexit hook, which
+# does not run when the process is killed with SIGKILL or dies abruptly;
+# up to CHAT_MESSAGE_FLUSH_INTERVAL seconds of messages are lost then.
+CHAT_MESSAGE_WRITE_MODE = 'sync'
+CHAT_MESSAGE_BATCH_SIZE = 100
+CHAT_MESSAGE_FLUSH_INTERVAL = 0.05
+
+# Websocket consumers and the background pipelines run their queries on a
+# pool of CHAT_DB_THREADS threads per process, each holding its own database
+# connection; size it below the database's connection limit divided by the
+# number of workers. Queue wait and saturation show up on the metrics view.
+CHAT_DB_THREADS = 8
+
+# SQLite production mode: every connection gets WAL, synchronous=NORMAL,
+# CHAT_SQLITE_MMAP_SIZE bytes of mmap and a page cache of
+# CHAT_SQLITE_CACHE_SIZE (KiB when negative), and connections are kept open.
+# Writes from the websocket consumers and background pipelines go through a
+# single writer thread that commits up to CHAT_SQLITE_GROUP_COMMIT_SIZE of
+# them per transaction, while reads stay on the CHAT_DB_THREADS pool.
+CHAT_SQLITE_PRODUCTION = False
+CHAT_SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+CHAT_SQLITE_CACHE_SIZE = -64000
+CHAT_SQLITE_GROUP_COMMIT_SIZE = 200
+
+# Number of room slug -> id and username -> id lookups kept in each process
+CHAT_ROOM_CACHE_SIZE = 1024
+CHAT_USER_CACHE_SIZE = 4096
+
+# Seconds the list of public room ids stays in the shared cache; saves and
+# deletes clear it at once, this bounds how long bulk updates go unnoticed
+CHAT_PUBLIC_ROOMS_TIMEOUT = 300
+
+# Typing indicators are merged per room and process into one snapshot, sent
+# at most CHAT_TYPING_MAX_RATE times per second; clients merge the snapshots
+# of all processes. Typists that stop sending updates drop out after
+# CHAT_TYPING_TTL seconds.
+CHAT_TYPING_MAX_RATE = 2
+CHAT_TYPING_TTL = 5
+
+# Messages rendered with the room page and returned per history request
+CHAT_HISTORY_PAGE_SIZE = 50
+
+# Let websocket clients negotiate the compact MessagePack protocol
+# ('chat.msgpack' subprotocol). Broadcasts are then encoded in both formats
+# once per send; JSON text frames remain the default.
+CHAT_BINARY_PROTOCOL = False
+
+# Per-connection send queue, in frames. Past the high water mark typing and
+# join/leave events are dropped until the queue drains to the low water
+# mark; at the limit the client is disconnected with a resume token.
+# Clients connecting with ?ack=1 acknowledge the messages they handle and
+# get at most CHAT_SEND_WINDOW unacknowledged ones; Daphne does not push
+# back on sends, so only these clients are ever held to the limits.
+CHAT_SEND_QUEUE_HIGH_WATER = 200
+CHAT_SEND_QUEUE_LOW_WATER = 50
+CHAT_SEND_QUEUE_LIMIT = 1000
+CHAT_SEND_WINDOW = 100
+
+# Sockets opened with ?batch=1 gather outgoing events for up to
+# CHAT_OUTBOUND_BATCH_WINDOW seconds, or CHAT_OUTBOUND_BATCH_BYTES bytes,
+# and receive them as a single array frame
+CHAT_OUTBOUND_BATCH_WINDOW = 0.01
+CHAT_OUTBOUND_BATCH_BYTES = 16384
+
+# Newest CHAT_RECENT_MESSAGES serialized messages of active rooms are kept
+# in memory for room pages, history and reconnect replays. 'local' buffers
+# are per process, capped at CHAT_RECENT_MEMORY_BUDGET bytes with idle rooms
+# evicted first, and only see messages saved by their own process. 'cache'
+# keeps them in the default cache, which must then be shared by the workers
+# (Redis, Memcached). None picks 'local' for the in-memory channel layer;
+# a channel layer spanning processes always uses 'cache'.
+CHAT_RECENT_BACKEND = None
+CHAT_RECENT_MESSAGES = 100
+CHAT_RECENT_MEMORY_BUDGET = 32 * 1024 * 1024
+CHAT_RECENT_CACHE_TIMEOUT = 3600
+
+# Most messages replayed to a client reconnecting with last_message_id;
+# clients that missed more reload the room instead
+CHAT_RESUME_MAX_MESSAGES = 200
+
+# Message search: None picks SQLite FTS5 or a PostgreSQL GIN index from the
+# database vendor (LIKE scans elsewhere); or a dotted path to a
+# chat.search.SearchBackend subclass
+CHAT_SEARCH_BACKEND = None
+CHAT_SEARCH_PAGE_SIZE = 20
+
+# Attachments are uploaded in chunks of at most CHAT_UPLOAD_CHUNK_SIZE bytes
+# to partial files in CHAT_UPLOAD_TEMP_DIR, kept outside MEDIA_ROOT so they
+# are never served. "manage.py expire_uploads" deletes uploads that have not
+# received a chunk for CHAT_UPLOAD_EXPIRY seconds, and their partial files.
+# Thumbnails and metadata stripping run in a pool of CHAT_IMAGE_WORKERS
+# processes.
+CHAT_UPLOAD_MAX_SIZE = 100 * 1024 * 1024
+CHAT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+CHAT_UPLOAD_TEMP_DIR = BASE_DIR / 'uploads'
+CHAT_UPLOAD_EXPIRY = 24 * 3600
+CHAT_THUMBNAIL_SIZE = 320
+CHAT_IMAGE_WORKERS = 2
+
+# Avatars get square thumbnails of CHAT_AVATAR_SIZES pixels, made in the
+# image pool after upload and named by content hash under
+# MEDIA_URL/avatars/thumbs/, so they can be served with far-future cache
+# headers. Messages show the CHAT_AVATAR_SIZE one. Sender names and avatar
+# URLs of up to CHAT_RENDER_CACHE_SIZE users are cached per process.
+CHAT_AVATAR_SIZES = (32, 64, 128)
+CHAT_AVATAR_SIZE = 64
+CHAT_RENDER_CACHE_SIZE = 4096
+
+# Retention: archive_messages moves messages older than a room's
+# retention_days (CHAT_RETENTION_DAYS when unset; None keeps them forever)
+# into gzipped NDJSON segments, CHAT_ARCHIVE_BATCH_SIZE messages each.
+# Segments go to the 'chat_archive' entry of STORAGES if there is one (e.g.
+# object storage), else to CHAT_ARCHIVE_DIR, which is deliberately not
+# under MEDIA_ROOT. History pages read through to archived messages.
+CHAT_RETENTION_DAYS = None
+CHAT_ARCHIVE_DIR = BASE_DIR / 'archive'
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+CHAT_ARCHIVE_CACHE_SIZE = 32
+
+# Notifications are created in the background: messages are collected for
+# CHAT_NOTIFICATION_FLUSH_INTERVAL seconds, then online participants get a
+# push and offline ones a coalesced unread notification per room. At most
+# CHAT_NOTIFICATION_QUEUE_SIZE messages wait; beyond that they are skipped.
+CHAT_NOTIFICATION_FLUSH_INTERVAL = 1.0
+CHAT_NOTIFICATION_QUEUE_SIZE = 10000
+
+# Read receipts arriving within this many seconds on one connection are
+# merged into a single high-water-mark update
+CHAT_READ_RECEIPT_WINDOW = 0.5
+
+# Presence: each worker refreshes the users it has connected every
+# CHAT_PRESENCE_HEARTBEAT seconds; keys expire after CHAT_PRESENCE_TTL.
+# UserProfile.last_seen/is_online are written every CHAT_PRESENCE_FLUSH_INTERVAL.
+CHAT_PRESENCE_TTL = 30
+CHAT_PRESENCE_HEARTBEAT = 10
+CHAT_PRESENCE_FLUSH_INTERVAL = 30
+
+
+# Cache
+# Presence lives in the default cache. Local memory is per process; point
+# this at a shared backend such as Redis when running several workers:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#         'LOCATION': 'redis://127.0.0.1:6379',
+#     },
+# }
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -100,6 +288,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep each thread's connection, with its page cache and mmap, in
+        # SQLite production mode
+        'CONN_MAX_AGE': None if CHAT_SQLITE_PRODUCTION else 0,
     }
 }
 